@@ -0,0 +1,5 @@
+import os
+
+# Metrics are never sent from benchmarks. This must be set before opentsdb_python_metrics is imported,
+# which otherwise connects to the metrics server.
+os.environ.setdefault('OPENTSDB_PYTHON_METRICS_TEST_MODE', 'True')
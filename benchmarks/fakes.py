@@ -0,0 +1,188 @@
+"""In-process stand-ins for the science archive API and the file store.
+
+The fake archive is served by a requests transport adapter, mounted on the pooled session that
+:class:`ocs_ingester.archive.ArchiveService` uses for the API root, so that benchmarks exercise the real
+request and response handling without a network or a server.
+"""
+import io
+import gzip
+import json
+import time
+import hashlib
+import threading
+from urllib.parse import urlparse, parse_qs
+
+import requests
+from requests.adapters import BaseAdapter
+
+from ocs_archive.storage.filestore import FileStore
+
+from ocs_ingester.archive import get_session
+
+API_ROOT = 'http://benchmark-archive/'
+
+
+class FakeArchive(object):
+    """Thread-safe state of a fake science archive, answering the requests made by ArchiveService."""
+    def __init__(self):
+        self.md5s = set()
+        self.frames = []
+        self._lock = threading.Lock()
+
+    def handle(self, method, path, query, body):
+        """Returns the status code and JSON content of the response to a request.
+
+        Args:
+            method (str): HTTP method
+            path (str): Path of the url, relative to the API root
+            query (dict): Query parameters, as parsed by urllib.parse.parse_qs
+            body (bytes): Request body
+        """
+        path = path.strip('/')
+        with self._lock:
+            if method == 'GET' and path == 'versions':
+                return 200, self._versions(query)
+            if method == 'POST' and path == 'frames':
+                return 201, self._post_frame(self._load(body))
+            if method == 'POST' and path == 'frames/bulk':
+                return 201, [self._post_frame(record) for record in self._load(body)]
+        return 404, {'detail': 'Not found.'}
+
+    @staticmethod
+    def _load(body):
+        # Request bodies may be gzip compressed, depending on ARCHIVE_GZIP_MIN_SIZE
+        if body[:2] == b'\x1f\x8b':
+            body = gzip.decompress(body)
+        return json.loads(body)
+
+    def _versions(self, query):
+        md5s = query['md5__in'][0].split(',') if 'md5__in' in query else query.get('md5', [])
+        results = [{'md5': md5} for md5 in md5s if md5 in self.md5s]
+        return {'count': len(results), 'next': None, 'results': results}
+
+    def _post_frame(self, record):
+        self.md5s.update(version['md5'] for version in record.get('version_set', []))
+        self.frames.append(record['basename'])
+        frame_id = len(self.frames)
+        return {
+            'id': frame_id,
+            'filename': record['basename'],
+            'proposal_id': record.get('proposal_id'),
+            'url': 'http://benchmark-files/{0}'.format(frame_id),
+        }
+
+
+class FakeArchiveAdapter(BaseAdapter):
+    """Requests transport adapter that sends requests to a FakeArchive instead of over the network.
+
+    Args:
+        api_root (str): API root that the adapter is mounted for
+        latency (float): Seconds that every response is delayed by
+    """
+    def __init__(self, api_root=API_ROOT, latency=0.0):
+        super().__init__()
+        self.api_root_path = urlparse(api_root).path
+        self.latency = latency
+        self.archive = FakeArchive()
+
+    def send(self, request, **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+        url = urlparse(request.url)
+        status_code, content = self.archive.handle(
+            request.method, url.path[len(self.api_root_path):], parse_qs(url.query), request.body
+        )
+        response = requests.Response()
+        response.status_code = status_code
+        response.headers['Content-Type'] = 'application/json'
+        response.raw = io.BytesIO(json.dumps(content).encode())
+        response.encoding = 'utf-8'
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        pass
+
+
+def mount_fake_archive(api_root=API_ROOT, latency=0.0):
+    """Routes requests to api_root to a new FakeArchiveAdapter, returning the adapter."""
+    adapter = FakeArchiveAdapter(api_root, latency=latency)
+    get_session(api_root).mount(api_root, adapter)
+    return adapter
+
+
+class FakeFileStore(FileStore):
+    """Reads and hashes stored files in chunks, the way an upload would, without storing them.
+
+    Args:
+        latency (float): Seconds that every upload is delayed by
+        chunk_size (int): Bytes read at a time
+    """
+    def __init__(self, latency=0.0, chunk_size=8 * 1024 * 1024):
+        self.latency = latency
+        self.chunk_size = chunk_size
+        self.uploaded = 0
+
+    def store_file(self, data_file):
+        if self.latency:
+            time.sleep(self.latency)
+        fileobj = data_file.open_file.get_from_start()
+        md5 = hashlib.md5()
+        for chunk in iter(lambda: fileobj.read(self.chunk_size), b''):
+            md5.update(chunk)
+        self.uploaded += 1
+        return {'key': 'version{0}'.format(self.uploaded), 'md5': md5.hexdigest(),
+                'extension': data_file.open_file.extension}
+
+
+class FakeObjectStore(object):
+    """Thread-safe state of a fake S3 compatible object store, answering the requests made by MultipartS3Store.
+
+    Objects are not kept, only the md5s of their contents and of the parts of multipart uploads.
+    """
+    def __init__(self):
+        self.versions = 0
+        self.uploads = {}
+        self._lock = threading.Lock()
+
+    def handle(self, method, path, query, body):
+        """Returns the status code, headers and body of the response to a path style S3 request.
+
+        Args:
+            method (str): HTTP method
+            path (str): Path of the url, starting with the bucket
+            query (dict): Query parameters, as parsed by urllib.parse.parse_qs with keep_blank_values
+            body (bytes): Request body
+        """
+        with self._lock:
+            if 'uploadId' in query and query['uploadId'][0] not in self.uploads:
+                return 404, {}, self._xml('Error', '<Code>NoSuchUpload</Code>')
+            if method == 'PUT' and 'uploadId' in query:
+                digest = hashlib.md5(body).digest()
+                self.uploads[query['uploadId'][0]][int(query['partNumber'][0])] = digest
+                return 200, {'ETag': '"{0}"'.format(digest.hex())}, b''
+            if method == 'PUT':
+                return 200, self._version_headers(hashlib.md5(body).hexdigest()), b''
+            if method == 'POST' and 'uploads' in query:
+                upload_id = 'upload{0}'.format(len(self.uploads) + 1)
+                self.uploads[upload_id] = {}
+                return 200, {}, self._xml('InitiateMultipartUploadResult', '<UploadId>{0}</UploadId>'.format(upload_id))
+            if method == 'POST' and 'uploadId' in query:
+                parts = self.uploads.pop(query['uploadId'][0])
+                digests = [parts[number] for number in sorted(parts)]
+                etag = '{0}-{1}'.format(hashlib.md5(b''.join(digests)).hexdigest(), len(digests))
+                headers = self._version_headers(etag)
+                return 200, headers, self._xml('CompleteMultipartUploadResult', '<ETag>{0}</ETag>'.format(headers['ETag']))
+            if method == 'DELETE':
+                self.uploads.pop(query.get('uploadId', [None])[0], None)
+                return 204, {}, b''
+        return 400, {}, self._xml('Error', '<Code>NotImplemented</Code>')
+
+    def _version_headers(self, etag):
+        self.versions += 1
+        return {'ETag': '"{0}"'.format(etag), 'x-amz-version-id': 'version{0}'.format(self.versions)}
+
+    @staticmethod
+    def _xml(element, content):
+        return '<?xml version="1.0" encoding="UTF-8"?><{0}>{1}</{0}>'.format(element, content).encode()
@@ -0,0 +1,114 @@
+"""Generate synthetic frames to benchmark the ingester with.
+
+Three kinds of frames are generated, each with the headers that the science archive requires:
+
+* ``image``: a compressed ``.fits.fz`` image with a WCS, so that its corners are computed
+* ``catalog``: a ``_cat.fits.fz`` source catalog table
+* ``spectrum``: a ``.tar.gz`` bundle of spectra along with the FITS file holding its headers
+
+Every frame has random data, so that each one has a different md5.
+"""
+import io
+import os
+import tarfile
+
+import numpy as np
+from astropy.io import fits
+
+KINDS = ('image', 'catalog', 'spectrum')
+
+
+def frame_header(basename, index, obstype='EXPOSE'):
+    site_telescope, instrument, day = basename.split('-')[:3]
+    return fits.Header({
+        'SITEID': site_telescope[:3],
+        'TELID': '1m0a',
+        'ENCID': 'doma',
+        'INSTRUME': instrument,
+        'PROPID': 'BENCHMARK-001',
+        'OBSTYPE': obstype,
+        'DATE-OBS': '{0}-{1}-{2}T10:13:{3:06.3f}'.format(day[:4], day[4:6], day[6:], index % 60),
+        'DAY-OBS': day,
+        'EXPTIME': 30.0,
+        'BLKUID': 100000 + index,
+        'REQNUM': 200000 + index,
+        'MOLUID': 300000 + index,
+        'OBJECT': 'Benchmark {0}'.format(index),
+        'FILTER': 'rp',
+        'RLEVEL': 91,
+        'L1PUBDAT': '{0}-{1}-{2}T10:13:00'.format(int(day[:4]) + 1, day[4:6], day[6:]),
+    })
+
+
+def add_wcs(header, size):
+    header.update({
+        'CTYPE1': 'RA---TAN', 'CTYPE2': 'DEC--TAN',
+        'CRPIX1': size / 2.0, 'CRPIX2': size / 2.0,
+        'CRVAL1': 186.27, 'CRVAL2': 13.02,
+        'CD1_1': -1.08e-4, 'CD1_2': 0.0, 'CD2_1': 0.0, 'CD2_2': 1.08e-4,
+    })
+
+
+def write_image(directory, index, size, rng):
+    """Writes a size by size pixel compressed image."""
+    basename = 'cpt1m010-fa16-20191013-{0:04d}-e91'.format(index)
+    header = frame_header(basename, index)
+    add_wcs(header, size)
+    data = rng.integers(0, 65535, size=(size, size), dtype=np.uint16).astype(np.int32)
+    path = os.path.join(directory, basename + '.fits.fz')
+    fits.HDUList([fits.PrimaryHDU(), fits.CompImageHDU(data=data, header=header)]).writeto(path)
+    return path
+
+
+def write_catalog(directory, index, size, rng):
+    """Writes a catalog with size sources."""
+    basename = 'cpt1m010-fa16-20191013-{0:04d}-e91_cat'.format(index)
+    header = frame_header(basename, index)
+    columns = [
+        fits.Column(name=name, format='D', array=rng.random(size)) for name in ('ra', 'dec', 'flux', 'fluxerr')
+    ]
+    path = os.path.join(directory, basename + '.fits.fz')
+    fits.HDUList([fits.PrimaryHDU(header=header), fits.BinTableHDU.from_columns(columns)]).writeto(path)
+    return path
+
+
+def write_spectrum(directory, index, size, rng):
+    """Writes a bundle of spectra with size bytes of data per spectrum."""
+    basename = 'lscnrs01-fl09-20191013-{0:04d}-e91'.format(index)
+    header = frame_header(basename, index, obstype='TARGET')
+    members = {basename + '-meta.fits': _fits_bytes(fits.HDUList([fits.PrimaryHDU(header=header)]))}
+    for order in range(2):
+        data = rng.random(max(1, size // 8))
+        members['{0}-spectrum-{1}.fits'.format(basename, order)] = _fits_bytes(
+            fits.HDUList([fits.PrimaryHDU(), fits.ImageHDU(data=data)])
+        )
+    path = os.path.join(directory, basename + '.tar.gz')
+    with tarfile.open(path, 'w:gz') as tar:
+        for name, content in members.items():
+            info = tarfile.TarInfo(os.path.join(basename, name))
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+    return path
+
+
+def _fits_bytes(hdulist):
+    buffer = io.BytesIO()
+    hdulist.writeto(buffer)
+    return buffer.getvalue()
+
+
+WRITERS = {'image': write_image, 'catalog': write_catalog, 'spectrum': write_spectrum}
+
+
+def generate_frames(directory, kind, count, size, seed=0):
+    """Writes count synthetic frames of the given kind into directory, returning their paths.
+
+    Args:
+        directory (str): Directory to write the frames into
+        kind (str): One of KINDS
+        count (int): Number of frames
+        size (int): Pixels per side of an image, sources in a catalog, or bytes per spectrum
+        seed (int): Seed for the random data, so that the same frames are generated every time
+    """
+    rng = np.random.default_rng(seed)
+    return [WRITERS[kind](directory, index, size, rng) for index in range(count)]
@@ -0,0 +1,236 @@
+"""Load test the ingester with concurrent clients against local stand-ins for the archive and S3.
+
+Stub HTTP servers for the science archive API and an S3 compatible object store are started in a separate
+process, so that they do not compete with the clients for the interpreter. Every response can be delayed,
+and a fraction of them can be failed with a 503, to see how the ingester degrades when the archive or S3
+slow down or fail. Synthetic frames are then ingested with ``upload_file_and_ingest_to_archive`` from
+concurrent client threads, in the same way that the workers of ``ocs_ingest_watch`` ingest files, and the
+throughput, outcomes and latency percentiles of the ingests are reported.
+
+Retries are configured by the RETRY_* environment variables, as they are for the ingester itself.
+
+Examples:
+    Ingest 200 frames with 8 clients against an archive that takes 50ms to respond:
+
+    $ python -m benchmarks.loadtest --count 200 --concurrency 8 --archive-latency 0.05
+
+    See how the ingester behaves when one in ten archive responses is a 503, with retries enabled:
+
+    $ RETRY_MAX_ATTEMPTS=3 RETRY_BASE_DELAY=0.1 python -m benchmarks.loadtest --archive-error-rate 0.1
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import threading
+import multiprocessing
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from ocs_archive.settings import settings as archive_settings
+
+from ocs_ingester.batch import INGESTED, outcome_status_for_exception
+from ocs_ingester.ingester import upload_file_and_ingest_to_archive
+from ocs_ingester.settings import settings as ingester_settings
+
+from benchmarks.fakes import FakeArchive, FakeObjectStore
+from benchmarks.frames import KINDS, generate_frames
+
+AUTH_TOKEN = 'loadtest'
+
+
+class StubServer(ThreadingHTTPServer):
+    """HTTP server that answers requests with a fake service, after an injected latency or error.
+
+    Args:
+        service: FakeArchive or FakeObjectStore that answers the requests
+        latency (float): Seconds that every response is delayed by
+        error_rate (float): Fraction of requests that are answered with a 503
+    """
+    daemon_threads = True
+
+    def __init__(self, service, latency=0.0, error_rate=0.0):
+        super().__init__(('127.0.0.1', 0), StubHandler)
+        self.service = service
+        self.latency = latency
+        self.error_rate = error_rate
+        self.requests = Counter()
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{0}/'.format(self.server_address[1])
+
+    def respond(self, method, path, query, body):
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.requests[method] += 1
+            if random.random() < self.error_rate:
+                self.errors += 1
+                return 503, {}, b'Service Unavailable'
+        if isinstance(self.service, FakeArchive):
+            status_code, content = self.service.handle(method, path, query, body)
+            return status_code, {'Content-Type': 'application/json'}, json.dumps(content).encode()
+        return self.service.handle(method, path, query, body)
+
+    def stats(self):
+        with self._lock:
+            return {'requests': dict(self.requests), 'errors': self.errors}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    # Keep connections alive, as the archive and S3 do
+    protocol_version = 'HTTP/1.1'
+    # The headers and body are written separately, which would otherwise be held up by delayed ACKs
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_PUT(self):
+        self._handle('PUT')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_DELETE(self):
+        self._handle('DELETE')
+
+    def _handle(self, method):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        url = urlparse(self.path)
+        status_code, headers, content = self.server.respond(
+            method, url.path, parse_qs(url.query, keep_blank_values=True), body
+        )
+        self.send_response(status_code)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(connection, archive_latency, archive_error_rate, s3_latency, s3_error_rate):
+    """Runs the stub servers until told to stop over the connection, then sends back their stats."""
+    servers = {
+        'archive': StubServer(FakeArchive(), archive_latency, archive_error_rate),
+        's3': StubServer(FakeObjectStore(), s3_latency, s3_error_rate),
+    }
+    for server in servers.values():
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    connection.send({name: server.url for name, server in servers.items()})
+    connection.recv()
+    for server in servers.values():
+        server.shutdown()
+    connection.send({name: server.stats() for name, server in servers.items()})
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100.0))]
+
+
+def ingest(path, api_root):
+    """Ingests a file, returning its outcome status and the seconds the ingest took."""
+    start = time.perf_counter()
+    try:
+        with open(path, 'rb') as fileobj:
+            upload_file_and_ingest_to_archive(fileobj, api_root=api_root, auth_token=AUTH_TOKEN)
+        status = INGESTED
+    except Exception as e:
+        status = outcome_status_for_exception(e)
+    return status, time.perf_counter() - start
+
+
+def report(outcomes, elapsed, server_stats):
+    latencies = [latency for _, latency in outcomes]
+    print('Ingested {0} files in {1:.2f}s, {2:.2f} files/s'.format(len(outcomes), elapsed, len(outcomes) / elapsed))
+    print('Outcomes: {0}'.format(', '.join(
+        '{0} {1}'.format(count, status) for status, count in sorted(Counter(status for status, _ in outcomes).items())
+    )))
+    print('Latency (ms): p50 {0:.1f}, p95 {1:.1f}, p99 {2:.1f}, max {3:.1f}'.format(
+        *(value * 1000.0 for value in (percentile(latencies, 50), percentile(latencies, 95),
+                                       percentile(latencies, 99), max(latencies)))
+    ))
+    for name, stats in sorted(server_stats.items()):
+        print('{0} requests: {1}, injected errors: {2}'.format(
+            name, ', '.join('{0} {1}'.format(count, method) for method, count in sorted(stats['requests'].items())),
+            stats['errors']
+        ))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Load test the ingester with concurrent clients against local stand-ins for the archive and S3'
+    )
+    parser.add_argument('--count', type=int, default=100, help='Number of files to ingest')
+    parser.add_argument('--concurrency', type=int, default=4, help='Number of concurrent clients')
+    parser.add_argument('--kinds', nargs='+', choices=KINDS, default=['image'],
+                        help='Kinds of frames to ingest, in equal numbers')
+    parser.add_argument('--image-size', type=int, default=512, help='Pixels per side of image frames')
+    parser.add_argument('--catalog-size', type=int, default=10000, help='Sources per catalog frame')
+    parser.add_argument('--spectrum-size', type=int, default=256 * 1024, help='Bytes per spectrum')
+    parser.add_argument('--archive-latency', type=float, default=0.0, help='Seconds added to every archive response')
+    parser.add_argument('--archive-error-rate', type=float, default=0.0,
+                        help='Fraction of archive requests that are answered with a 503')
+    parser.add_argument('--s3-latency', type=float, default=0.0, help='Seconds added to every S3 response')
+    parser.add_argument('--s3-error-rate', type=float, default=0.0,
+                        help='Fraction of S3 requests that are answered with a 503')
+    args = parser.parse_args()
+
+    connection, server_connection = multiprocessing.Pipe()
+    server_process = multiprocessing.Process(target=serve, daemon=True, args=(
+        server_connection, args.archive_latency, args.archive_error_rate, args.s3_latency, args.s3_error_rate
+    ))
+    server_process.start()
+    urls = connection.recv()
+
+    # Upload to the stub object store, with credentials so that requests are signed, and keep the
+    # ingester free of local state
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'loadtest')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'loadtest')
+    archive_settings.FILESTORE_TYPE = 's3'
+    archive_settings.S3_ENDPOINT_URL = urls['s3']
+    archive_settings.S3_ADDRESSING_STYLE = 'path'
+    archive_settings.AWS_DEFAULT_REGION = os.environ.get('AWS_DEFAULT_REGION') or 'us-west-2'
+    ingester_settings.MD5_INDEX_PATH = ''
+    ingester_settings.CHECKPOINT_PATH = ''
+
+    sizes = {'image': args.image_size, 'catalog': args.catalog_size, 'spectrum': args.spectrum_size}
+    outcomes = []
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            paths = []
+            for index, kind in enumerate(args.kinds):
+                kind_directory = os.path.join(directory, kind)
+                os.mkdir(kind_directory)
+                count = args.count // len(args.kinds) + (index < args.count % len(args.kinds))
+                paths.extend(generate_frames(kind_directory, kind, count, sizes[kind], seed=index))
+
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+                outcomes = list(executor.map(lambda path: ingest(path, urls['archive']), paths))
+            elapsed = time.perf_counter() - start
+    finally:
+        connection.send('stop')
+        server_stats = connection.recv()
+        server_process.join()
+
+    if not outcomes:
+        print('No files were ingested', file=sys.stderr)
+        sys.exit(1)
+    report(outcomes, elapsed, server_stats)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,204 @@
+"""Benchmark the ingester against synthetic frames and in-process stand-ins for its services.
+
+Each benchmark is run against every kind of frame from :mod:`benchmarks.frames`:
+
+* ``parse``: ``validate_fits_and_create_archive_record``, which reads the headers and computes the WCS
+* ``exists``: ``frame_exists``, which hashes the file and asks the archive about its md5
+* ``ingest``: ``Ingester.ingest``, which runs every stage from hashing the file to posting its record
+
+The throughput and peak memory of every benchmark are reported, along with the mean time spent in each
+stage of an ingest. Results are compared with a stored baseline, and the command exits with status 1 if
+any benchmark regressed by more than the tolerance. Baselines are only comparable between runs on the
+same machine, and each result is stored with the number and size of the frames it was generated from, so
+that a benchmark of other frames is not compared with it.
+
+Examples:
+    Run the benchmarks and save the results as the new baseline:
+
+    $ python -m benchmarks.run --save-baseline
+
+    Run the benchmarks against larger images, and compare them with the baseline:
+
+    $ python -m benchmarks.run --kinds image --image-size 4096
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import tracemalloc
+
+from ocs_ingester import ingester
+from ocs_ingester.archive import ArchiveService
+from ocs_ingester.settings import settings as ingester_settings
+
+from benchmarks.fakes import API_ROOT, FakeFileStore, mount_fake_archive
+from benchmarks.frames import KINDS, generate_frames
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), 'baseline.json')
+AUTH_TOKEN = 'benchmark'
+
+
+def bench_parse(paths, stages):
+    for path in paths:
+        with open(path, 'rb') as fileobj:
+            ingester.validate_fits_and_create_archive_record(fileobj)
+
+
+def bench_exists(paths, stages):
+    mount_fake_archive()
+    for path in paths:
+        with open(path, 'rb') as fileobj:
+            ingester.frame_exists(fileobj, api_root=API_ROOT, auth_token=AUTH_TOKEN)
+
+
+def bench_ingest(paths, stages):
+    # A fresh archive every run, so that no frame has been ingested already
+    mount_fake_archive()
+    filestore = FakeFileStore()
+    archive = ArchiveService(API_ROOT, AUTH_TOKEN)
+    for path in paths:
+        with open(path, 'rb') as fileobj:
+            result = ingester.Ingester(ingester.Frame(fileobj), filestore, archive).ingest()
+        for stage, seconds in result['ingest_stats']['stages'].items():
+            stages[stage] = stages.get(stage, 0.0) + seconds
+
+
+BENCHMARKS = {'parse': bench_parse, 'exists': bench_exists, 'ingest': bench_ingest}
+
+
+def run_benchmark(benchmark, paths, repeat):
+    """Runs a benchmark over the paths, returning its best throughput, peak memory and mean stage times."""
+    total_bytes = sum(os.path.getsize(path) for path in paths)
+    best = None
+    stages = {}
+    for _ in range(repeat):
+        stages = {}
+        start = time.perf_counter()
+        benchmark(paths, stages)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    # Memory is measured in a separate run, since tracing allocations slows everything down
+    tracemalloc.start()
+    try:
+        benchmark(paths, {})
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {
+        'frames_per_second': round(len(paths) / best, 3),
+        'megabytes_per_second': round(total_bytes / best / 1e6, 3),
+        'peak_megabytes': round(peak / 1e6, 3),
+        'stages': {stage: round(seconds / len(paths), 6) for stage, seconds in sorted(stages.items())},
+    }
+
+
+def comparable(result, expected):
+    """Returns whether a result was generated from frames of the same number and size as the expected one."""
+    return expected is not None and result['parameters'] == expected.get('parameters')
+
+
+def compare(results, baseline, tolerance):
+    """Returns a description of every benchmark that regressed by more than the tolerance.
+
+    Benchmarks without a comparable baseline are skipped.
+    """
+    regressions = []
+    for name, result in sorted(results.items()):
+        expected = baseline.get(name)
+        if not comparable(result, expected):
+            continue
+        if result['frames_per_second'] < expected['frames_per_second'] * (1 - tolerance):
+            regressions.append('{0}: {1} frames/s, baseline {2}'.format(
+                name, result['frames_per_second'], expected['frames_per_second']
+            ))
+        if result['peak_megabytes'] > expected['peak_megabytes'] * (1 + tolerance):
+            regressions.append('{0}: {1} MB peak memory, baseline {2}'.format(
+                name, result['peak_megabytes'], expected['peak_megabytes']
+            ))
+    return regressions
+
+
+def report(results, baseline):
+    print('{0:<18} {1:>10} {2:>10} {3:>10} {4:>10}  {5}'.format(
+        'benchmark', 'frames/s', 'MB/s', 'peak MB', 'baseline', 'stages (ms per frame)'
+    ))
+    for name, result in sorted(results.items()):
+        expected = baseline.get(name)
+        if expected is None:
+            expected = '-'
+        elif not comparable(result, expected):
+            expected = 'other size'
+        else:
+            expected = expected['frames_per_second']
+        stages = ' '.join(
+            '{0}={1:.2f}'.format(stage, seconds * 1000.0) for stage, seconds in result['stages'].items()
+        )
+        print('{0:<18} {1:>10} {2:>10} {3:>10} {4:>10}  {5}'.format(
+            name, result['frames_per_second'], result['megabytes_per_second'], result['peak_megabytes'],
+            expected, stages
+        ))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the ingester against synthetic frames and in-process stand-ins for its services'
+    )
+    parser.add_argument('--kinds', nargs='+', choices=KINDS, default=list(KINDS), help='Kinds of frames to use')
+    parser.add_argument('--benchmarks', nargs='+', choices=sorted(BENCHMARKS), default=sorted(BENCHMARKS),
+                        help='Benchmarks to run')
+    parser.add_argument('--count', type=int, default=10, help='Number of frames of each kind')
+    parser.add_argument('--repeat', type=int, default=5, help='Number of runs, of which the fastest is reported')
+    parser.add_argument('--image-size', type=int, default=1024, help='Pixels per side of image frames')
+    parser.add_argument('--catalog-size', type=int, default=10000, help='Sources per catalog frame')
+    parser.add_argument('--spectrum-size', type=int, default=1024 * 1024, help='Bytes per spectrum')
+    parser.add_argument('--baseline', default=BASELINE_PATH, help='Baseline to compare the results with')
+    parser.add_argument('--save-baseline', action='store_true', help='Save the results as the baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Fraction by which a benchmark may be slower or use more memory than the baseline')
+    args = parser.parse_args()
+
+    # Keep the benchmarks to the ingester itself, without local state
+    ingester_settings.MD5_INDEX_PATH = ''
+    ingester_settings.CHECKPOINT_PATH = ''
+
+    sizes = {'image': args.image_size, 'catalog': args.catalog_size, 'spectrum': args.spectrum_size}
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for kind in args.kinds:
+            kind_directory = os.path.join(directory, kind)
+            os.mkdir(kind_directory)
+            paths = generate_frames(kind_directory, kind, args.count, sizes[kind])
+            parameters = {'count': args.count, '{0}_size'.format(kind): sizes[kind]}
+            for name in args.benchmarks:
+                result = run_benchmark(BENCHMARKS[name], paths, args.repeat)
+                results['{0}.{1}'.format(kind, name)] = dict(result, parameters=parameters)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+    report(results, baseline)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump(dict(baseline, **results), baseline_file, indent=2, sort_keys=True)
+            baseline_file.write('\n')
+        print('Saved baseline to {0}'.format(args.baseline))
+        return
+
+    for name, result in sorted(results.items()):
+        if name in baseline and not comparable(result, baseline[name]):
+            print('Not comparing {0}, whose baseline was generated from frames {1}'.format(
+                name, baseline[name].get('parameters', 'of unknown size')
+            ), file=sys.stderr)
+    regressions = compare(results, baseline, args.tolerance)
+    for regression in regressions:
+        print('Regression in {0}'.format(regression), file=sys.stderr)
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
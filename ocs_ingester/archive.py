@@ -1,18 +1,122 @@
+import copy
+import gzip
+import json
+import asyncio
+import weakref
 import logging
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from dateutil.parser import parse
 
 import requests
+from requests.adapters import HTTPAdapter
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
 from opentsdb_python_metrics.metric_wrappers import SendMetricMixin
 
 from ocs_ingester.utils import metrics
+from ocs_ingester.utils.local_state import ProcessLocal
+from ocs_ingester.utils.serialization import get_json_serializer
 from ocs_ingester.exceptions import BackoffRetryError, DoNotRetryError
 from ocs_ingester.settings import settings as ingester_settings
+from ocs_ingester.md5_index import get_md5_index
 
 from ocs_archive.settings import settings as archive_settings
 
 logger = logging.getLogger('ocs_ingester')
 
+# Pooled sessions keyed by API root, shared by every ArchiveService in this process
+_sessions = ProcessLocal()
+
+# API roots that responded that they do not support bulk frame posts
+_bulk_unsupported = set()
+
+# API roots that responded that they do not accept gzip compressed request bodies, and that accepted them
+_gzip_unsupported = set()
+_gzip_supported = set()
+
+JSON_HEADERS = {'Content-Type': 'application/json'}
+GZIP_JSON_HEADERS = {'Content-Type': 'application/json', 'Content-Encoding': 'gzip'}
+
+# Threads that AsyncArchiveService checks many md5s from, shared by every AsyncArchiveService in this process
+_executor = ProcessLocal()
+
+# aiohttp sessions of AsyncArchiveService, keyed by event loop and then by API root
+_async_sessions = ProcessLocal()
+
+
+def get_session(api_root):
+    """Return the connection pooled session used for requests to the given API root.
+
+    Sessions are created on first use and reused by every ArchiveService in the process, so that
+    connections to the science archive are kept alive between frames. A forked child process starts
+    with a fresh set of sessions rather than sharing sockets with its parent.
+    """
+    with _sessions.lock:
+        sessions = _sessions.get(dict)
+        session = sessions.get(api_root)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=ingester_settings.ARCHIVE_POOL_SIZE)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            if not ingester_settings.ARCHIVE_KEEP_ALIVE:
+                session.headers['Connection'] = 'close'
+            sessions[api_root] = session
+        return session
+
+
+def get_executor():
+    """Return the thread pool that AsyncArchiveService checks many md5s at once from.
+
+    The pool has as many threads as there are pooled connections per API root, so that requests
+    never wait on each other for a connection.
+    """
+    return _executor.get(lambda: ThreadPoolExecutor(
+        max_workers=ingester_settings.ARCHIVE_POOL_SIZE, thread_name_prefix='ocs_ingester_archive'
+    ))
+
+
+def get_async_session(api_root):
+    """Return the aiohttp session used for requests to the given API root from the running event loop.
+
+    Like the sessions of get_session, it is created on first use and reused by every AsyncArchiveService
+    on the event loop, with up to ARCHIVE_POOL_SIZE connections. Sessions belong to their event loop, and
+    are closed with close_async_sessions before the loop is closed.
+    """
+    loop = asyncio.get_running_loop()
+    with _async_sessions.lock:
+        sessions = _async_sessions.get(weakref.WeakKeyDictionary).setdefault(loop, {})
+        session = sessions.get(api_root)
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=ingester_settings.ARCHIVE_POOL_SIZE, force_close=not ingester_settings.ARCHIVE_KEEP_ALIVE
+            )
+            session = aiohttp.ClientSession(connector=connector)
+            sessions[api_root] = session
+        return session
+
+
+async def close_async_sessions():
+    """Close the aiohttp sessions of the running event loop, dropping any kept-alive connections."""
+    with _async_sessions.lock:
+        sessions = _async_sessions.get(weakref.WeakKeyDictionary).pop(asyncio.get_running_loop(), {})
+    for session in sessions.values():
+        await session.close()
+
+
+def close_sessions():
+    """Close all pooled sessions, dropping any kept-alive connections."""
+    with _sessions.lock:
+        sessions = _sessions.get(dict)
+        for session in sessions.values():
+            session.close()
+        sessions.clear()
+
 
 def obs_end_time_from_dict(archive_record):
     obs_date = parse(archive_record.get('observation_date'))
@@ -32,9 +136,101 @@ def obs_end_time_from_dict(archive_record):
 
 
 class ArchiveService(SendMetricMixin):
-    def __init__(self, api_root, auth_token):
+    def __init__(self, api_root, auth_token, md5_index=None, retrier=None, deadline=None):
         self.api_root = api_root
         self.headers = {'Authorization': 'Token {}'.format(auth_token)}
+        self.session = get_session(api_root)
+        # Local index of md5s known to exist in the archive, consulted before asking the archive
+        self.md5_index = md5_index if md5_index is not None else get_md5_index()
+        # Optional ocs_ingester.retry.Retrier used to retry requests that fail with a retryable error
+        self.retrier = retrier
+        # Optional ocs_ingester.deadline.Deadline that the timeouts of requests are cut down to
+        self.deadline = deadline
+
+    def with_deadline(self, deadline):
+        """Returns a copy of this service, with the same session and md5 index, that has the given deadline."""
+        archive = copy.copy(self)
+        archive.deadline = deadline
+        return archive
+
+    @property
+    def timeout(self):
+        timeout = (ingester_settings.ARCHIVE_CONNECT_TIMEOUT, ingester_settings.ARCHIVE_READ_TIMEOUT)
+        if self.deadline is None:
+            return timeout
+        return tuple(self.deadline.timeout(seconds, 'an archive request') for seconds in timeout)
+
+    def get(self, url, **kwargs):
+        return self._send(self.session.get, url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self._send(self.session.post, url, **kwargs)
+
+    def post_json(self, url, data):
+        """Posts data serialized by the ARCHIVE_JSON_SERIALIZER, gzip compressed if it is large enough.
+
+        Compressed bodies are sent uncompressed instead, from then on, if the archive does not accept them. An
+        archive that cannot decode them either responds that it does not support the encoding, or that the body
+        is a bad request. Until the archive has accepted a compressed body, a compressed body that is a bad
+        request is sent again uncompressed to tell the two apart.
+
+        Raises:
+            ocs_ingester.exceptions.DoNotRetryError: If the data cannot be serialized to JSON
+        """
+        body = self._serialize(data)
+        compressed_body = self._compress(body)
+        if compressed_body is None:
+            return self.post(url, data=body, headers=JSON_HEADERS)
+        response = self.post(url, data=compressed_body, headers=GZIP_JSON_HEADERS)
+        if not self._resend_uncompressed(response.status_code):
+            return response
+        uncompressed_response = self.post(url, data=body, headers=JSON_HEADERS)
+        self._gzip_probed(response.status_code, uncompressed_response.status_code)
+        return uncompressed_response
+
+    @staticmethod
+    def _serialize(data):
+        try:
+            return get_json_serializer(ingester_settings.ARCHIVE_JSON_SERIALIZER)(data)
+        except (TypeError, ValueError) as exc:
+            # The same data would fail to serialize again
+            raise DoNotRetryError(exc)
+
+    def _compress(self, body):
+        # Returns the gzip compressed body, or None if it should be sent uncompressed
+        min_size = ingester_settings.ARCHIVE_GZIP_MIN_SIZE
+        if 0 < min_size <= len(body) and self.api_root not in _gzip_unsupported:
+            return gzip.compress(body, compresslevel=6)
+        return None
+
+    def _resend_uncompressed(self, status_code):
+        # Whether the response to a compressed body may mean that the archive could not decode it
+        if status_code not in (400, 415):
+            _gzip_supported.add(self.api_root)
+            return False
+        return status_code == 415 or self.api_root not in _gzip_supported
+
+    def _gzip_probed(self, compressed_status_code, uncompressed_status_code):
+        # A bad request either way is a bad record, and says nothing about whether gzip is supported
+        if compressed_status_code == 415 or uncompressed_status_code != 400:
+            logger.info('Archive does not accept gzip compressed requests, sending them uncompressed')
+            _gzip_unsupported.add(self.api_root)
+
+    def _send(self, send, url, headers=None, **kwargs):
+        headers = dict(self.headers, **headers) if headers else self.headers
+        try:
+            return send(url, headers=headers, timeout=self.timeout, **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as exc:
+            # The archive could not be reached or did not respond in time, try again later
+            raise BackoffRetryError(exc)
+
+    def _retry(self, function, *args):
+        if self.retrier is None:
+            return function(*args)
+        return self.retrier.call(function, *args)
+
+    def _get_json(self, url, params=None):
+        return self.handle_response(self.get(url, params=params))
 
     def handle_response(self, response):
         try:
@@ -57,21 +253,153 @@ class ArchiveService(SendMetricMixin):
         return response.json()
 
     def version_exists(self, md5):
-        response = requests.get(
-            '{0}versions/?md5={1}'.format(self.api_root, md5), headers=self.headers
-        )
+        if self.md5_index is not None and self.md5_index.contains(self.api_root, md5):
+            return True
+        exists = self._retry(self._version_exists, md5)
+        if exists and self.md5_index is not None:
+            self.md5_index.add(self.api_root, [md5])
+        return exists
+
+    def _version_exists(self, md5):
+        response = self.get('{0}versions/?md5={1}'.format(self.api_root, md5))
         result = self.handle_response(response)
         try:
             return result['count'] > 0
         except KeyError as e:
             raise BackoffRetryError(e)
 
+    def versions_exist(self, md5s):
+        """Check which of the given md5s already exist in the science archive.
+
+        The md5s are checked in chunks of ARCHIVE_VERSIONS_CHUNK_SIZE per request. If the archive does not
+        support filtering versions by many md5s at once, each md5 in the chunk is checked individually.
+
+        Returns a dictionary mapping each md5 to a boolean indicating whether it exists.
+        """
+        md5s = list(dict.fromkeys(md5s))
+        exists = {}
+        if self.md5_index is not None:
+            exists = {md5: True for md5 in self.md5_index.contains_many(self.api_root, md5s)}
+            md5s = [md5 for md5 in md5s if md5 not in exists]
+        chunk_size = ingester_settings.ARCHIVE_VERSIONS_CHUNK_SIZE
+        for i in range(0, len(md5s), chunk_size):
+            chunk_exists = self._retry(self._versions_exist_chunk, md5s[i:i + chunk_size])
+            if self.md5_index is not None:
+                self.md5_index.add(self.api_root, [md5 for md5, md5_exists in chunk_exists.items() if md5_exists])
+            exists.update(chunk_exists)
+        return exists
+
+    def iter_versions(self, **filters):
+        """Iterates over every version listed by the archive's versions/ endpoint, following pagination.
+
+        Args:
+            filters: Extra query parameters used to filter the versions that are listed
+        """
+        url = '{0}versions/'.format(self.api_root)
+        params = dict({'limit': 1000}, **filters)
+        while url:
+            result = self._retry(self._get_json, url, params)
+            try:
+                versions, url = result['results'], result.get('next')
+            except (KeyError, TypeError) as e:
+                raise BackoffRetryError(e)
+            # The next url already holds the query parameters
+            params = None
+            for version in versions:
+                yield version
+
+    def _versions_exist_chunk(self, md5s):
+        response = self.get(
+            '{0}versions/'.format(self.api_root), params={'md5__in': ','.join(md5s), 'limit': len(md5s)}
+        )
+        result = self.handle_response(response)
+        try:
+            count = result['count']
+            found = {version['md5'] for version in result.get('results', [])}
+        except (KeyError, TypeError) as e:
+            raise BackoffRetryError(e)
+
+        if not found.issubset(md5s):
+            # The archive ignored the md5__in filter and returned unrelated versions
+            return {md5: self._version_exists(md5) for md5 in md5s}
+        exists = {md5: md5 in found for md5 in md5s}
+        if count > len(result.get('results', [])):
+            # Some md5s have multiple versions, so not every match fit in the page. Check the rest individually.
+            for md5 in md5s:
+                if not exists[md5]:
+                    exists[md5] = self._version_exists(md5)
+        return exists
+
     @metrics.method_timer('ingester.post_frame')
     def post_frame(self, archive_record):
-        response = requests.post(
-            '{0}frames/'.format(self.api_root), json=archive_record, headers=self.headers
+        result = self._retry(self._post_frame, archive_record)
+        return self._frame_posted(archive_record, result)
+
+    def _post_frame(self, archive_record):
+        response = self.post_json('{0}frames/'.format(self.api_root), archive_record)
+        return self.handle_response(response)
+
+    @metrics.method_timer('ingester.post_frames')
+    def post_frames(self, archive_records):
+        """Posts many records to the archive, in a single request if the archive supports it.
+
+        The records are sent to the ARCHIVE_BULK_FRAMES_PATH endpoint, which is expected to respond with a list
+        holding, in the same order as the records, either the created frame or an object with an ``error`` and a
+        ``status_code`` for each record. If bulk posting is not configured, or the archive responds that the
+        endpoint does not exist or is not implemented, each record is posted individually instead.
+
+        Returns:
+            list: For each record, either the ingested record as returned by post_frame, or the exception
+            that post_frame would have raised for it
+
+        Raises:
+            ocs_ingester.exceptions.DoNotRetryError: If the archive rejected the bulk request as a whole
+            ocs_ingester.exceptions.BackoffRetryError: If the bulk request as a whole could not be completed
+        """
+        archive_records = list(archive_records)
+        if not archive_records:
+            return []
+        if not ingester_settings.ARCHIVE_BULK_FRAMES_PATH or self.api_root in _bulk_unsupported:
+            return self._post_frames_individually(archive_records)
+
+        response = self.post_json(
+            '{0}{1}'.format(self.api_root, ingester_settings.ARCHIVE_BULK_FRAMES_PATH), archive_records
         )
-        result = self.handle_response(response)
+        if response.status_code in (404, 405, 501):
+            logger.info('Archive does not support bulk frame posts, posting frames individually')
+            _bulk_unsupported.add(self.api_root)
+            return self._post_frames_individually(archive_records)
+        results = self.handle_response(response)
+        if not isinstance(results, list) or len(results) != len(archive_records):
+            raise BackoffRetryError('Unexpected response to bulk frame post')
+
+        posted = []
+        for archive_record, result in zip(archive_records, results):
+            if 'error' in result:
+                posted.append(self._error_for_status(result.get('status_code', 500), result['error']))
+            else:
+                posted.append(self._frame_posted(archive_record, result))
+        return posted
+
+    def _post_frames_individually(self, archive_records):
+        posted = []
+        for archive_record in archive_records:
+            try:
+                posted.append(self.post_frame(archive_record))
+            except (DoNotRetryError, BackoffRetryError) as e:
+                posted.append(e)
+        return posted
+
+    @staticmethod
+    def _error_for_status(status_code, error):
+        # Same semantics as handle_response, for an error reported for a single record
+        if 400 <= status_code < 500:
+            return DoNotRetryError(error)
+        return BackoffRetryError(error)
+
+    def _frame_posted(self, archive_record, result):
+        if self.md5_index is not None:
+            self.md5_index.add(self.api_root, [version['md5'] for version in archive_record.get('version_set', [])])
         logger.info('Ingester posted frame to archive', extra={
             'tags': {
                 'filename': result.get('filename'),
@@ -86,10 +414,136 @@ class ArchiveService(SendMetricMixin):
         archive_record['url'] = result.get('url')
         # Record metric for the ingest lag (time between date of image vs date ingested)
         ingest_lag = datetime.utcnow() - obs_end_time_from_dict(archive_record)
-        self.send_metric(
-            metric_name='ingester.ingest_lag',
-            value=ingest_lag.total_seconds(),
-            asynchronous=ingester_settings.SUBMIT_METRICS_ASYNCHRONOUSLY,
-            **ingester_settings.EXTRA_METRICS_TAGS
+        metrics.send_metric(
+            'ingester.ingest_lag', ingest_lag.total_seconds(),
+            class_path='{0}.{1}.post_frame'.format(self.__class__.__module__, self.__class__.__name__)
         )
         return archive_record
+
+
+class AsyncArchiveService(object):
+    """Asyncio interface to the science archive API, sending its requests with aiohttp.
+
+    Requests are awaited without holding a thread, over a pool of up to ARCHIVE_POOL_SIZE connections per
+    API root that is shared by every AsyncArchiveService on the event loop. Everything other than sending
+    the requests, such as handling their responses, the md5 index and gzip compression, is shared with the
+    ArchiveService that it wraps. Whole ingests are run from an event loop by :mod:`ocs_ingester.async_ingester`.
+
+    Raises:
+        ImportError: If aiohttp, from the ``async`` extra, is not installed
+    """
+    def __init__(self, api_root, auth_token, md5_index=None, executor=None, deadline=None):
+        if aiohttp is None:
+            raise ImportError('AsyncArchiveService requires aiohttp, install ocs_ingester[async]')
+        self.archive = ArchiveService(api_root=api_root, auth_token=auth_token, md5_index=md5_index,
+                                      deadline=deadline)
+        # Executor that versions_exist runs in, since it checks many md5s with requests of its own
+        self.executor = executor if executor is not None else get_executor()
+
+    @property
+    def api_root(self):
+        return self.archive.api_root
+
+    async def _send(self, method, url, data=None, headers=None, params=None):
+        # Returns the status code and body of the response
+        archive = self.archive
+        connect_timeout, read_timeout = archive.timeout
+        timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)
+        headers = dict(archive.headers, **headers) if headers else archive.headers
+        try:
+            async with get_async_session(archive.api_root).request(
+                method, url, data=data, headers=headers, params=params, timeout=timeout
+            ) as response:
+                return response.status, await response.read()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
+            # The archive could not be reached or did not respond in time, try again later
+            raise BackoffRetryError(exc)
+
+    @staticmethod
+    def _handle_response(status_code, body):
+        # Same semantics as ArchiveService.handle_response
+        if status_code >= 400:
+            raise ArchiveService._error_for_status(status_code, '{0} Error from the science archive: {1}'.format(
+                status_code, body.decode('utf-8', errors='replace')
+            ))
+        return json.loads(body)
+
+    async def _post_json(self, url, data):
+        # Same as ArchiveService.post_json, returning the status code and body of the response
+        archive = self.archive
+        body = archive._serialize(data)
+        compressed_body = archive._compress(body)
+        if compressed_body is None:
+            return await self._send('POST', url, data=body, headers=JSON_HEADERS)
+        status_code, response_body = await self._send('POST', url, data=compressed_body, headers=GZIP_JSON_HEADERS)
+        if not archive._resend_uncompressed(status_code):
+            return status_code, response_body
+        uncompressed_status_code, response_body = await self._send('POST', url, data=body, headers=JSON_HEADERS)
+        archive._gzip_probed(status_code, uncompressed_status_code)
+        return uncompressed_status_code, response_body
+
+    async def version_exists(self, md5):
+        archive = self.archive
+        if archive.md5_index is not None and archive.md5_index.contains(archive.api_root, md5):
+            return True
+        result = self._handle_response(*await self._send('GET', '{0}versions/?md5={1}'.format(archive.api_root, md5)))
+        try:
+            exists = result['count'] > 0
+        except KeyError as e:
+            raise BackoffRetryError(e)
+        if exists and archive.md5_index is not None:
+            archive.md5_index.add(archive.api_root, [md5])
+        return exists
+
+    async def versions_exist(self, md5s):
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, functools.partial(self.archive.versions_exist, list(md5s))
+        )
+
+    async def post_frame(self, archive_record):
+        result = self._handle_response(*await self._post_json('{0}frames/'.format(self.api_root), archive_record))
+        return self.archive._frame_posted(archive_record, result)
+
+
+class FramePostBatcher(object):
+    """Accumulates archive records from many ingests and posts them to the archive in bulk.
+
+    Records are posted with ArchiveService.post_frames whenever batch_size records have been added, and any
+    remaining records are posted by flush. The batcher may be shared between threads.
+
+    Examples:
+        >>> batcher = FramePostBatcher(archive, batch_size=50)
+        >>> results = []
+        >>> for ingester in ingesters:
+        >>>     ingester.check_not_exists()
+        >>>     results += batcher.add(ingester.build_record(ingester.upload()))
+        >>> results += batcher.flush()
+    """
+    def __init__(self, archive, batch_size=50):
+        self.archive = archive
+        self.batch_size = batch_size
+        self._records = []
+        self._lock = threading.Lock()
+
+    def add(self, archive_record):
+        """Adds a record, returning the (record, result) pairs of any batch that was posted as a result."""
+        with self._lock:
+            self._records.append(archive_record)
+            if len(self._records) < self.batch_size:
+                return []
+            records, self._records = self._records, []
+        return self._post(records)
+
+    def flush(self):
+        """Posts any remaining records, returning their (record, result) pairs."""
+        with self._lock:
+            records, self._records = self._records, []
+        return self._post(records)
+
+    def _post(self, records):
+        try:
+            results = self.archive.post_frames(records)
+        except (DoNotRetryError, BackoffRetryError) as e:
+            # The bulk request as a whole failed, which is the result of each of its records
+            results = [e] * len(records)
+        return list(zip(records, results))
@@ -0,0 +1,116 @@
+"""``async_ingester.py`` - Asyncio functions for adding data to the science archive.
+
+These run the same steps as :func:`ocs_ingester.ingester.upload_file_and_ingest_to_archive` and
+:class:`ocs_ingester.ingester.Ingester`, with the same retries, checkpoints, modes and deadline, from an event
+loop. Requests to the science archive are awaited with an :class:`ocs_ingester.archive.AsyncArchiveService`,
+and only hashing, parsing and uploading the file are run in an executor. A frame only occupies a thread of the
+executor while one of those steps runs, so many more frames can be checked and posted at once than there are
+threads. This requires aiohttp, which is installed with the ``async`` extra.
+
+Examples:
+    Ingest many files concurrently, hashing, parsing and uploading up to 16 of them at a time:
+
+    >>> import asyncio
+    >>> from concurrent.futures import ThreadPoolExecutor
+    >>> from ocs_ingester import async_ingester
+    >>> from ocs_ingester.archive import close_async_sessions
+    >>> async def ingest(paths):
+    >>>     executor = ThreadPoolExecutor(max_workers=16)
+    >>>     fileobjs = [open(path, 'rb') for path in paths]
+    >>>     try:
+    >>>         return await asyncio.gather(*[
+    >>>             async_ingester.upload_file_and_ingest_to_archive(fileobj, executor=executor) for fileobj in fileobjs
+    >>>         ], return_exceptions=True)
+    >>>     finally:
+    >>>         await close_async_sessions()
+
+"""
+import asyncio
+import inspect
+
+from ocs_ingester.ingester import (Ingester, ArchiveCall, Concurrently, _get_frame, _ingest_options,
+                                   _get_ingest_file_store)
+from ocs_ingester.archive import AsyncArchiveService
+from ocs_ingester.settings import settings as ingester_settings
+
+from ocs_archive.settings import settings as archive_settings
+
+
+async def upload_file_and_ingest_to_archive(fileobj, path=None, file_metadata=None,
+                                            required_headers=archive_settings.REQUIRED_HEADERS,
+                                            blacklist_headers=archive_settings.HEADER_BLACKLIST,
+                                            api_root=ingester_settings.API_ROOT,
+                                            auth_token=ingester_settings.AUTH_TOKEN, executor=None,
+                                            streaming=False, bucket=None, concurrent=None, speculative=None,
+                                            deadline=None):
+    """Uploads a file to S3 and adds the associated record to the science archive database.
+
+    This is the asyncio version of :func:`ocs_ingester.ingester.upload_file_and_ingest_to_archive`, and
+    takes the same arguments, returns the same record and raises the same exceptions.
+
+    Args:
+        executor (concurrent.futures.Executor): Executor that the file is hashed, parsed and uploaded in.
+            Defaults to the default executor of the event loop.
+    """
+    options = _ingest_options(streaming, concurrent, speculative, deadline)
+    frame = _get_frame(fileobj, path, file_metadata, required_headers=required_headers,
+                       blacklist_headers=blacklist_headers)
+    loop = asyncio.get_running_loop()
+    if streaming or not options['concurrent']:
+        # Parse the file up front, like the synchronous ingest does
+        await loop.run_in_executor(executor, lambda: frame.datafile)
+    filestore = _get_ingest_file_store(bucket)
+    archive = AsyncArchiveService(api_root=api_root, auth_token=auth_token, deadline=options['deadline'])
+    return await AsyncIngester(frame, filestore, archive, executor=executor, **options).ingest()
+
+
+class AsyncIngester(Ingester):
+    """Ingest a single frame into the archive from an event loop.
+
+    Runs the steps of :class:`ocs_ingester.ingester.Ingester`, and takes the same arguments, except that
+    the archive must be an :class:`ocs_ingester.archive.AsyncArchiveService`. Its requests are awaited, steps
+    that run concurrently are gathered, and every other step is run in the executor. The methods that run
+    steps, such as ingest and check_not_exists, are coroutines.
+
+    Args:
+        executor (concurrent.futures.Executor): Executor that the file is hashed, parsed and uploaded in.
+            Defaults to the default executor of the event loop.
+    """
+    def __init__(self, datafile, filestore, archive, executor=None, **kwargs):
+        super().__init__(datafile, filestore, archive, **kwargs)
+        self.executor = executor
+
+    async def ingest(self):
+        if self.retrier is not None:
+            return await self.retrier.call_async(self._ingest)
+        return await self._ingest()
+
+    async def _ingest(self):
+        return await self.run_steps(self.ingest_steps())
+
+    async def run_steps(self, steps):
+        result, error = None, None
+        while True:
+            try:
+                step = steps.send(result) if error is None else steps.throw(error)
+            except StopIteration as stop:
+                return stop.value
+            try:
+                result, error = await self.run_step(step), None
+            except Exception as e:
+                result, error = None, e
+
+    async def run_step(self, step):
+        if isinstance(step, ArchiveCall):
+            return await getattr(self.archive, step.method)(*step.args)
+        if isinstance(step, Concurrently):
+            return list(await asyncio.gather(*[self._run_step_outcome(other) for other in step.steps]))
+        if inspect.isgenerator(step):
+            return await self.run_steps(step)
+        return await asyncio.get_running_loop().run_in_executor(self.executor, step)
+
+    async def _run_step_outcome(self, step):
+        try:
+            return await self.run_step(step), None
+        except Exception as e:
+            return None, e
@@ -0,0 +1,90 @@
+"""``batch.py`` - Ingest many files into the science archive using a pool of worker processes.
+
+Each file is ingested with :func:`ocs_ingester.ingester.upload_file_and_ingest_to_archive` in a worker process,
+and the result is reported as an outcome classified by the exception that was raised, if any.
+
+Examples:
+    Ingest every file in a directory using 4 worker processes:
+
+    >>> from ocs_ingester import batch
+    >>> from ocs_ingester.utils.paths import expand_paths
+    >>> for outcome in batch.ingest_paths(expand_paths(['/data/20191013/']), processes=4):
+    >>>     print(outcome.status, outcome.path)
+
+"""
+import functools
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+from ocs_ingester.ingester import upload_file_and_ingest_to_archive
+from ocs_ingester.exceptions import BackoffRetryError, RetryError, NonFatalDoNotRetryError
+from ocs_ingester.retry import RetryBudgetManager, retry_budget_settings, use_retry_budget
+from ocs_ingester.settings import settings as ingester_settings
+
+INGESTED = 'ingested'
+ALREADY_EXISTS = 'already exists'
+RETRYABLE = 'retryable'
+FATAL = 'fatal'
+
+IngestOutcome = namedtuple('IngestOutcome', ['path', 'status', 'message'])
+
+
+def outcome_status_for_exception(exception):
+    """Classifies an exception raised while ingesting a file as one of the outcome statuses."""
+    if isinstance(exception, NonFatalDoNotRetryError):
+        return ALREADY_EXISTS
+    if isinstance(exception, (BackoffRetryError, RetryError)):
+        return RETRYABLE
+    return FATAL
+
+
+def ingest_path(path, **kwargs):
+    """Ingests the file at the given path, returning an IngestOutcome rather than raising.
+
+    Args:
+        path (str): Path to the file to ingest
+        kwargs: Extra arguments for :func:`ocs_ingester.ingester.upload_file_and_ingest_to_archive`
+
+    Returns:
+        IngestOutcome: The path, outcome status and either the url of the ingested file or the error message
+    """
+    try:
+        with open(path, 'rb') as fileobj:
+            result = upload_file_and_ingest_to_archive(fileobj, path=path, **kwargs)
+    except Exception as e:
+        return IngestOutcome(path, outcome_status_for_exception(e), str(e))
+    return IngestOutcome(path, INGESTED, result.get('url'))
+
+
+def _initialize_worker(submit_metrics_asynchronously, extra_metrics_tags, retry_budget):
+    # Worker processes that are not forked do not see settings that were changed at runtime
+    ingester_settings.SUBMIT_METRICS_ASYNCHRONOUSLY = submit_metrics_asynchronously
+    ingester_settings.EXTRA_METRICS_TAGS.update(extra_metrics_tags)
+    use_retry_budget(retry_budget)
+
+
+def ingest_paths(paths, processes=1, **kwargs):
+    """Ingests many files, spreading them over a pool of worker processes.
+
+    Args:
+        paths (list): Paths of the files to ingest
+        processes (int): Number of worker processes. With a single process files are ingested in this process.
+            Worker processes share a single retry budget, held by a RetryBudgetManager for the duration.
+        kwargs: Extra arguments for :func:`ocs_ingester.ingester.upload_file_and_ingest_to_archive`
+
+    Yields:
+        IngestOutcome: The outcome of each file, in the order that the paths were given
+    """
+    ingest = functools.partial(ingest_path, **kwargs)
+    if processes <= 1:
+        for path in paths:
+            yield ingest(path)
+        return
+
+    with RetryBudgetManager() as manager, ProcessPoolExecutor(
+        max_workers=processes, initializer=_initialize_worker,
+        initargs=(ingester_settings.SUBMIT_METRICS_ASYNCHRONOUSLY, ingester_settings.EXTRA_METRICS_TAGS,
+                  manager.RetryBudget(**retry_budget_settings()))
+    ) as executor:
+        for outcome in executor.map(ingest, paths):
+            yield outcome
@@ -0,0 +1,77 @@
+"""``checkpoint.py`` - Local journal of ingests that were uploaded but not yet added to the science archive.
+
+When CHECKPOINT_PATH is set, :class:`ocs_ingester.ingester.Ingester` records the version returned by the file
+store and the archive record built for a file as soon as the file is uploaded, keyed by the science archive,
+the bucket the file was uploaded to and the md5 of the file. If posting the record to the science archive then
+fails, a later ingest of the same file into the same bucket resumes from the checkpoint and only posts the
+record, instead of uploading the whole file again, as long as it would post the same record. Checkpoints are
+removed once the record is posted, and are no longer trusted after CHECKPOINT_TTL seconds.
+"""
+import json
+import time
+
+from ocs_ingester.utils.local_state import ProcessLocal, LocalDatabase
+from ocs_ingester.settings import settings as ingester_settings
+
+# The process-wide journal, opened on first use
+_checkpoint_journal = ProcessLocal()
+
+
+def get_checkpoint_journal():
+    """Return the process-wide checkpoint journal configured by CHECKPOINT_PATH, or None if it is not configured."""
+    if not ingester_settings.CHECKPOINT_PATH:
+        return None
+    return _checkpoint_journal.get(
+        lambda: CheckpointJournal(ingester_settings.CHECKPOINT_PATH, ttl=ingester_settings.CHECKPOINT_TTL),
+        stale=lambda journal: journal.path != ingester_settings.CHECKPOINT_PATH
+    )
+
+
+class CheckpointJournal(LocalDatabase):
+    """SQLite backed journal of uploaded files, keyed by API root, bucket and md5.
+
+    The bucket is the S3 bucket, or the root directory of a file system store, that the file was uploaded to.
+
+    Args:
+        path (str): Path to the SQLite database, which is created if it does not exist
+        ttl (float): Number of seconds after which a checkpoint is no longer trusted
+    """
+    def __init__(self, path, ttl=ingester_settings.CHECKPOINT_TTL):
+        super().__init__(
+            path,
+            'CREATE TABLE IF NOT EXISTS checkpoints ('
+            'api_root TEXT NOT NULL, bucket TEXT NOT NULL, md5 TEXT NOT NULL, version TEXT NOT NULL, '
+            'record TEXT NOT NULL, saved REAL NOT NULL, PRIMARY KEY (api_root, bucket, md5))'
+        )
+        self.ttl = ttl
+
+    def save(self, api_root, bucket, md5, version, record):
+        """Records that the file with the md5 was uploaded to the bucket as version, and will be posted as record."""
+        with self._lock:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO checkpoints (api_root, bucket, md5, version, record, saved) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                [api_root, bucket, md5, json.dumps(version), json.dumps(record), time.time()]
+            )
+
+    def load(self, api_root, bucket, md5):
+        """Returns the (version, record) checkpointed for the md5 in the bucket, or None if there is no recent one."""
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT version, record FROM checkpoints WHERE api_root = ? AND bucket = ? AND md5 = ? AND saved >= ?',
+                [api_root, bucket, md5, time.time() - self.ttl]
+            ).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), json.loads(row[1])
+
+    def remove(self, api_root, bucket, md5):
+        with self._lock:
+            self._connection.execute(
+                'DELETE FROM checkpoints WHERE api_root = ? AND bucket = ? AND md5 = ?', [api_root, bucket, md5]
+            )
+
+    def evict_expired(self):
+        """Removes checkpoints older than the ttl, returning how many were removed."""
+        with self._lock:
+            return self._connection.execute('DELETE FROM checkpoints WHERE saved < ?', [time.time() - self.ttl]).rowcount
@@ -0,0 +1,76 @@
+"""``deadline.py`` - A time limit for a whole ingest, shared by every step and network call that it makes.
+
+Timeouts on single requests do not stop an ingest from taking much longer than intended, when it makes many
+requests, retries them, or uploads a large file in parts. A deadline is set once for an ingest, and each
+step gets what is left of it: archive requests have their timeouts cut down to the time remaining, retries
+are not started when their delay would outlast it, and every step fails with a
+:class:`ocs_ingester.exceptions.BackoffRetryError` once it has passed.
+
+The file stores of ocs_archive are called without a deadline, so an ingest makes its deadline current while it
+uploads a file. S3 uploads then cut their timeouts down to it, and check it before each part of a multipart upload,
+and copies into a file system store check it before each chunk.
+
+Examples:
+    Give each ingest at most two minutes:
+
+    >>> from ocs_ingester.ingester import upload_file_and_ingest_to_archive
+    >>> upload_file_and_ingest_to_archive(fileobj, deadline=120)
+
+"""
+import time
+import contextlib
+import contextvars
+
+from ocs_ingester.exceptions import BackoffRetryError
+
+# The deadline of the ingest that is uploading a file in this context
+_current_deadline = contextvars.ContextVar('ocs_ingester_deadline', default=None)
+
+
+class Deadline(object):
+    """A point in time by which an ingest must be done.
+
+    Args:
+        seconds (float): Seconds from now until the deadline
+    """
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds
+
+    @classmethod
+    def after(cls, seconds):
+        """Returns a deadline the given seconds from now, or None if seconds is None or 0."""
+        return cls(seconds) if seconds else None
+
+    def remaining(self):
+        """Returns the seconds left until the deadline, which are negative once it has passed."""
+        return self.expires_at - time.monotonic()
+
+    def check(self, step):
+        """Raises a BackoffRetryError if the deadline has passed before the given step of the ingest."""
+        if self.remaining() <= 0:
+            raise BackoffRetryError('Ingest deadline of {0}s passed before {1}'.format(self.seconds, step))
+
+    def timeout(self, seconds, step):
+        """Returns a timeout of the given seconds, cut down to the time left until the deadline.
+
+        Raises:
+            ocs_ingester.exceptions.BackoffRetryError: If the deadline has already passed
+        """
+        self.check(step)
+        return min(seconds, self.remaining())
+
+
+@contextlib.contextmanager
+def current_deadline(deadline):
+    """Makes the deadline current in this context for the duration of the block."""
+    token = _current_deadline.set(deadline)
+    try:
+        yield deadline
+    finally:
+        _current_deadline.reset(token)
+
+
+def get_current_deadline():
+    """Returns the deadline made current in this context, or None."""
+    return _current_deadline.get()
@@ -0,0 +1,137 @@
+"""``frame.py`` - A handle on a file being ingested that carries what has been parsed from it between steps.
+
+Examples:
+    Parse a file once and reuse the result for each step of an ingest:
+
+    >>> from ocs_ingester import ingester
+    >>> with open('tst1mXXX-ab12-20191013-0001-e00.fits.fz', 'rb') as fileobj:
+    >>>     frame = ingester.Frame(fileobj)
+    >>>     if not ingester.frame_exists(frame):
+    >>>         record = ingester.validate_fits_and_create_archive_record(frame)
+
+"""
+import io
+import os
+import hashlib
+
+from ocs_ingester.exceptions import DoNotRetryError
+from ocs_ingester.utils.hashing import file_md5
+from ocs_ingester.utils.metrics import get_md5_and_collect_metrics, IngestStats
+
+from ocs_archive.settings import settings as archive_settings
+from ocs_archive.input.file import File, FileSpecificationException
+from ocs_archive.input.filefactory import FileFactory
+
+
+class Frame(object):
+    """A file to ingest, along with everything that has been computed from it so far.
+
+    The datafile, md5 and archive record of the file are computed the first time that they are
+    needed and reused after that, so that the headers, WCS corners and md5 are only computed once
+    however many steps of an ingest the frame is passed through. The time spent on each of them,
+    and on the steps of an ingest, is kept in the stats of the frame.
+
+    Args:
+        fileobj (file-like object): File-like object
+        path (str): File path/name for this object. This option may be used to override the filename
+            associated with the fileobj. It must be used if the fileobj does not have a filename.
+        file_metadata (dict): Dictionary of file metadata to use when generating the archive record for a non-FITS file.
+            This must be used when uploading a non-FITS file.
+        required_headers (tuple): FITS headers that must be present
+        blacklist_headers (tuple): FITS headers that should not be ingested
+    """
+    def __init__(self, fileobj, path=None, file_metadata=None, required_headers=archive_settings.REQUIRED_HEADERS,
+                 blacklist_headers=archive_settings.HEADER_BLACKLIST):
+        self.open_file = File(fileobj, path)
+        self.file_metadata = file_metadata if file_metadata is not None else {}
+        self.required_headers = required_headers
+        self.blacklist_headers = blacklist_headers
+        self._datafile = None
+        self._md5 = None
+        self._archive_record = None
+        self.stats = IngestStats()
+
+    @classmethod
+    def from_datafile(cls, datafile):
+        """Creates a frame for a datafile that has already been parsed."""
+        frame = cls(datafile.open_file.fileobj, datafile.open_file.path,
+                    required_headers=datafile.required_headers, blacklist_headers=datafile.blacklist_headers)
+        frame.open_file = datafile.open_file
+        frame._datafile = datafile
+        return frame
+
+    @property
+    def datafile(self):
+        """The datafile for this frame, parsed on first access.
+
+        Raises:
+            ocs_ingester.exceptions.DoNotRetryError: If the file could not be parsed or required headers could not be found
+        """
+        if self._datafile is None:
+            try:
+                with self.stats.timed('parse'):
+                    self._datafile = FileFactory.get_datafile_class_for_extension(self.open_file.extension)(
+                        self.open_file, self.file_metadata,
+                        blacklist_headers=self.blacklist_headers, required_headers=self.required_headers
+                    )
+            except FileSpecificationException as fe:
+                raise DoNotRetryError(str(fe))
+        return self._datafile
+
+    @property
+    def md5(self):
+        """The md5 of the file, computed on first access."""
+        if self._md5 is None:
+            with self.stats.timed('md5'):
+                self._md5 = get_md5_and_collect_metrics(self.open_file)
+        return self._md5
+
+    @md5.setter
+    def md5(self, md5):
+        self._md5 = md5
+
+    def compute_md5_independently(self):
+        """Computes the md5 of the file without moving the position of its file-like object.
+
+        The file is read through a file handle of its own, or from the buffer of an in-memory file, so that
+        it can be hashed in one thread while it is parsed in another.
+
+        Returns:
+            bool: Whether the md5 was computed. It is not if the file cannot be read independently.
+        """
+        if self._md5 is not None:
+            return True
+        fileobj = self.open_file.fileobj
+        if isinstance(fileobj, io.BytesIO):
+            with self.stats.timed('md5'), fileobj.getbuffer() as buffer:
+                self._md5 = hashlib.md5(buffer).hexdigest()
+            return True
+        name = getattr(fileobj, 'name', None)
+        try:
+            # Only reopen the file by its name if that is still the same file
+            if not isinstance(name, str) or not os.path.samestat(os.fstat(fileobj.fileno()), os.stat(name)):
+                return False
+            with self.stats.timed('md5'), open(name, 'rb') as independent_fileobj:
+                self._md5 = file_md5(independent_fileobj)
+        except (OSError, AttributeError, io.UnsupportedOperation):
+            return False
+        return True
+
+    @property
+    def archive_record(self):
+        """A new copy of the science archive record for this frame, built on first access.
+
+        The record holds the archive frame data, cleaned headers, WCS corners and basename of the file,
+        but not yet the version set of the upload.
+        """
+        if self._archive_record is None:
+            datafile = self.datafile
+            with self.stats.timed('headers'):
+                header_data = datafile.get_header_data()
+                record = header_data.get_archive_frame_data()
+                record['headers'] = header_data.get_headers()
+            with self.stats.timed('wcs'):
+                record['area'] = datafile.get_wcs_corners()
+            record['basename'] = self.open_file.basename
+            self._archive_record = record
+        return dict(self._archive_record)
@@ -10,13 +10,15 @@ data to the science archive are as follows:
     4) Combine the results from steps 2 and 3 into a record to be added to the science archive database
 
 Examples:
-    Ingest a file one step at a time:
+    Ingest a file one step at a time, passing a Frame between the steps so that the file is only hashed
+    and parsed once:
 
     >>> from ocs_ingester import ingester
     >>> with open('tst1mXXX-ab12-20191013-0001-e00.fits.fz', 'rb') as fileobj:
-    >>>     if not ingester.frame_exists(fileobj):
-    >>>        record = ingester.validate_fits_and_create_archive_record(fileobj)
-    >>>        s3_version = ingester.upload_file_to_s3(fileobj)
+    >>>     frame = ingester.Frame(fileobj)
+    >>>     if not ingester.frame_exists(frame):
+    >>>        record = ingester.validate_fits_and_create_archive_record(frame)
+    >>>        s3_version = ingester.upload_file_to_file_store(frame)
     >>>        ingested_record = ingester.ingest_archive_record(s3_version, record)
 
     Ingest a file in one step:
@@ -26,19 +28,35 @@ Examples:
     >>>    ingested_record = ingester.upload_file_and_ingest_to_archive(fileobj)
 
 """
+import functools
+import inspect
+import json
+from concurrent.futures import ThreadPoolExecutor
 
 from ocs_ingester.exceptions import BackoffRetryError, NonFatalDoNotRetryError, DoNotRetryError
 from ocs_ingester.archive import ArchiveService
-from ocs_ingester.utils.metrics import upload_and_collect_metrics, get_md5_and_collect_metrics
+from ocs_ingester.frame import Frame
+from ocs_ingester.utils.metrics import upload_and_collect_metrics, count_metric
+from ocs_ingester.storage import get_file_store
+from ocs_ingester.retry import get_retrier
+from ocs_ingester.checkpoint import get_checkpoint_journal
+from ocs_ingester.deadline import Deadline, current_deadline
+from ocs_ingester.utils.hashing import HashingReader
 from ocs_ingester.settings import settings as ingester_settings
 
 from ocs_archive.settings import settings as archive_settings
-from ocs_archive.input.file import File, FileSpecificationException
-from ocs_archive.input.filefactory import FileFactory
-from ocs_archive.storage.filestorefactory import FileStoreFactory
+from ocs_archive.storage.s3store import S3Store
+from ocs_archive.storage.filesystemstore import FileSystemStore
 from ocs_archive.storage.filestore import FileStoreSpecificationError, FileStoreConnectionError
 
 
+def _get_frame(fileobj, *args, **kwargs):
+    # Step functions accept either a file-like object or a Frame that was created earlier
+    if isinstance(fileobj, Frame):
+        return fileobj
+    return Frame(fileobj, *args, **kwargs)
+
+
 def frame_exists(fileobj, api_root=ingester_settings.API_ROOT, auth_token=ingester_settings.AUTH_TOKEN):
     """Checks if the file exists in the science archive.
 
@@ -46,7 +64,7 @@ def frame_exists(fileobj, api_root=ingester_settings.API_ROOT, auth_token=ingest
     the science archive.
 
     Args:
-        fileobj (file-like object): File-like object
+        fileobj (file-like object or Frame): File-like object, or a Frame to reuse the md5 of
         api_root (str): Science archive API root url
         auth_token (str): Science archive API authentication token
 
@@ -58,9 +76,33 @@ def frame_exists(fileobj, api_root=ingester_settings.API_ROOT, auth_token=ingest
             a response from the science archive API
 
     """
-    archive = ArchiveService(api_root=api_root, auth_token=auth_token)
-    md5 = get_md5_and_collect_metrics(File(fileobj))
-    return archive.version_exists(md5)
+    archive = ArchiveService(api_root=api_root, auth_token=auth_token, retrier=get_retrier())
+    return archive.version_exists(_get_frame(fileobj).md5)
+
+
+def frames_exist(fileobjs, api_root=ingester_settings.API_ROOT, auth_token=ingester_settings.AUTH_TOKEN):
+    """Checks which of many files exist in the science archive.
+
+    Computes the md5 of each of the given files and checks them against the science archive in
+    as few requests as possible.
+
+    Args:
+        fileobjs (iterable): File-like objects or Frames
+        api_root (str): Science archive API root url
+        auth_token (str): Science archive API authentication token
+
+    Returns:
+        dict: Mapping of each file-like object to a boolean indicating whether it exists in the science archive
+
+    Raises:
+        ocs_ingester.exceptions.BackoffRetryError: If there was a problem getting
+            a response from the science archive API
+
+    """
+    archive = ArchiveService(api_root=api_root, auth_token=auth_token, retrier=get_retrier())
+    md5s = {fileobj: _get_frame(fileobj).md5 for fileobj in fileobjs}
+    exists = archive.versions_exist(md5s.values())
+    return {fileobj: exists[md5] for fileobj, md5 in md5s.items()}
 
 
 def validate_fits_and_create_archive_record(fileobj, path=None, file_metadata=None,
@@ -72,7 +114,8 @@ def validate_fits_and_create_archive_record(fileobj, path=None, file_metadata=No
     headers such that they are valid for ingestion into the science archive.
 
     Args:
-        fileobj (file-like object): File-like object
+        fileobj (file-like object or Frame): File-like object, or a Frame to reuse the parsed headers of. The
+            other arguments are ignored when a Frame is given, since it was created with its own.
         path (str): File path/name for this object. This option may be used to override the filename
             associated with the fileobj. It must be used if the fileobj does not have a filename.
         file_metadata (dict): Dictionary of file metadata to use when generating the archive record for a non-FITS file.
@@ -98,29 +141,21 @@ def validate_fits_and_create_archive_record(fileobj, path=None, file_metadata=No
         ocs_ingester.exceptions.DoNotRetryError: If required headers could not be found
 
     """
-    try:
-        open_file = File(fileobj, path)
-        datafile = FileFactory.get_datafile_class_for_extension(open_file.extension)(
-            open_file, file_metadata, blacklist_headers, required_headers
-        )
-    except FileSpecificationException as fe:
-        raise DoNotRetryError(str(fe))
-    json_record = datafile.get_header_data().get_archive_frame_data()
-    json_record['headers'] = datafile.get_header_data().get_headers()
-    json_record['area'] = datafile.get_wcs_corners()
-    json_record['basename'] = open_file.basename
-    return json_record
+    frame = _get_frame(fileobj, path, file_metadata, required_headers=required_headers,
+                       blacklist_headers=blacklist_headers)
+    return frame.archive_record
 
 
-def upload_file_to_file_store(fileobj, path=None, file_metadata=None):
+def upload_file_to_file_store(fileobj, path=None, file_metadata=None, bucket=None):
     """Uploads a file to the S3 bucket.
 
     Args:
-        fileobj (file-like object): File-like object
+        fileobj (file-like object or Frame): File-like object, or a Frame to reuse the parsed headers of
         path (str): File path/name for this object. This option may be used to override the filename
             associated with the fileobj. It must be used if the fileobj does not have a filename.
         file_metadata (dict): Dictionary of file metadata to use when generating the archive record for a non-FITS file.
             This must be used when uploading a non-FITS file.
+        bucket (str): S3 bucket to upload to, defaults to the BUCKET setting of ocs_archive
 
     Returns:
         dict: Version information for the file that was uploaded. For example::
@@ -140,16 +175,10 @@ def upload_file_to_file_store(fileobj, path=None, file_metadata=None):
         ocs_ingester.exceptions.BackoffRetryError: If there is a problem connecting to file store
         ocs_ingester.exceptions.DoNotRetryError: If there is a problem configuring file store
     """
-    try:
-        open_file = File(fileobj, path)
-        datafile = FileFactory.get_datafile_class_for_extension(open_file.extension)(
-            open_file, file_metadata
-        )
-    except FileSpecificationException as fe:
-        raise DoNotRetryError(str(fe))
+    datafile = _get_frame(fileobj, path, file_metadata).datafile
 
     try:
-        filestore = FileStoreFactory.get_file_store_class()()
+        filestore = get_file_store(bucket=bucket)
         # Returns the version, which holds in it the md5 that was uploaded
         return upload_and_collect_metrics(filestore, datafile)
     except FileStoreSpecificationError as fe:
@@ -193,7 +222,7 @@ def ingest_archive_record(version, record, api_root=ingester_settings.API_ROOT,
             attempting to ingest it again
 
     """
-    archive = ArchiveService(api_root=api_root, auth_token=auth_token)
+    archive = ArchiveService(api_root=api_root, auth_token=auth_token, retrier=get_retrier())
     # Construct final archive payload and post to archive
     record['version_set'] = [version]
     return archive.post_frame(record)
@@ -202,14 +231,17 @@ def ingest_archive_record(version, record, api_root=ingester_settings.API_ROOT,
 def upload_file_and_ingest_to_archive(fileobj, path=None, file_metadata=None,
                                       required_headers=archive_settings.REQUIRED_HEADERS,
                                       blacklist_headers=archive_settings.HEADER_BLACKLIST,
-                                      api_root=ingester_settings.API_ROOT, auth_token=ingester_settings.AUTH_TOKEN):
+                                      api_root=ingester_settings.API_ROOT, auth_token=ingester_settings.AUTH_TOKEN,
+                                      streaming=False, bucket=None, concurrent=None, speculative=None,
+                                      deadline=None):
     """Uploads a file to S3 and adds the associated record to the science archive database.
 
     This is a standalone function that runs all of the necessary steps to add data to the
     science archive.
+    Retryable errors are retried as configured by the RETRY_* settings before they are raised.
 
     Args:
-        fileobj (file-like object): File-like object
+        fileobj (file-like object or Frame): File-like object, or a Frame to reuse the md5 and parsed headers of
         path (str): File path/name for this object. This option may be used to override the filename
             associated with the fileobj. It must be used if the fileobj does not have a filename.
         file_metadata (dict): Dictionary of file metadata to use when generating the archive record for a non-FITS file.
@@ -218,6 +250,17 @@ def upload_file_and_ingest_to_archive(fileobj, path=None, file_metadata=None,
         auth_token (str): Science archive API authentication token
         required_headers (tuple): FITS headers that must be present
         blacklist_headers (tuple): FITS headers that should not be ingested
+        streaming (bool): Compute the md5 of the file while it is uploaded instead of reading it beforehand.
+            The check for whether the file already exists then happens after the upload, and an unneeded
+            upload is removed again from versioned file stores.
+        bucket (str): S3 bucket to upload to, defaults to the BUCKET setting of ocs_archive
+        concurrent (bool): Hash the file, and then check whether it already exists, in a separate thread while
+            the headers and WCS are parsed. Defaults to the INGEST_CONCURRENT_STAGES setting.
+        speculative (bool): Upload the file while checking whether it already exists, instead of after. An
+            unneeded upload is removed again from versioned file stores. Defaults to the INGEST_SPECULATIVE_UPLOADS
+            setting.
+        deadline (float): Seconds that the whole ingest, including retries, may take. Archive requests are given
+            what remains of it as their timeout. Defaults to the INGEST_DEADLINE setting, and 0 means no deadline.
 
     Returns:
         dict: Information about the uploaded file and record. For example:
@@ -234,63 +277,401 @@ def upload_file_and_ingest_to_archive(fileobj, path=None, file_metadata=None,
                 'headers': {
                     'REQNUM': 12345,
                     ...
+                },
+                'ingest_stats': {
+                    'stages': {'parse': 0.012, 'md5': 0.004, 'exists': 0.021, 'upload': 0.310, ...},
+                    'total': 0.402,
+                    'bytes': 1648320,
+                    'retries': 0
                 }
                 ...
             }
 
+        The ingest_stats hold the seconds spent in each stage of the ingest, the size of the file and the
+        number of retries. They are also sent as metrics when INGEST_STAGE_METRICS is set.
+
     Raises:
         ocs_ingester.exceptions.NonFatalDoNotRetryError: If the file already exists in the science archive
         ocs_ingester.exceptions.BackoffRetryError: If the md5 computed locally does not match the md5
-            computed by S3, if there was an error connecting to S3, or if there was a problem reaching
-            the science archive.
+            computed by S3, if there was an error connecting to S3, if there was a problem reaching
+            the science archive, or if the deadline passed.
         ocs_ingester.exceptions.DoNotRetryError: If there was a problem that must be fixed before attempting
              to ingest again
 
     """
+    options = _ingest_options(streaming, concurrent, speculative, deadline)
+    frame = _get_frame(fileobj, path, file_metadata, required_headers=required_headers,
+                       blacklist_headers=blacklist_headers)
+    if streaming or not options['concurrent']:
+        # Parse the file up front so that invalid files are rejected before anything else is done. A concurrent
+        # ingest parses it alongside hashing, and still rejects it before anything is uploaded.
+        frame.datafile
+    filestore = _get_ingest_file_store(bucket)
+    archive = ArchiveService(api_root=api_root, auth_token=auth_token, deadline=options['deadline'])
+    return Ingester(frame, filestore, archive, **options).ingest()
+
+
+def _ingest_options(streaming, concurrent, speculative, deadline):
+    # Arguments of the Ingester of a standalone ingest, filled in from the settings
+    deadline = Deadline.after(ingester_settings.INGEST_DEADLINE if deadline is None else deadline)
+    return {
+        'streaming': streaming,
+        'retrier': get_retrier(deadline),
+        'checkpoints': get_checkpoint_journal(),
+        'concurrent': ingester_settings.INGEST_CONCURRENT_STAGES if concurrent is None else concurrent,
+        'speculative': ingester_settings.INGEST_SPECULATIVE_UPLOADS if speculative is None else speculative,
+        'deadline': deadline,
+    }
+
+
+def _get_ingest_file_store(bucket):
     try:
-        if file_metadata is None:
-            file_metadata = {}
-        open_file = File(fileobj, path)
-        datafile = FileFactory.get_datafile_class_for_extension(open_file.extension)(
-            open_file, file_metadata, required_headers=required_headers, blacklist_headers=blacklist_headers
-        )
-        filestore = FileStoreFactory.get_file_store_class()()
-    except (FileSpecificationException, FileStoreSpecificationError) as fe:
+        return get_file_store(bucket=bucket)
+    except FileStoreSpecificationError as fe:
         raise DoNotRetryError(str(fe))
 
-    archive = ArchiveService(api_root=api_root, auth_token=auth_token)
-    ingester = Ingester(datafile, filestore, archive)
-    return ingester.ingest()
+
+class ArchiveCall(object):
+    """Step of an ingest that calls a method of the science archive service with the given arguments."""
+    def __init__(self, method, *args):
+        self.method = method
+        self.args = args
+
+
+class Concurrently(object):
+    """Step of an ingest that runs the given steps at the same time.
+
+    Its result is a list with a (result, exception) pair for each of the steps, where one of the two is None.
+    """
+    def __init__(self, *steps):
+        self.steps = steps
 
 
 class Ingester(object):
     """Ingest a single file into the archive.
 
     A single instance of this class is responsible for parsing a fits file,
-    uploading the data to s3, and making a call to the archive api.
+    uploading the data to s3, and making a call to the archive api. It may be
+    given either a datafile or a Frame that has already been partly processed.
+
+    In streaming mode the file is only read once: its md5 is computed while it is
+    uploaded, and the check for an existing version happens after the upload.
+
+    In concurrent mode, which does not apply to streaming, the file is hashed and then
+    checked for an existing version in a separate thread while its headers and WCS are
+    parsed. The time spent in those stages then overlaps in the stats of the ingest.
+
+    In speculative mode, which does not apply to streaming either, the file is uploaded
+    while it is checked for an existing version. If it turns out to exist, the upload is
+    removed again from versioned file stores and counted as wasted. When the check was
+    already made concurrently with the parse, the upload waits for its result instead.
+
+    With a deadline, each step fails with a BackoffRetryError once the deadline has passed,
+    and the deadline is current while the file is uploaded.
+
+    Once the file is uploaded, a retried ingest only posts the record again. With a
+    checkpoint journal, this also holds for a later ingest of the same file, with the same
+    metadata and into the same bucket, in another process, except in streaming mode where
+    the md5 is not known before the upload.
+
+    The ingest is a generator of steps, which are callables, an ArchiveCall for each request
+    to the science archive, Concurrently for steps that overlap, or generators of more steps.
+    This class runs them one after the other in the calling thread, and
+    :class:`ocs_ingester.async_ingester.AsyncIngester` runs the same steps from an event loop.
     """
-    def __init__(self, datafile, filestore, archive):
-        self.datafile = datafile
+    def __init__(self, datafile, filestore, archive, streaming=False, retrier=None, checkpoints=None,
+                 concurrent=False, speculative=False, deadline=None):
+        self.frame = datafile if isinstance(datafile, Frame) else Frame.from_datafile(datafile)
         self.filestore = filestore
         self.archive = archive
+        self.streaming = streaming
+        # Optional ocs_ingester.retry.Retrier used to retry the whole ingest after a retryable error
+        self.retrier = retrier
+        # Optional ocs_ingester.checkpoint.CheckpointJournal used to resume ingests that were already uploaded
+        self.checkpoints = checkpoints
+        self.concurrent = concurrent and not streaming
+        self.speculative = speculative and not streaming
+        # Optional ocs_ingester.deadline.Deadline checked before each step of the ingest
+        self.deadline = deadline
+        self.version = None
+        self.record = None
+        self.attempted = False
+        # Whether the file exists, as found by the concurrent check and not yet acted on
+        self._exists = None
+
+    @property
+    def datafile(self):
+        return self.frame.datafile
 
     def ingest(self):
-        # Get the Md5 checksum of this file and check if it already exists in the archive
-        md5 = get_md5_and_collect_metrics(self.datafile.open_file)
-        if self.archive.version_exists(md5):
+        if self.retrier is not None:
+            return self.retrier.call(self._ingest)
+        return self._ingest()
+
+    def _ingest(self):
+        return self.run_steps(self.ingest_steps())
+
+    def ingest_steps(self):
+        # The order of the steps of an ingest, which ocs_ingester.async_ingester.AsyncIngester runs as well
+        yield from self.upload_steps()
+        return (yield from self.post_steps())
+
+    def upload_and_checkpoint(self):
+        return self.run_steps(self.upload_steps())
+
+    def upload_steps(self):
+        # The steps of an attempt up to and including the checkpoint of the upload, after which version holds the
+        # upload to post
+        first_attempt = not self.attempted
+        if not first_attempt:
+            self.frame.stats.retries += 1
+        self.attempted = True
+        if first_attempt and self.concurrent:
+            yield from self._prepare_concurrently_steps()
+        if self.version is None:
+            yield self.resume
+        if self.version is not None:
+            # The attempt that uploaded the file may have posted the record before it failed
+            try:
+                yield from self._check_not_exists_steps()
+            except NonFatalDoNotRetryError:
+                yield self.forget_checkpoint
+                raise
+        elif self.speculative and self._exists is None:
+            version = yield from self._upload_speculatively_steps()
+            yield functools.partial(self.checkpoint, version)
+        elif not self.streaming:
+            yield from self._check_not_exists_steps()
+            version = yield self.upload
+            yield functools.partial(self.checkpoint, version)
+        else:
+            version = yield self.upload
+            try:
+                yield from self._check_not_exists_steps()
+            except NonFatalDoNotRetryError:
+                yield functools.partial(self.discard_upload, version)
+                raise
+            yield functools.partial(self.checkpoint, version)
+
+    def post_and_forget(self):
+        return self.run_steps(self.post_steps())
+
+    def post_steps(self):
+        # Posts the record of the upload, which is then no longer needed to resume the ingest
+        result = yield from self._post_steps(self.version)
+        yield self.forget_checkpoint
+        return result
+
+    def run_steps(self, steps):
+        # Runs each step yielded by a generator of steps, and sends its result, or throws its exception, back in
+        result, error = None, None
+        while True:
+            try:
+                step = steps.send(result) if error is None else steps.throw(error)
+            except StopIteration as stop:
+                return stop.value
+            try:
+                result, error = self.run_step(step), None
+            except Exception as e:
+                result, error = None, e
+
+    def run_step(self, step):
+        if isinstance(step, ArchiveCall):
+            return getattr(self.archive, step.method)(*step.args)
+        if isinstance(step, Concurrently):
+            # The first step runs in this thread and the others each in a thread of their own
+            first, *others = step.steps
+            with ThreadPoolExecutor(max_workers=len(others), thread_name_prefix='ocs_ingester_step') as executor:
+                outcomes = [executor.submit(self._run_step_outcome, other) for other in others]
+                return [self._run_step_outcome(first)] + [outcome.result() for outcome in outcomes]
+        if inspect.isgenerator(step):
+            return self.run_steps(step)
+        return step()
+
+    def _run_step_outcome(self, step):
+        try:
+            return self.run_step(step), None
+        except Exception as e:
+            return None, e
+
+    def prepare_concurrently(self):
+        return self.run_steps(self._prepare_concurrently_steps())
+
+    def _prepare_concurrently_steps(self):
+        # Parse the headers and WCS while the file is hashed and then checked for an existing version. hashlib
+        # releases the GIL while hashing, so the two overlap even though both are CPU bound.
+        (_, parse_error), (exists, exists_error) = yield Concurrently(
+            self._parse, self._hash_and_check_exists_steps()
+        )
+        # An invalid file is rejected whether or not it exists, like in a sequential ingest
+        if parse_error is not None:
+            raise parse_error
+        if exists_error is not None:
+            raise exists_error
+        self._exists = exists
+
+    def _hash_and_check_exists_steps(self):
+        # A file that cannot be read independently of the parse is hashed and checked afterwards instead
+        if (yield self.frame.compute_md5_independently):
+            return (yield from self._version_exists_steps())
+        return None
+
+    def check_exists_ahead(self):
+        return self.run_steps(self._check_exists_ahead_steps())
+
+    def _check_exists_ahead_steps(self):
+        # Check whether the file exists ahead of the ingest, which then acts on the result instead of checking again
+        if not self.streaming:
+            self._exists = yield from self._version_exists_steps()
+
+    @property
+    def exists_ahead(self):
+        # Whether the file was found to exist by a check that the ingest has not yet acted on
+        return bool(self._exists)
+
+    def check_deadline(self, step):
+        if self.deadline is not None:
+            self.deadline.check(step)
+
+    def _hash(self):
+        return self.frame.md5
+
+    def _parse(self):
+        return self.frame.archive_record
+
+    def _version_exists_steps(self):
+        md5 = yield self._hash
+        self.check_deadline('checking whether the file exists')
+        with self.frame.stats.timed('exists'):
+            return (yield ArchiveCall('version_exists', md5))
+
+    def upload_speculatively(self):
+        return self.run_steps(self._upload_speculatively_steps())
+
+    def _upload_speculatively_steps(self):
+        # The md5 is needed for the check, and must be read from the file before the upload starts reading it
+        yield self._hash
+        (version, upload_error), (_, exists_error) = yield Concurrently(
+            self.upload, self._check_not_exists_steps()
+        )
+        if upload_error is not None:
+            # A file that already exists did not need uploading, so that takes precedence over a failed upload.
+            # Any other failure of the check is less telling than the failure of the upload.
+            if isinstance(exists_error, NonFatalDoNotRetryError):
+                raise exists_error
+            raise upload_error
+        extension = self.frame.open_file.extension
+        if isinstance(exists_error, NonFatalDoNotRetryError):
+            count_metric('ingester.speculative_uploads', extension=extension, wasted='true')
+            yield functools.partial(self.discard_upload, version)
+            raise exists_error
+        if exists_error is not None:
+            # Keep the upload, so that the retry only checks again whether the file exists before posting it
+            yield functools.partial(self.checkpoint, version)
+            raise exists_error
+        count_metric('ingester.speculative_uploads', extension=extension, wasted='false')
+        return version
+
+    def resume(self):
+        # Pick up the upload of an earlier ingest of this file into the same bucket from the checkpoint journal
+        if self.checkpoints is None or self.streaming:
+            return
+        checkpoint = self.checkpoints.load(self.archive.api_root, self.checkpoint_bucket, self.frame.md5)
+        if checkpoint is None:
+            return
+        version, record = checkpoint
+        # An ingest with other metadata would post another record, and may have stored the file under another path
+        if json.loads(json.dumps(self.build_record(version))) == record:
+            self.version, self.record = version, record
+
+    def checkpoint(self, version):
+        self.version = version
+        self.record = self.build_record(version)
+        if self.checkpoints is not None:
+            self.checkpoints.save(
+                self.archive.api_root, self.checkpoint_bucket, self.frame.md5, self.version, self.record
+            )
+
+    def forget_checkpoint(self):
+        if self.checkpoints is not None:
+            self.checkpoints.remove(self.archive.api_root, self.checkpoint_bucket, self.frame.md5)
+
+    @property
+    def checkpoint_bucket(self):
+        # Where the file store keeps its files, so that an upload is only resumed by ingests into the same place
+        if isinstance(self.filestore, S3Store):
+            return self.filestore.bucket
+        if isinstance(self.filestore, FileSystemStore):
+            return self.filestore.root_dir
+        return ''
+
+    def check_not_exists(self):
+        return self.run_steps(self._check_not_exists_steps())
+
+    def _check_not_exists_steps(self):
+        # Get the Md5 checksum of this file and check if it already exists in the archive, unless that was
+        # already checked concurrently
+        exists, self._exists = self._exists, None
+        if exists is None:
+            exists = yield from self._version_exists_steps()
+        if exists:
             raise NonFatalDoNotRetryError('Version with this md5 already exists')
 
+    def upload(self):
         # Upload the file to s3 and get version information back
-        version = upload_and_collect_metrics(self.filestore, self.datafile)
+        datafile = self.datafile
+        self.frame.stats.bytes = len(self.frame.open_file)
+        self.check_deadline('uploading the file')
+        try:
+            with self.frame.stats.timed('upload'), current_deadline(self.deadline):
+                if self.streaming:
+                    version = self.upload_and_hash()
+                else:
+                    version = upload_and_collect_metrics(self.filestore, datafile)
+        except FileStoreConnectionError as fce:
+            raise BackoffRetryError(str(fce))
 
         # Make sure our md5 matches amazons
-        if version['md5'] != md5:
+        if version['md5'] != self.frame.md5:
             raise BackoffRetryError('S3 md5 did not match ours')
-
-        # Construct final archive payload and post to archive
-        record = self.datafile.get_header_data().get_archive_frame_data()
-        record['headers'] = self.datafile.get_header_data().get_headers()
-        record['area'] = self.datafile.get_wcs_corners()
+        return version
+
+    def upload_and_hash(self):
+        open_file = self.frame.open_file
+        reader = HashingReader(open_file.fileobj)
+        open_file.fileobj = reader
+        try:
+            version = upload_and_collect_metrics(self.filestore, self.datafile)
+        finally:
+            open_file.fileobj = reader.fileobj
+        self.frame.md5 = reader.hexdigest()
+        return version
+
+    def discard_upload(self, version):
+        # Only versioned file stores can remove the new upload without touching an existing copy of the file
+        if isinstance(self.filestore, S3Store):
+            self.filestore.delete_file(self.datafile.get_filestore_path(), version['key'])
+
+    def build_record(self, version):
+        # Construct final archive payload
+        record = self.frame.archive_record
         record['version_set'] = [version]
-        record['basename'] = self.datafile.open_file.basename
-        return self.archive.post_frame(record)
+        return record
+
+    def post(self, version):
+        return self.run_steps(self._post_steps(version))
+
+    def _post_steps(self, version):
+        if self.record is not None:
+            record = dict(self.record)
+        else:
+            record = yield functools.partial(self.build_record, version)
+        self.check_deadline('posting the record')
+        with self.frame.stats.timed('post'):
+            result = yield ArchiveCall('post_frame', record)
+        if ingester_settings.INGEST_STAGE_METRICS:
+            self.frame.stats.send_metrics(
+                instrument_id=record.get('instrument_id'), extension=self.frame.open_file.extension
+            )
+        result['ingest_stats'] = self.frame.stats.as_dict()
+        return result
@@ -0,0 +1,106 @@
+"""``md5_index.py`` - Local on-disk index of md5s known to exist in a science archive.
+
+The index is an optional SQLite database of md5s that this host has ingested or seen to exist in the
+science archive. When MD5_INDEX_PATH is set, :class:`ocs_ingester.archive.ArchiveService` consults it before
+asking the science archive whether a version exists, so that repeated checks of already archived files do
+not need to reach the archive at all. Entries expire after MD5_INDEX_TTL seconds, after which the archive is
+asked again.
+
+Examples:
+    Warm up the index with every version added to the archive since a given date:
+
+    >>> from ocs_ingester.archive import ArchiveService
+    >>> from ocs_ingester.md5_index import get_md5_index
+    >>> archive = ArchiveService(api_root='http://archive-api/', auth_token='token')
+    >>> get_md5_index().warm_up(archive, created_after='2019-10-01')
+
+"""
+import time
+
+from ocs_ingester.utils.local_state import ProcessLocal, LocalDatabase
+from ocs_ingester.settings import settings as ingester_settings
+
+# The process-wide index, opened on first use
+_md5_index = ProcessLocal()
+
+
+def get_md5_index():
+    """Return the process-wide md5 index configured by MD5_INDEX_PATH, or None if it is not configured."""
+    if not ingester_settings.MD5_INDEX_PATH:
+        return None
+    return _md5_index.get(
+        lambda: Md5Index(ingester_settings.MD5_INDEX_PATH, ttl=ingester_settings.MD5_INDEX_TTL),
+        stale=lambda index: index.path != ingester_settings.MD5_INDEX_PATH
+    )
+
+
+class Md5Index(LocalDatabase):
+    """SQLite backed index of md5s that exist in one or more science archives, keyed by API root.
+
+    Args:
+        path (str): Path to the SQLite database, which is created if it does not exist
+        ttl (float): Number of seconds after which an entry is no longer trusted
+    """
+    def __init__(self, path, ttl=ingester_settings.MD5_INDEX_TTL):
+        super().__init__(
+            path,
+            'CREATE TABLE IF NOT EXISTS md5s ('
+            'api_root TEXT NOT NULL, md5 TEXT NOT NULL, seen REAL NOT NULL, PRIMARY KEY (api_root, md5))'
+        )
+        self.ttl = ttl
+
+    def contains(self, api_root, md5):
+        """Returns whether the md5 is known to exist in the science archive at api_root."""
+        return md5 in self.contains_many(api_root, [md5])
+
+    def contains_many(self, api_root, md5s):
+        """Returns the subset of the md5s that are known to exist in the science archive at api_root."""
+        md5s = list(md5s)
+        found = set()
+        with self._lock:
+            # Stay well below the SQLite limit on the number of query parameters
+            for i in range(0, len(md5s), 500):
+                chunk = md5s[i:i + 500]
+                rows = self._connection.execute(
+                    'SELECT md5 FROM md5s WHERE api_root = ? AND seen >= ? AND md5 IN ({0})'.format(
+                        ','.join('?' * len(chunk))
+                    ),
+                    [api_root, time.time() - self.ttl] + chunk
+                )
+                found.update(row[0] for row in rows)
+        return found
+
+    def add(self, api_root, md5s):
+        """Records that the md5s exist in the science archive at api_root."""
+        now = time.time()
+        with self._lock:
+            self._connection.executemany(
+                'INSERT OR REPLACE INTO md5s (api_root, md5, seen) VALUES (?, ?, ?)',
+                [(api_root, md5, now) for md5 in md5s]
+            )
+
+    def evict_expired(self):
+        """Removes entries older than the ttl, returning how many were removed."""
+        with self._lock:
+            return self._connection.execute('DELETE FROM md5s WHERE seen < ?', [time.time() - self.ttl]).rowcount
+
+    def warm_up(self, archive, **filters):
+        """Adds the md5 of every version listed by the archive's versions/ endpoint.
+
+        Args:
+            archive (ocs_ingester.archive.ArchiveService): Science archive to list versions from
+            filters: Extra query parameters used to filter the versions that are listed
+
+        Returns:
+            int: Number of md5s added to the index
+        """
+        count = 0
+        md5s = []
+        for version in archive.iter_versions(**filters):
+            md5s.append(version['md5'])
+            if len(md5s) >= 1000:
+                self.add(archive.api_root, md5s)
+                count += len(md5s)
+                md5s = []
+        self.add(archive.api_root, md5s)
+        return count + len(md5s)
@@ -0,0 +1,228 @@
+"""``pipeline.py`` - Ingest many frames at once by overlapping the stages of different frames.
+
+Ingesting a frame is split into the stages hash, exists, parse, upload and post. Each stage has its own pool of
+worker threads and a bounded queue in front of it, so that while one frame is being uploaded the next frames can
+already be hashed, checked and parsed, and the record of the frame before it posted. The first three stages only do
+work ahead of time. The upload stage runs :meth:`ocs_ingester.ingester.Ingester.upload_and_checkpoint`, which acts on
+what was found ahead of time instead of doing it again, and the post stage then runs
+:meth:`ocs_ingester.ingester.Ingester.post_and_forget`. Each of these two is retried on its own, with the retrier,
+checkpoints and deadline of the frame, and a retried post first checks whether the failed attempt was posted after
+all. A frame found to exist already skips the parse, and a frame that fails a stage skips the remaining stages and
+is reported with the exception that was raised.
+
+Examples:
+    Ingest many files, overlapping hashing and parsing with uploading:
+
+    >>> from ocs_ingester.pipeline import IngestPipeline
+    >>> from ocs_ingester.frame import Frame
+    >>> pipeline = IngestPipeline(filestore, archive, workers={'upload': 8, 'post': 4})
+    >>> for result in pipeline.run(Frame(open(path, 'rb')) for path in paths):
+    >>>     result.frame.open_file.fileobj.close()
+    >>>     print(result.frame.open_file.filename, result.error or result.record['url'])
+
+"""
+import queue
+import threading
+from collections import namedtuple
+
+from ocs_ingester.ingester import Ingester
+from ocs_ingester.retry import get_retrier
+from ocs_ingester.checkpoint import get_checkpoint_journal
+from ocs_ingester.deadline import Deadline
+from ocs_ingester.settings import settings as ingester_settings
+
+PipelineResult = namedtuple('PipelineResult', ['frame', 'record', 'error'])
+
+STAGES = ('hash', 'exists', 'parse', 'upload', 'post')
+
+DEFAULT_WORKERS = {
+    'hash': 2,
+    'exists': 4,
+    'parse': 2,
+    'upload': 8,
+    'post': 4,
+}
+
+# Placed on a stage's queue once for each of its workers when there are no more frames
+_STOP = object()
+
+# Seconds that blocked threads wait before checking whether the pipeline is being closed
+_POLL_INTERVAL = 0.1
+
+
+class _Item(object):
+    def __init__(self, frame):
+        self.frame = frame
+        self.ingester = None
+        self.record = None
+        self.post_attempted = False
+
+
+class IngestPipeline(object):
+    """Staged ingest engine built on :class:`ocs_ingester.ingester.Ingester`.
+
+    Frames are ingested with the retries, checkpoint journal and speculative uploads configured by the settings,
+    like :func:`ocs_ingester.ingester.upload_file_and_ingest_to_archive`.
+
+    Args:
+        filestore (ocs_archive.storage.filestore.FileStore): File store to upload to
+        archive (ocs_ingester.archive.ArchiveService): Science archive to check for and post frames to, whose
+            requests for each frame are given the deadline of that frame
+        workers (dict): Number of worker threads per stage, overriding DEFAULT_WORKERS
+        queue_size (int): Maximum number of frames waiting in front of each stage
+        deadline (float): Seconds that the ingest of each frame may take from when it is first worked on,
+            defaulting to the INGEST_DEADLINE setting, where 0 means no deadline
+    """
+    def __init__(self, filestore, archive, workers=None, queue_size=8, deadline=None):
+        self.filestore = filestore
+        self.archive = archive
+        self.workers = dict(DEFAULT_WORKERS, **(workers or {}))
+        self.queue_size = queue_size
+        self.deadline = ingester_settings.INGEST_DEADLINE if deadline is None else deadline
+
+    def run(self, frames):
+        """Ingests the given frames.
+
+        The frames are consumed lazily, so at most a few frames per stage are being worked on at once. When
+        the caller stops iterating early, frames that were not started are dropped, and the pipeline waits
+        for the frames being worked on before its threads are gone.
+
+        Args:
+            frames (iterable): Frames to ingest
+
+        Yields:
+            PipelineResult: The frame, with either the ingested record or the exception that was raised,
+                in the order that frames finish
+
+        Raises:
+            Exception: Whatever iterating over frames raised, once the frames before it have finished
+        """
+        queues = [queue.Queue(self.queue_size) for _ in STAGES]
+        results = queue.Queue()
+        stopping = threading.Event()
+        feed_errors = []
+        threads = [threading.Thread(
+            target=self._feed, args=(frames, queues[0], stopping, feed_errors), daemon=True
+        )]
+        for index, stage in enumerate(STAGES):
+            next_queue = queues[index + 1] if index + 1 < len(STAGES) else None
+            next_workers = self.workers[STAGES[index + 1]] if next_queue is not None else 1
+            remaining = [self.workers[stage]]
+            lock = threading.Lock()
+            for _ in range(self.workers[stage]):
+                threads.append(threading.Thread(
+                    target=self._work,
+                    args=(getattr(self, '_' + stage), queues[index], next_queue, next_workers, results, stopping,
+                          remaining, lock),
+                    daemon=True
+                ))
+        for thread in threads:
+            thread.start()
+
+        try:
+            while True:
+                result = results.get()
+                if result is _STOP:
+                    break
+                yield result
+            if feed_errors:
+                raise feed_errors[0]
+        finally:
+            stopping.set()
+            for thread in threads:
+                thread.join()
+            # Let go of the frames that were never started
+            for pending in queues + [results]:
+                while not pending.empty():
+                    pending.get_nowait()
+
+    def _feed(self, frames, first_queue, stopping, feed_errors):
+        try:
+            for frame in frames:
+                if not _put(first_queue, _Item(frame), stopping):
+                    return
+        except Exception as e:
+            feed_errors.append(e)
+        for _ in range(self.workers[STAGES[0]]):
+            _put(first_queue, _STOP, stopping)
+
+    def _work(self, stage, in_queue, out_queue, out_workers, results, stopping, remaining, lock):
+        while True:
+            item = _get(in_queue, stopping)
+            if item is _STOP:
+                break
+            try:
+                stage(item)
+            except Exception as e:
+                results.put(PipelineResult(item.frame, None, e))
+                continue
+            if out_queue is None:
+                results.put(PipelineResult(item.frame, item.record, None))
+            elif not _put(out_queue, item, stopping):
+                break
+
+        # The last worker of a stage to stop passes the stop on to the next stage
+        with lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last:
+            for _ in range(out_workers):
+                if out_queue is not None:
+                    _put(out_queue, _STOP, stopping)
+                else:
+                    results.put(_STOP)
+
+    def _hash(self, item):
+        deadline = Deadline.after(self.deadline)
+        item.ingester = Ingester(
+            item.frame, self.filestore, self.archive.with_deadline(deadline), retrier=get_retrier(deadline),
+            checkpoints=get_checkpoint_journal(), speculative=ingester_settings.INGEST_SPECULATIVE_UPLOADS,
+            deadline=deadline
+        )
+        item.frame.md5
+
+    def _exists(self, item):
+        try:
+            item.ingester.check_exists_ahead()
+        except Exception:
+            # The ingest checks again, with retries
+            pass
+
+    def _parse(self, item):
+        if not item.ingester.exists_ahead:
+            item.frame.archive_record
+
+    def _upload(self, item):
+        item.ingester.retrier.call(item.ingester.upload_and_checkpoint)
+
+    def _post(self, item):
+        item.record = item.ingester.retrier.call(self._post_attempt, item)
+
+    @staticmethod
+    def _post_attempt(item):
+        if not item.post_attempted:
+            item.post_attempted = True
+            return item.ingester.post_and_forget()
+        # The failed attempt may have posted the record, which a retry of the ingest checks before posting it again
+        return item.ingester.run_steps(item.ingester.ingest_steps())
+
+
+def _put(to_queue, item, stopping):
+    # Returns whether the item was put on the queue before the pipeline was closed
+    while not stopping.is_set():
+        try:
+            to_queue.put(item, timeout=_POLL_INTERVAL)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _get(from_queue, stopping):
+    # Returns _STOP once the pipeline is closed
+    while not stopping.is_set():
+        try:
+            return from_queue.get(timeout=_POLL_INTERVAL)
+        except queue.Empty:
+            pass
+    return _STOP
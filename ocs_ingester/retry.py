@@ -0,0 +1,234 @@
+"""``retry.py`` - Retry calls that fail with a retryable exception from :mod:`ocs_ingester.exceptions`.
+
+How a failed call is retried depends on the class of the exception that it raised. By default:
+
+* :class:`ocs_ingester.exceptions.BackoffRetryError` is retried with an exponential backoff
+* :class:`ocs_ingester.exceptions.RetryError` is retried after a short, constant delay
+* :class:`ocs_ingester.exceptions.DoNotRetryError`, :class:`ocs_ingester.exceptions.NonFatalDoNotRetryError`
+  and any other exceptions are not retried
+
+Delays use full jitter, a random delay between zero and the backoff, so that workers that failed at the same
+time do not retry at the same time. Retries are also limited by a :class:`RetryBudget` shared by every
+retrier in the process, so that an outage of the science archive or S3 does not multiply the load on them
+with retries from every worker. Worker processes share the budget of the process that started them when it
+is held by a :class:`RetryBudgetManager`, as :func:`ocs_ingester.batch.ingest_paths` does.
+
+Examples:
+    Retry a call according to the RETRY_* settings:
+
+    >>> from ocs_ingester.retry import get_retrier
+    >>> get_retrier().call(archive.version_exists, md5)
+
+"""
+import time
+import asyncio
+import random
+import logging
+import threading
+from multiprocessing.managers import BaseManager
+
+from ocs_ingester.exceptions import BackoffRetryError, RetryError
+from ocs_ingester.utils.metrics import count_metric
+from ocs_ingester.utils.local_state import ProcessLocal
+from ocs_ingester.settings import settings as ingester_settings
+
+logger = logging.getLogger('ocs_ingester')
+
+# The process-wide retry budget, created on first use
+_retry_budget = ProcessLocal()
+
+
+class RetryPolicy(object):
+    """How to retry a call that failed with a given class of exception.
+
+    Args:
+        max_attempts (int): Maximum number of attempts, including the first one
+        base_delay (float): Backoff in seconds before the first retry
+        max_delay (float): Maximum backoff in seconds
+        multiplier (float): Factor that the backoff grows by with every retry
+    """
+    def __init__(self, max_attempts, base_delay, max_delay, multiplier=2.0):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+
+    def backoff(self, retry):
+        """Returns the backoff in seconds before the given retry, counting from 1."""
+        return min(self.max_delay, self.base_delay * self.multiplier ** (retry - 1))
+
+
+class RetryBudget(object):
+    """Thread-safe token bucket that limits the number of retries.
+
+    Every retry costs a token. The bucket earns ``ratio`` tokens for every call that is made and
+    ``per_second`` tokens every second, up to ``capacity`` tokens. While the bucket is empty, failed calls
+    are not retried.
+    """
+    def __init__(self, ratio=0.2, per_second=1.0, capacity=10.0):
+        self.ratio = ratio
+        self.per_second = per_second
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, tokens):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + tokens + (now - self._updated) * self.per_second)
+        self._updated = now
+
+    def deposit(self):
+        """Records that a call was made."""
+        with self._lock:
+            self._refill(self.ratio)
+
+    def withdraw(self):
+        """Takes a token for a retry, returning whether one was available."""
+        with self._lock:
+            self._refill(0)
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+class RetryBudgetManager(BaseManager):
+    """Manager whose server process holds retry budgets that other processes share through proxies.
+
+    Examples:
+        >>> with RetryBudgetManager() as manager:
+        >>>     budget = manager.RetryBudget(**retry_budget_settings())
+        >>>     # Hand the budget to each worker process, which calls use_retry_budget(budget)
+    """
+
+
+RetryBudgetManager.register('RetryBudget', RetryBudget)
+
+
+def retry_budget_settings():
+    """Return the arguments of a RetryBudget configured by the RETRY_BUDGET_* settings."""
+    return {
+        'ratio': ingester_settings.RETRY_BUDGET_RATIO,
+        'per_second': ingester_settings.RETRY_BUDGET_PER_SECOND,
+        'capacity': ingester_settings.RETRY_BUDGET_CAPACITY,
+    }
+
+
+def get_retry_budget():
+    """Return the retry budget shared by every retrier in this process.
+
+    This is the budget given to use_retry_budget, or otherwise one configured by the RETRY_BUDGET_* settings.
+    """
+    return _retry_budget.get(lambda: RetryBudget(**retry_budget_settings()))
+
+
+def use_retry_budget(budget):
+    """Make the budget, such as a proxy from a RetryBudgetManager, the one shared by every retrier in this process."""
+    _retry_budget.set(budget)
+
+
+def get_retrier(deadline=None):
+    """Return a retrier configured by the RETRY_* settings, sharing the process-wide retry budget.
+
+    Args:
+        deadline (ocs_ingester.deadline.Deadline): Deadline after which no more retries are started, or None
+    """
+    max_attempts = ingester_settings.RETRY_MAX_ATTEMPTS
+    base_delay = ingester_settings.RETRY_BASE_DELAY
+    return Retrier(
+        policies={
+            BackoffRetryError: RetryPolicy(max_attempts, base_delay, ingester_settings.RETRY_MAX_DELAY),
+            RetryError: RetryPolicy(max_attempts, base_delay, base_delay, multiplier=1.0),
+        },
+        max_time=ingester_settings.RETRY_MAX_TIME,
+        budget=get_retry_budget(),
+        deadline=deadline
+    )
+
+
+class Retrier(object):
+    """Calls functions, retrying them according to the policy for the exception that they raise.
+
+    Args:
+        policies (dict): Maps exception classes to the RetryPolicy used when an exception of that class, or a
+            subclass of it, is raised. Exceptions without a policy are not retried.
+        max_time (float): Seconds after the first attempt after which no more retries are started, or None
+        budget (RetryBudget): Budget that retries are taken from, or None for no limit
+        deadline (ocs_ingester.deadline.Deadline): Deadline that a retry must start before, or None
+    """
+    def __init__(self, policies, max_time=None, budget=None, deadline=None):
+        self.policies = policies
+        self.max_time = max_time
+        self.budget = budget
+        self.deadline = deadline
+
+    def policy_for(self, exception):
+        for exception_class in type(exception).__mro__:
+            if exception_class in self.policies:
+                return self.policies[exception_class]
+        return None
+
+    def call(self, function, *args, **kwargs):
+        """Calls function with the given arguments, retrying it until it succeeds or may not be retried.
+
+        Raises:
+            Exception: The exception raised by the last attempt
+        """
+        start = time.monotonic()
+        retries = 0
+        if self.budget is not None:
+            self.budget.deposit()
+        while True:
+            try:
+                return function(*args, **kwargs)
+            except Exception as exc:
+                delay = self._delay_before_retry(exc, retries + 1, start)
+                if delay is None:
+                    raise
+                retries += 1
+                self._log_retry(exc, retries, delay)
+                time.sleep(delay)
+
+    async def call_async(self, function, *args, **kwargs):
+        """Awaits the coroutine function with the given arguments, retrying it like :meth:`call` does.
+
+        The delays before retries are slept without blocking the event loop.
+
+        Raises:
+            Exception: The exception raised by the last attempt
+        """
+        start = time.monotonic()
+        retries = 0
+        if self.budget is not None:
+            self.budget.deposit()
+        while True:
+            try:
+                return await function(*args, **kwargs)
+            except Exception as exc:
+                delay = self._delay_before_retry(exc, retries + 1, start)
+                if delay is None:
+                    raise
+                retries += 1
+                self._log_retry(exc, retries, delay)
+                await asyncio.sleep(delay)
+
+    @staticmethod
+    def _log_retry(exception, retry, delay):
+        count_metric('ingester.retries', error=type(exception).__name__)
+        logger.warning('Retrying after error: {0}'.format(exception), extra={'tags': {
+            'retry': retry, 'error': type(exception).__name__, 'delay': round(delay, 3)
+        }})
+
+    def _delay_before_retry(self, exception, retry, start):
+        policy = self.policy_for(exception)
+        if policy is None or retry >= policy.max_attempts:
+            return None
+        delay = random.uniform(0, policy.backoff(retry))
+        if self.max_time is not None and time.monotonic() - start + delay > self.max_time:
+            return None
+        if self.deadline is not None and delay >= self.deadline.remaining():
+            return None
+        if self.budget is not None and not self.budget.withdraw():
+            return None
+        return delay
@@ -8,24 +8,94 @@ Examples:
 
         (venv) ocs_ingest_frame --help
 
+    Ingest every file in a directory using 8 worker processes, printing the outcome of each file::
+
+        (venv) ocs_ingest_frame --processes 8 /data/night/
+
+    Check whether many files exist, printing a JSON report::
+
+        (venv) ocs_ingest_frame --check-only /data/night/*.fits.fz
+
+    Defer files that could not be ingested because of a retryable error to a spool, and drain it later::
+
+        (venv) ocs_ingest_frame --spool /var/spool/ingester.sqlite3 /data/night/
+        (venv) ocs_ingest_frame --spool /var/spool/ingester.sqlite3 --drain
+
+    Ingest a file through a running ocs_ingest_server, avoiding the cost of starting the ingester::
+
+        (venv) ocs_ingest_frame --server-socket /run/ocs_ingester.sock /data/night/frame.fits.fz
+
 """
+import os
 import sys
+import json
 import argparse
+import threading
 
-from ocs_ingester.ingester import frame_exists, upload_file_and_ingest_to_archive
+# Only light modules are imported up front. The ingester, which pulls in ocs_archive with astropy and boto3,
+# is imported by the code paths that ingest files, so that checking whether files exist starts quickly.
 from ocs_ingester.settings import settings
-from ocs_ingester.exceptions import NonFatalDoNotRetryError
+from ocs_ingester.utils.paths import expand_paths
+from ocs_ingester.utils.hashing import file_md5
+
+CHECK = 'check'
+INGEST = 'ingest'
+
+# Spools opened by handle_request, by path
+_spools = {}
+_spools_lock = threading.Lock()
 
 description = (
     'Upload a FITS file to the science archive of an observatory control system. This script will output the resulting '
     'URL if the upload is successful. An optional flag --check-only can be used to check for the existence of a file '
-    'without uploading it (based on md5).'
+    'without uploading it (based on md5). Many paths, directories or glob patterns may be given to ingest or check many '
+    'files at once, in which case the outcome of each file is output instead. Files that fail with a retryable error '
+    'may be deferred to a spool with --spool, and ingested again later with --drain.'
 )
 
 
+def check_frames_exist(paths, api_root=settings.API_ROOT, auth_token=settings.AUTH_TOKEN):
+    """Check which of the files at the given paths exist in the science archive.
+
+    Returns a report of the form ``{'exists': {path: bool}, 'errors': {path: str}}``, where files
+    that could not be read or checked are listed under errors.
+    """
+    from ocs_ingester.archive import ArchiveService
+
+    md5s = {}
+    errors = {}
+    for path in paths:
+        try:
+            with open(path, 'rb') as fileobj:
+                md5s[path] = file_md5(fileobj)
+        except Exception as e:
+            errors[path] = str(e)
+
+    exists = {}
+    try:
+        archive = ArchiveService(api_root=api_root, auth_token=auth_token)
+        versions = archive.versions_exist(md5s.values())
+        exists = {path: versions[md5] for path, md5 in md5s.items()}
+    except Exception as e:
+        errors.update({path: str(e) for path in md5s})
+    return {'exists': exists, 'errors': errors}
+
+
+def check_frame_exists(fileobj, api_root=settings.API_ROOT, auth_token=settings.AUTH_TOKEN):
+    """Check whether a file exists in the science archive, without parsing it.
+
+    Only the md5 of the file is computed, so that none of the modules needed to ingest a file are imported.
+    """
+    from ocs_ingester.archive import ArchiveService
+    from ocs_ingester.retry import get_retrier
+
+    archive = ArchiveService(api_root=api_root, auth_token=auth_token, retrier=get_retrier())
+    return archive.version_exists(file_md5(fileobj))
+
+
 def main():
     parser = argparse.ArgumentParser(description=description)
-    parser.add_argument('path', help='Path to file')
+    parser.add_argument('paths', nargs='*', metavar='path', help='Path to file, directory or glob pattern')
     parser.add_argument('--api-root', help='API root')
     parser.add_argument('--auth-token', help='API token')
     parser.add_argument('--bucket', help='S3 bucket name')
@@ -33,7 +103,25 @@ def main():
     parser.add_argument('--check-only', action='store_true', help='Only check if the frame exists in the archive. \
                                                                    returns a status code of 0 if found, 1 if not \
                                                                    (or an error occurred)')
+    parser.add_argument('--processes', type=int, default=os.cpu_count(),
+                        help='Number of worker processes used when ingesting many files')
+    parser.add_argument('--spool', default=settings.SPOOL_PATH or None,
+                        help='Path to a spool that files failing with a retryable error are deferred to')
+    parser.add_argument('--drain', action='store_true',
+                        help='Ingest the deferred files in the spool that are due, into the API root and bucket '
+                             'that each was deferred with')
+    parser.add_argument('--drain-rate', type=float, default=settings.SPOOL_DRAIN_RATE,
+                        help='Maximum number of deferred files whose ingest is started per second')
+    parser.add_argument('--server-socket', default=settings.INGEST_SERVER_SOCKET or None,
+                        help='Unix socket of an ocs_ingest_server to forward a single file to. The file is '
+                             'ingested by this process if no server is listening.')
     args = parser.parse_args()
+    if args.drain and not args.spool:
+        parser.error('--drain requires a --spool')
+    if args.drain and args.check_only:
+        parser.error('--drain cannot be used with --check-only')
+    if not args.paths and not args.drain:
+        parser.error('at least one path is required')
 
     # Submit metrics synchronously so that they all get submitted before the program exits
     settings.SUBMIT_METRICS_ASYNCHRONOUSLY = False
@@ -41,40 +129,105 @@ def main():
     if args.process_name:
         settings.EXTRA_METRICS_TAGS['ingester_process_name'] = args.process_name
 
+    check_args = {k: v for k, v in vars(args).items() if k in ['api_root', 'auth_token'] and v is not None}
+    ingest_args = {k: v for k, v in vars(args).items() if k in ['api_root', 'auth_token', 'bucket'] and v is not None}
+    paths = expand_paths(args.paths)
+    if not args.drain and paths == args.paths and len(paths) == 1:
+        request = {
+            'command': CHECK if args.check_only else INGEST,
+            'path': os.path.abspath(paths[0]),
+            'args': check_args if args.check_only else ingest_args,
+            'spool': os.path.abspath(args.spool) if args.spool and not args.check_only else None,
+        }
+        output, exit_code = run_request(request, args.server_socket)
+        sys.stdout.write(output)
+        sys.exit(exit_code)
+
+    if not paths and not args.drain:
+        sys.stdout.write('No files found')
+        sys.exit(1)
+    if args.check_only:
+        report = check_frames_exist(paths, **check_args)
+        sys.stdout.write(json.dumps(report))
+        sys.exit(int(bool(report['errors']) or not all(report['exists'].values())))
+
+    from ocs_ingester.batch import ingest_paths, RETRYABLE, FATAL
+    from ocs_ingester.spool import Spool, DEFERRED
+
+    spool = Spool(args.spool) if args.spool else None
+    outcomes = spool.drain(rate=args.drain_rate, **ingest_args) if args.drain else ingest_paths(
+        paths, processes=args.processes, **ingest_args
+    )
+    failed = False
+    for outcome in outcomes:
+        if outcome.status == RETRYABLE and spool is not None and not args.drain:
+            spool.defer(outcome.path, outcome.message, ingest_args)
+            outcome = outcome._replace(status=DEFERRED)
+        sys.stdout.write('{0}\t{1}\t{2}\n'.format(outcome.status, outcome.path, outcome.message))
+        failed = failed or outcome.status in (RETRYABLE, FATAL)
+    sys.exit(int(failed))
+
+
+def run_request(request, server_socket=None):
+    """Runs a request for a single file on the ingest server if one is listening, or in this process otherwise.
+
+    Returns:
+        tuple: The output and exit code of the request
+    """
+    if server_socket:
+        from ocs_ingester.server import forward_request
+        try:
+            return forward_request(server_socket, request)
+        except (OSError, ValueError):
+            # Repeating the request here is safe even if the server got part of the way, since a file that was
+            # already ingested is reported as such
+            pass
+    return handle_request(request)
+
+
+def handle_request(request):
+    """Checks or ingests a single file, returning the output and exit code of ocs_ingest_frame for it.
+
+    Args:
+        request (dict): The ``command``, either CHECK or INGEST, the ``path`` of the file, the ``args`` for
+            checking or ingesting it, and for ingests, the path of an optional ``spool`` that a file failing
+            with a retryable error is deferred to
+    """
+    path = request['path']
     try:
-        with open(args.path, 'rb') as fileobj:
-            if args.check_only:
-                try:
-                    check_args = {
-                        k: v for k, v in vars(args).items() if k in ['api_root', 'auth_token'] and v is not None
-                    }
-                    exists = frame_exists(fileobj, **check_args)
-
-                except Exception as e:
-                    sys.stdout.write(str(e))
-                    sys.exit(1)
-                sys.stdout.write(str(exists))
-                sys.exit(int(not exists))
-
-            try:
-                ingest_args = {
-                    k: v for k, v in vars(args).items() if k in ['api_root', 'auth_token', 'bucket'] and v is not None
-                }
-                result = upload_file_and_ingest_to_archive(fileobj=fileobj, path=args.path, **ingest_args)
-            except NonFatalDoNotRetryError as e:
-                sys.stdout.write(str(e))
-                sys.exit(0)
-            except Exception as e:
-                sys.stdout.write('Exception uploading file: ')
-                sys.stdout.write(str(e))
-                sys.exit(1)
-
-            sys.stdout.write(result['url'])
-            sys.exit(0)
+        with open(path, 'rb') as fileobj:
+            if request['command'] == CHECK:
+                exists = check_frame_exists(fileobj, **request['args'])
+                return str(exists), int(not exists)
+            return ingest_file(fileobj, path, request.get('spool'), request['args'])
+    except Exception as e:
+        return str(e), 1
 
+
+def ingest_file(fileobj, path, spool_path, ingest_args):
+    from ocs_ingester.ingester import upload_file_and_ingest_to_archive
+    from ocs_ingester.exceptions import NonFatalDoNotRetryError, BackoffRetryError, RetryError
+
+    try:
+        result = upload_file_and_ingest_to_archive(fileobj=fileobj, path=path, **ingest_args)
+    except NonFatalDoNotRetryError as e:
+        return str(e), 0
     except Exception as e:
-        sys.stdout.write(str(e))
-        sys.exit(1)
+        if spool_path and isinstance(e, (BackoffRetryError, RetryError)):
+            get_spool(spool_path).defer(path, e, ingest_args)
+            return 'Deferred ingest after error: {0}'.format(e), 0
+        return 'Exception uploading file: {0}'.format(e), 1
+    return result['url'], 0
+
+
+def get_spool(path):
+    """Returns the spool at path, opening it on first use. Spools are kept open for the life of the process."""
+    from ocs_ingester.spool import Spool
+
+    with _spools_lock:
+        if path not in _spools:
+            _spools[path] = Spool(path)
+        return _spools[path]
 
 
 if __name__ == '__main__':
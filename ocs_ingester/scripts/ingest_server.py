@@ -0,0 +1,73 @@
+#!/bin/env python3
+"""
+Command-line entrypoint to a resident server that ingests the files forwarded to it by ocs_ingest_frame.
+
+Examples:
+
+    See available options::
+
+        (venv) ocs_ingest_server --help
+
+    Serve on a socket, and forward files to it from ocs_ingest_frame::
+
+        (venv) ocs_ingest_server --socket /run/ocs_ingester.sock
+        (venv) INGEST_SERVER_SOCKET=/run/ocs_ingester.sock ocs_ingest_frame /data/night/frame.fits.fz
+
+"""
+import signal
+import logging
+import importlib
+import argparse
+import threading
+
+from ocs_ingester.archive import get_session
+from ocs_ingester.server import IngestServer
+from ocs_ingester.storage import warm_up_file_store, close_file_stores
+from ocs_ingester.scripts.ingest_frame import handle_request
+from ocs_ingester.settings import settings
+
+logger = logging.getLogger('ocs_ingester')
+
+description = (
+    'Serve requests to ingest files into the science archive of an observatory control system on a Unix domain '
+    'socket. ocs_ingest_frame forwards single files to the server when it is given the socket with --server-socket or '
+    'INGEST_SERVER_SOCKET, so that the ingester is only started once.'
+)
+
+
+def warm_up():
+    """Does the slow work of a first ingest up front, so that the first request is as quick as the rest."""
+    # The request handler only imports the ingester when a file is first ingested
+    importlib.import_module('ocs_ingester.ingester')
+    warm_up_file_store()
+    get_session(settings.API_ROOT)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--socket', default=settings.INGEST_SERVER_SOCKET or None,
+                        help='Path of the Unix socket to listen on')
+    parser.add_argument('--process-name', help='Tag set in collected metrics')
+    parser.add_argument('--workers', type=int, default=8, help='Number of files ingested at once')
+    args = parser.parse_args()
+    if not args.socket:
+        parser.error('a --socket is required')
+
+    if args.process_name:
+        settings.EXTRA_METRICS_TAGS['ingester_process_name'] = args.process_name
+
+    warm_up()
+    server = IngestServer(args.socket, handle_request, workers=args.workers)
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        # shutdown waits for serve_forever to return, so it must not be called from the thread running it
+        signal.signal(signum, lambda *_: threading.Thread(target=server.shutdown).start())
+    logger.info('Ingest server listening', extra={'tags': {'socket': args.socket}})
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        close_file_stores()
+
+
+if __name__ == '__main__':
+    main()
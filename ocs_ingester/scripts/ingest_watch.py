@@ -0,0 +1,74 @@
+#!/bin/env python3
+"""
+Command-line entrypoint that continuously ingests files as they land in directories.
+
+Examples:
+
+    See available options::
+
+        (venv) ocs_ingest_watch --help
+
+    Ingest files landing in a directory with 8 workers, moving them once they are in the archive::
+
+        (venv) ocs_ingest_watch --workers 8 --done-directory /data/ingested /data/landing
+
+"""
+import signal
+import argparse
+
+from ocs_ingester.watch import IngestWatcher
+from ocs_ingester.spool import Spool
+from ocs_ingester.storage import warm_up_file_store, close_file_stores
+from ocs_ingester.settings import settings
+
+description = (
+    'Watch directories and upload the FITS files that land in them to the science archive of an observatory control '
+    'system. Files are ingested once they have been completely written. Ingested files are left in place unless '
+    '--done-directory or --delete is given.'
+)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('directories', nargs='+', metavar='directory', help='Directory to watch')
+    parser.add_argument('--api-root', help='API root')
+    parser.add_argument('--auth-token', help='API token')
+    parser.add_argument('--bucket', help='S3 bucket name')
+    parser.add_argument('--process-name', help='Tag set in collected metrics')
+    parser.add_argument('--workers', type=int, default=4, help='Number of files ingested at once')
+    parser.add_argument('--queue-size', type=int, default=100,
+                        help='Maximum number of completely written files waiting to be ingested')
+    parser.add_argument('--settle-time', type=float, default=2.0,
+                        help='Seconds that a file must be unchanged before it is ingested')
+    parser.add_argument('--spool', default=settings.SPOOL_PATH or None,
+                        help='Path to a spool that files failing with a retryable error are deferred to')
+    after_ingest = parser.add_mutually_exclusive_group()
+    after_ingest.add_argument('--done-directory', help='Move files here once they are in the archive')
+    after_ingest.add_argument('--delete', action='store_true', help='Delete files once they are in the archive')
+    args = parser.parse_args()
+
+    if args.process_name:
+        settings.EXTRA_METRICS_TAGS['ingester_process_name'] = args.process_name
+
+    ingest_args = {k: v for k, v in vars(args).items() if k in ['api_root', 'auth_token', 'bucket'] and v is not None}
+    if args.done_directory:
+        ingest_args.update(after_ingest=IngestWatcher.MOVE, done_directory=args.done_directory)
+    elif args.delete:
+        ingest_args.update(after_ingest=IngestWatcher.DELETE)
+
+    if args.spool:
+        ingest_args['spool'] = Spool(args.spool)
+
+    watcher = IngestWatcher(args.directories, workers=args.workers, queue_size=args.queue_size,
+                            settle_time=args.settle_time, **ingest_args)
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *_: watcher.stop())
+    warm_up_file_store(bucket=args.bucket)
+    try:
+        watcher.run()
+    finally:
+        close_file_stores()
+
+
+if __name__ == '__main__':
+    main()
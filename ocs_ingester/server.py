@@ -0,0 +1,124 @@
+"""``server.py`` - Resident server that runs ingest requests forwarded over a Unix domain socket.
+
+Starting Python and importing the ingester, with astropy and boto3, takes longer than ingesting a small file.
+A resident server keeps the imports, file store clients and connection pools of one process warm, and runs
+the requests that short-lived processes forward to it. The ``ocs_ingest_frame`` command line entrypoint
+forwards single files to an ``ocs_ingest_server`` listening on INGEST_SERVER_SOCKET.
+
+Every connection carries one request and one response, each a line of JSON. The response holds the output
+and exit code that the request would have produced if it had been run by the forwarding process.
+
+This module only imports the standard library, so that forwarding a request stays cheap.
+
+Examples:
+    Serve requests with a handler that returns the output and exit code for each request:
+
+    >>> from ocs_ingester.server import IngestServer
+    >>> server = IngestServer('/run/ocs_ingester.sock', handler, workers=8)
+    >>> server.serve_forever()
+
+    Forward a request to the server:
+
+    >>> from ocs_ingester.server import forward_request
+    >>> output, exit_code = forward_request('/run/ocs_ingester.sock', {'command': 'check', 'path': path})
+
+"""
+import os
+import json
+import stat
+import errno
+import socket
+import logging
+import threading
+import socketserver
+
+logger = logging.getLogger('ocs_ingester')
+
+
+class IngestServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Unix domain socket server that runs each request with a handler, in a thread per connection.
+
+    A socket left behind by a server that is no longer running is replaced.
+
+    Args:
+        socket_path (str): Path of the socket to listen on
+        handler (callable): Called with each request, returning a tuple of its output and exit code
+        workers (int): Maximum number of requests that are handled at once
+
+    Raises:
+        OSError: If socket_path is not a socket, or another server is already listening on it
+    """
+    daemon_threads = True
+
+    def __init__(self, socket_path, handler, workers=8):
+        self.handler = handler
+        self._slots = threading.BoundedSemaphore(workers)
+        if os.path.exists(socket_path):
+            if not stat.S_ISSOCK(os.stat(socket_path).st_mode):
+                raise OSError(errno.EEXIST, 'Not a socket', socket_path)
+            if _is_listening(socket_path):
+                raise OSError(errno.EADDRINUSE, 'An ingest server is already listening', socket_path)
+            os.unlink(socket_path)
+        super().__init__(socket_path, _RequestHandler)
+
+    def handle_request_line(self, line):
+        try:
+            request = json.loads(line)
+            with self._slots:
+                output, exit_code = self.handler(request)
+        except Exception as e:
+            logger.exception('Ingest server failed to handle a request')
+            output, exit_code = str(e), 1
+        return {'output': output, 'exit_code': exit_code}
+
+    def server_close(self):
+        super().server_close()
+        try:
+            os.unlink(self.server_address)
+        except FileNotFoundError:
+            pass
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        response = self.server.handle_request_line(self.rfile.readline())
+        self.wfile.write(json.dumps(response).encode() + b'\n')
+
+
+def _is_listening(socket_path):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(socket_path)
+        except OSError:
+            return False
+        return True
+
+
+def forward_request(socket_path, request, connect_timeout=1.0):
+    """Sends a request to the server listening on socket_path and waits for its response.
+
+    Args:
+        socket_path (str): Path of the socket that the server listens on
+        request (dict): Request, which must be serializable to JSON
+        connect_timeout (float): Seconds to wait to connect to the server
+
+    Returns:
+        tuple: The output and exit code of the request
+
+    Raises:
+        OSError: If no server is listening on the socket, or the connection to it failed
+        ValueError: If the server did not send a complete response
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(connect_timeout)
+        sock.connect(socket_path)
+        # An ingest may take a while, so wait as long as it takes once connected
+        sock.settimeout(None)
+        sock.sendall(json.dumps(request).encode() + b'\n')
+        with sock.makefile('rb') as response_file:
+            line = response_file.readline()
+    try:
+        response = json.loads(line)
+        return response['output'], response['exit_code']
+    except (ValueError, KeyError, TypeError):
+        raise ValueError('Incomplete response from ingest server on {0}'.format(socket_path))
@@ -6,6 +6,98 @@ import ast
 API_ROOT = os.getenv('API_ROOT', 'http://127.0.0.1:8000/')
 AUTH_TOKEN = os.getenv('AUTH_TOKEN', 'c158b4f055c5abdd9f520c8501159478f6f738ac')
 
+# Connection pooling for the science archive API. A single pooled session is shared by every
+# ArchiveService in the process that uses the same API root.
+ARCHIVE_POOL_SIZE = int(os.getenv('ARCHIVE_POOL_SIZE', 10))
+ARCHIVE_KEEP_ALIVE = ast.literal_eval(os.getenv('ARCHIVE_KEEP_ALIVE', 'True'))
+ARCHIVE_CONNECT_TIMEOUT = float(os.getenv('ARCHIVE_CONNECT_TIMEOUT', 5))
+ARCHIVE_READ_TIMEOUT = float(os.getenv('ARCHIVE_READ_TIMEOUT', 60))
+
+# Number of md5s checked per request when checking for many versions at once
+ARCHIVE_VERSIONS_CHUNK_SIZE = int(os.getenv('ARCHIVE_VERSIONS_CHUNK_SIZE', 100))
+
+# Optional endpoint, relative to the API root, that accepts a list of frames to create at once. Frames are posted
+# individually when this is not set or the archive does not support it.
+ARCHIVE_BULK_FRAMES_PATH = os.getenv('ARCHIVE_BULK_FRAMES_PATH', '')
+
+# Serializer of the records posted to the science archive: 'auto' uses orjson when it is installed and the
+# standard library otherwise, 'orjson' or 'json' pick one, and any other value is the dotted path of a function
+# that serializes data to JSON bytes. Bodies of at least ARCHIVE_GZIP_MIN_SIZE bytes are sent gzip compressed,
+# and are sent uncompressed again if the archive does not accept them. A size of 0 disables compression.
+ARCHIVE_JSON_SERIALIZER = os.getenv('ARCHIVE_JSON_SERIALIZER', 'auto')
+ARCHIVE_GZIP_MIN_SIZE = int(os.getenv('ARCHIVE_GZIP_MIN_SIZE', 0))
+
+# Files of at least MULTIPART_THRESHOLD bytes are uploaded to S3 in parts of MULTIPART_PART_SIZE bytes,
+# MULTIPART_CONCURRENCY parts at a time. A threshold of 0 disables multipart uploads.
+MULTIPART_THRESHOLD = int(os.getenv('MULTIPART_THRESHOLD', 64 * 1024 * 1024))
+MULTIPART_PART_SIZE = int(os.getenv('MULTIPART_PART_SIZE', 16 * 1024 * 1024))
+MULTIPART_CONCURRENCY = int(os.getenv('MULTIPART_CONCURRENCY', 4))
+
+# Seconds to wait when connecting to S3, and for each response from it
+S3_CONNECT_TIMEOUT = float(os.getenv('S3_CONNECT_TIMEOUT', 5))
+S3_READ_TIMEOUT = float(os.getenv('S3_READ_TIMEOUT', 60))
+
+# Optional on-disk index of md5s known to exist in the science archive, checked before asking the archive.
+# Entries are trusted for MD5_INDEX_TTL seconds. The index is disabled when no path is set.
+MD5_INDEX_PATH = os.getenv('MD5_INDEX_PATH', '')
+MD5_INDEX_TTL = float(os.getenv('MD5_INDEX_TTL', 7 * 24 * 60 * 60))
+
+# Retries of calls that fail with a BackoffRetryError or RetryError. Calls are attempted at most
+# RETRY_MAX_ATTEMPTS times, so the default of 1 leaves retrying to the caller. Retries use a jittered
+# exponential backoff from RETRY_BASE_DELAY up to RETRY_MAX_DELAY seconds, and are not started more than
+# RETRY_MAX_TIME seconds after the first attempt. Every process, along with the worker processes that it
+# ingests files with, shares a budget of retries, which earns RETRY_BUDGET_RATIO retries per call and
+# RETRY_BUDGET_PER_SECOND retries per second, up to RETRY_BUDGET_CAPACITY retries.
+RETRY_MAX_ATTEMPTS = int(os.getenv('RETRY_MAX_ATTEMPTS', 1))
+RETRY_BASE_DELAY = float(os.getenv('RETRY_BASE_DELAY', 1))
+RETRY_MAX_DELAY = float(os.getenv('RETRY_MAX_DELAY', 60))
+RETRY_MAX_TIME = float(os.getenv('RETRY_MAX_TIME', 300))
+RETRY_BUDGET_RATIO = float(os.getenv('RETRY_BUDGET_RATIO', 0.2))
+RETRY_BUDGET_PER_SECOND = float(os.getenv('RETRY_BUDGET_PER_SECOND', 1))
+RETRY_BUDGET_CAPACITY = float(os.getenv('RETRY_BUDGET_CAPACITY', 10))
+
+# Optional on-disk journal of files that were uploaded but whose record was not yet posted to the science
+# archive, so that a later ingest of the file does not upload it again. Checkpoints are trusted for
+# CHECKPOINT_TTL seconds. The journal is disabled when no path is set.
+CHECKPOINT_PATH = os.getenv('CHECKPOINT_PATH', '')
+CHECKPOINT_TTL = float(os.getenv('CHECKPOINT_TTL', 24 * 60 * 60))
+
+# Optional on-disk spool that the command line entrypoints defer files to when they fail with a retryable
+# error. Deferred files become eligible again after a jittered exponential backoff from SPOOL_BASE_DELAY up
+# to SPOOL_MAX_DELAY seconds, and are given up on after SPOOL_MAX_ATTEMPTS attempts. The spool is drained
+# at up to SPOOL_DRAIN_RATE ingests per second. Without a spool, the ingest watcher tries files again itself with
+# the same backoff.
+SPOOL_PATH = os.getenv('SPOOL_PATH', '')
+SPOOL_BASE_DELAY = float(os.getenv('SPOOL_BASE_DELAY', 30))
+SPOOL_MAX_DELAY = float(os.getenv('SPOOL_MAX_DELAY', 60 * 60))
+SPOOL_MAX_ATTEMPTS = int(os.getenv('SPOOL_MAX_ATTEMPTS', 20))
+SPOOL_DRAIN_RATE = float(os.getenv('SPOOL_DRAIN_RATE', 5))
+
+# Unix socket of a resident ocs_ingest_server. When set, ocs_ingest_frame forwards single files to the
+# server if it is running, and ingests them itself otherwise.
+INGEST_SERVER_SOCKET = os.getenv('INGEST_SERVER_SOCKET', '')
+
+# Seconds between sending summaries of the metrics aggregated in memory, which are also sent when the process
+# exits. The default of 0 sends every metric as it is recorded.
+METRICS_FLUSH_INTERVAL = float(os.getenv('METRICS_FLUSH_INTERVAL', 0))
+
+# Whether to hash a file, and then check whether it already exists in the science archive, in a separate thread
+# while its headers and WCS are parsed. Does not apply to streaming ingests, which hash the file while uploading it.
+INGEST_CONCURRENT_STAGES = ast.literal_eval(os.getenv('INGEST_CONCURRENT_STAGES', 'False'))
+
+# Whether to upload a file while checking whether it already exists in the science archive, rather than after.
+# An unneeded upload is removed again from S3. Suits files that are rarely ingested twice, such as fresh data from
+# a telescope. Does not apply to streaming ingests, which always upload before checking.
+INGEST_SPECULATIVE_UPLOADS = ast.literal_eval(os.getenv('INGEST_SPECULATIVE_UPLOADS', 'False'))
+
+# Seconds that a whole ingest, including its retries, may take before it fails with a BackoffRetryError. Requests
+# to the science archive are given what remains of it as their timeout. Set to 0 for no deadline.
+INGEST_DEADLINE = float(os.getenv('INGEST_DEADLINE', 0))
+
+# Whether to send the time spent in each stage of every ingest as metrics, tagged with the instrument and
+# file extension. The stage timings are returned with the result of every ingest either way.
+INGEST_STAGE_METRICS = ast.literal_eval(os.getenv('INGEST_STAGE_METRICS', 'False'))
+
 # Whether to submit the metrics asynchronously
 SUBMIT_METRICS_ASYNCHRONOUSLY = ast.literal_eval(os.getenv('SUBMIT_METRICS_ASYNCHRONOUSLY', 'False'))
 
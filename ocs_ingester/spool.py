@@ -0,0 +1,152 @@
+"""``spool.py`` - Durable local spool of ingests deferred after a retryable error.
+
+When the science archive or file store is unavailable, files can be deferred to a spool instead of being
+retried straight away, so that new files keep being accepted at full speed during an outage. The spool is
+a SQLite database that records the path of each deferred file and the arguments it was ingested with, together
+with the last error, the number of attempts and when it may next be tried. Deferred files are ingested again by draining the spool, which
+starts at most a given number of ingests per second so that a recovering archive is not overloaded.
+
+Only the path of a deferred file is spooled, so the file must stay in place until it has been drained. Of the
+arguments of the ingest, only those in SPOOLED_ARGS are spooled: the auth_token is left out so that it is never
+written to disk, and is taken from the arguments that the spool is drained with instead.
+
+Examples:
+    Defer a file that could not be ingested, and drain the spool once the archive is back:
+
+    >>> from ocs_ingester.spool import Spool
+    >>> spool = Spool('/var/spool/ingester.sqlite3')
+    >>> spool.defer('/data/landing/frame.fits.fz', 'Archive unavailable', {'bucket': 'raw-data'})
+    >>> for outcome in spool.drain(rate=5, auth_token=auth_token):
+    >>>     print(outcome.status, outcome.path)
+
+"""
+import json
+import time
+import random
+import logging
+from collections import namedtuple
+
+from ocs_ingester.batch import ingest_path, IngestOutcome, RETRYABLE
+from ocs_ingester.retry import RetryPolicy
+from ocs_ingester.utils.local_state import LocalDatabase
+from ocs_ingester.settings import settings as ingester_settings
+
+logger = logging.getLogger('ocs_ingester')
+
+DEFERRED = 'deferred'
+
+# Arguments of upload_file_and_ingest_to_archive that are spooled with a deferred file and used to drain it
+SPOOLED_ARGS = ('api_root', 'bucket', 'streaming', 'concurrent', 'speculative', 'deadline')
+
+SpoolEntry = namedtuple(
+    'SpoolEntry', ['path', 'error', 'attempts', 'next_eligible', 'first_deferred', 'ingest_args']
+)
+
+
+class Spool(LocalDatabase):
+    """SQLite backed spool of deferred ingests.
+
+    Args:
+        path (str): Path to the SQLite database, which is created if it does not exist
+        backoff (ocs_ingester.retry.RetryPolicy): Policy for when a deferred file is next eligible, and after
+            how many attempts it is given up on
+    """
+    def __init__(self, path, backoff=None):
+        super().__init__(
+            path,
+            # Make sure a deferred file is on disk before the ingest is reported as deferred
+            'PRAGMA synchronous=FULL',
+            'CREATE TABLE IF NOT EXISTS deferred ('
+            'path TEXT PRIMARY KEY, error TEXT NOT NULL, attempts INTEGER NOT NULL, '
+            'next_eligible REAL NOT NULL, first_deferred REAL NOT NULL, ingest_args TEXT NOT NULL)',
+            'CREATE INDEX IF NOT EXISTS deferred_next_eligible ON deferred (next_eligible)'
+        )
+        self.backoff = backoff or RetryPolicy(
+            max_attempts=ingester_settings.SPOOL_MAX_ATTEMPTS, base_delay=ingester_settings.SPOOL_BASE_DELAY,
+            max_delay=ingester_settings.SPOOL_MAX_DELAY
+        )
+
+    def defer(self, path, error, ingest_args=None, now=None):
+        """Records that ingesting the file at path failed with a retryable error.
+
+        Args:
+            path (str): Path to the file
+            error (str or Exception): The retryable error
+            ingest_args (dict): Arguments that the file was ingested with, of which those in SPOOLED_ARGS
+                are used again when the spool is drained
+
+        Returns:
+            SpoolEntry: The spooled entry, with the time after which it may be tried again
+        """
+        now = time.time() if now is None else now
+        ingest_args = {key: value for key, value in (ingest_args or {}).items() if key in SPOOLED_ARGS}
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT attempts, first_deferred FROM deferred WHERE path = ?', [path]
+            ).fetchone()
+            attempts, first_deferred = (row[0] + 1, row[1]) if row else (1, now)
+            # Jitter so that files deferred together are not all eligible at the same time
+            next_eligible = now + random.uniform(0.5, 1) * self.backoff.backoff(attempts)
+            self._connection.execute(
+                'INSERT OR REPLACE INTO deferred (path, error, attempts, next_eligible, first_deferred, ingest_args) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                [path, str(error), attempts, next_eligible, first_deferred, json.dumps(ingest_args)]
+            )
+        return SpoolEntry(path, str(error), attempts, next_eligible, first_deferred, ingest_args)
+
+    def due(self, limit=100, now=None):
+        """Returns up to limit entries that may be tried again, the longest waiting first."""
+        now = time.time() if now is None else now
+        with self._lock:
+            rows = self._connection.execute(
+                'SELECT path, error, attempts, next_eligible, first_deferred, ingest_args FROM deferred '
+                'WHERE next_eligible <= ? ORDER BY next_eligible LIMIT ?', [now, limit]
+            ).fetchall()
+        return [SpoolEntry(*row[:-1], json.loads(row[-1])) for row in rows]
+
+    def remove(self, path):
+        with self._lock:
+            self._connection.execute('DELETE FROM deferred WHERE path = ?', [path])
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute('SELECT COUNT(*) FROM deferred').fetchone()[0]
+
+    def drain(self, rate=ingester_settings.SPOOL_DRAIN_RATE, **kwargs):
+        """Ingests the deferred files that are due, starting at most rate ingests per second.
+
+        Each file is ingested with the arguments that were spooled with it, on top of the given ones. Files that
+        fail with a retryable error again are deferred again, unless they have been attempted the maximum number
+        of times. Every other file is removed from the spool.
+
+        Args:
+            rate (float): Maximum number of ingests started per second
+            kwargs: Extra arguments for :func:`ocs_ingester.ingester.upload_file_and_ingest_to_archive`, such as
+                the auth_token, which is never spooled
+
+        Yields:
+            IngestOutcome: The outcome of each file, with the DEFERRED status if it was deferred again
+        """
+        interval = 1.0 / rate if rate > 0 else 0
+        next_start = time.monotonic()
+        seen = set()
+        while True:
+            entries = [entry for entry in self.due() if entry.path not in seen]
+            if not entries:
+                return
+            for entry in entries:
+                seen.add(entry.path)
+                time.sleep(max(0.0, next_start - time.monotonic()))
+                next_start = max(next_start, time.monotonic()) + interval
+                yield self._replay(entry, **kwargs)
+
+    def _replay(self, entry, **kwargs):
+        outcome = ingest_path(entry.path, **dict(kwargs, **entry.ingest_args))
+        if outcome.status == RETRYABLE:
+            if entry.attempts + 1 < self.backoff.max_attempts:
+                self.defer(entry.path, outcome.message, entry.ingest_args)
+                return IngestOutcome(entry.path, DEFERRED, outcome.message)
+            logger.error('Giving up on deferred ingest after {0} attempts'.format(entry.attempts + 1),
+                         extra={'tags': {'filename': entry.path}})
+        self.remove(entry.path)
+        return outcome
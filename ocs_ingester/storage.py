@@ -0,0 +1,340 @@
+"""``storage.py`` - File stores used by the ingester.
+
+Files are stored with the file stores of the ocs_archive library, except that S3 uploads reuse one client per
+file store, and uploads of large files are split into parts that are uploaded concurrently. Uploads are bounded by
+the deadline that is current while they run: S3 requests are given what is left of it as their timeouts, without
+retries of their own, and files are copied into a file system store in chunks that each check it.
+
+File stores are created once per process for each configuration and shared between threads, so that S3
+clients, their credentials and their connection pools are reused for every file. Long running processes can
+create their file store up front with :func:`warm_up_file_store`, and close it with :func:`close_file_stores`.
+"""
+import os
+import math
+import base64
+import hashlib
+import logging
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from dateutil.parser import parse
+
+from ocs_ingester.deadline import get_current_deadline
+from ocs_ingester.utils.local_state import ProcessLocal
+from ocs_ingester.settings import settings as ingester_settings
+
+from ocs_archive.settings import settings as archive_settings
+from ocs_archive.storage.filestorefactory import FileStoreFactory
+from ocs_archive.storage.filestore import FileStoreConnectionError
+from ocs_archive.storage.filesystemstore import FileSystemStore
+from ocs_archive.storage.s3store import S3Store, strip_quotes_from_etag
+
+logger = logging.getLogger('ocs_ingester')
+
+# File stores keyed by their configuration, shared by every ingest in this process
+_file_stores = ProcessLocal()
+
+# Bytes copied into a file system store between checks of the deadline
+FILESYSTEM_CHUNK_SIZE = 8 * 1024 * 1024
+
+
+def get_file_store(filestore_type=None, bucket=None):
+    """Returns the file store for the given configuration, uploading large files to S3 in parts.
+
+    The file store is created on first use and reused by every caller in the process that asks for the same
+    configuration. A forked child process creates its own file stores rather than sharing clients with its
+    parent.
+
+    Args:
+        filestore_type (str): Type of file store, defaults to the FILESTORE_TYPE setting of ocs_archive
+        bucket (str): S3 bucket, defaults to the BUCKET setting of ocs_archive
+
+    Raises:
+        ocs_archive.storage.filestore.FileStoreSpecificationError: If the file store type is invalid
+    """
+    filestore_class = FileStoreFactory.get_file_store_class(filestore_type or archive_settings.FILESTORE_TYPE)
+    if filestore_class is S3Store:
+        filestore_class = MultipartS3Store
+        config = {'bucket': bucket or archive_settings.BUCKET, 'endpoint_url': archive_settings.S3_ENDPOINT_URL}
+    elif filestore_class is FileSystemStore:
+        filestore_class = ChunkedFileSystemStore
+        config = {'root_dir': archive_settings.FILESYSTEM_STORAGE_ROOT_DIR}
+    else:
+        config = {}
+    key = (filestore_class, tuple(sorted(config.items())))
+    with _file_stores.lock:
+        filestores = _file_stores.get(dict)
+        filestore = filestores.get(key)
+        if filestore is None:
+            filestore = filestores[key] = filestore_class(**config)
+        return filestore
+
+
+def warm_up_file_store(filestore_type=None, bucket=None):
+    """Creates the file store for the given configuration, along with its client, ahead of the first upload."""
+    filestore = get_file_store(filestore_type, bucket)
+    if isinstance(filestore, MultipartS3Store):
+        # Creating the client resolves the credentials
+        filestore.client
+    return filestore
+
+
+def close_file_stores():
+    """Closes every file store created by this process, dropping their connections."""
+    with _file_stores.lock:
+        filestores = _file_stores.get(dict)
+        for filestore in filestores.values():
+            if isinstance(filestore, MultipartS3Store):
+                filestore.close()
+        filestores.clear()
+
+
+def create_s3_client(endpoint_url=None, read_timeout=None):
+    """Returns a new S3 client configured by the S3 settings of ocs_archive.
+
+    Args:
+        endpoint_url (str): S3 endpoint, defaults to the S3_ENDPOINT_URL setting of ocs_archive
+        read_timeout (float): Read timeout of a client for uploads with a deadline, which is also its connect
+            timeout at most, and which makes a single attempt of each request. Defaults to the S3_READ_TIMEOUT
+            setting, with the retries of boto.
+    """
+    timeouts = {
+        'connect_timeout': ingester_settings.S3_CONNECT_TIMEOUT, 'read_timeout': ingester_settings.S3_READ_TIMEOUT
+    }
+    if read_timeout is not None:
+        # Retries are left to the retrier of the ingest, which does not start one that would outlast the deadline
+        timeouts = {
+            'connect_timeout': min(ingester_settings.S3_CONNECT_TIMEOUT, read_timeout), 'read_timeout': read_timeout,
+            'retries': {'total_max_attempts': 1}
+        }
+    config = boto3.session.Config(
+        signature_version=archive_settings.S3_SIGNATURE_VERSION,
+        s3={'addressing_style': archive_settings.S3_ADDRESSING_STYLE},
+        **timeouts
+    )
+    region = archive_settings.AWS_DEFAULT_REGION if archive_settings.S3_ADDRESSING_STYLE == 'path' else None
+    return boto3.client('s3', region or None, endpoint_url=endpoint_url or archive_settings.S3_ENDPOINT_URL,
+                        config=config)
+
+
+def multipart_etag(part_digests):
+    """Returns the ETag that S3 gives an object uploaded in parts with the given md5 digests."""
+    return '{0}-{1}'.format(hashlib.md5(b''.join(part_digests)).hexdigest(), len(part_digests))
+
+
+class MultipartS3Store(S3Store):
+    """S3 file store that reuses one client, and uploads files of at least MULTIPART_THRESHOLD bytes in parts.
+
+    The client is created on first use, and is shared by every thread using the file store. Uploads with a
+    current deadline use a client whose timeouts are cut down to what is left of it instead, and that does not
+    retry. Such clients are kept for read timeouts that are a power of two seconds, rounded down from the time
+    left, so that only a few of them are ever created. In a multipart
+    upload, the file is read once, in order, to compute its md5 while parts of MULTIPART_PART_SIZE bytes are
+    uploaded by up to MULTIPART_CONCURRENCY threads. Each part is checked against its md5 by S3, and the
+    ETag of the assembled object is checked against the ETag expected from the parts. The returned version
+    holds the md5 of the whole file, like a single part upload. A multipart upload is aborted if the deadline
+    of the ingest passes before all of its parts have been started.
+
+    Args:
+        bucket (str): S3 bucket
+        endpoint_url (str): S3 endpoint, defaults to the S3_ENDPOINT_URL setting of ocs_archive
+        client: S3 client to use instead of creating one
+    """
+    def __init__(self, bucket=archive_settings.BUCKET, endpoint_url=None, client=None):
+        super().__init__(bucket)
+        self.endpoint_url = endpoint_url
+        self._client = client
+        # Clients for uploads with a deadline, keyed by their read timeout
+        self._deadline_clients = {}
+        self._client_lock = threading.Lock()
+
+    @property
+    def client(self):
+        with self._client_lock:
+            if self._client is None:
+                self._client = create_s3_client(self.endpoint_url)
+            return self._client
+
+    def client_for(self, deadline):
+        """Returns the client for an upload with the given deadline, or the shared client if it is None.
+
+        Raises:
+            ocs_ingester.exceptions.BackoffRetryError: If the deadline has already passed
+        """
+        if deadline is None:
+            return self.client
+        read_timeout = deadline.timeout(ingester_settings.S3_READ_TIMEOUT, 'uploading the file')
+        if read_timeout < ingester_settings.S3_READ_TIMEOUT:
+            read_timeout = 2.0 ** math.floor(math.log2(read_timeout))
+        with self._client_lock:
+            client = self._deadline_clients.get(read_timeout)
+            if client is None:
+                client = self._deadline_clients[read_timeout] = create_s3_client(self.endpoint_url, read_timeout)
+            return client
+
+    def close(self):
+        with self._client_lock:
+            for client in [self._client] + list(self._deadline_clients.values()):
+                if client is not None:
+                    client.close()
+            self._client = None
+            self._deadline_clients.clear()
+
+    def store_file(self, data_file):
+        client = self.client_for(get_current_deadline())
+        threshold = ingester_settings.MULTIPART_THRESHOLD
+        if threshold <= 0 or len(data_file.open_file) < threshold:
+            return self.store_file_single(data_file, client)
+        return self.store_file_multipart(data_file, client)
+
+    def store_file_single(self, data_file, client=None):
+        # The same upload as S3Store.store_file, without creating a new client for every file
+        client = client or self.client
+        storage_class = self.get_storage_class(parse(data_file.get_header_data().get_observation_date()))
+        filename = '{0}{1}'.format(data_file.open_file.basename, data_file.open_file.extension)
+        try:
+            response = client.put_object(
+                Bucket=self.bucket,
+                Key=data_file.get_filestore_path(),
+                Body=data_file.open_file.get_from_start(),
+                ContentDisposition='attachment; filename={0}'.format(filename),
+                ContentType=data_file.get_filestore_content_type(),
+                StorageClass=storage_class,
+            )
+        except Exception as exc:
+            raise FileStoreConnectionError(exc)
+        logger.info('Ingester uploaded file to s3', extra={
+            'tags': {
+                'filename': filename,
+                'key': response['VersionId'],
+                'storage_class': storage_class,
+            }
+        })
+        return {
+            'key': response['VersionId'],
+            'md5': strip_quotes_from_etag(response['ETag']),
+            'extension': data_file.open_file.extension
+        }
+
+    def delete_file(self, path, version_id):
+        self.client.delete_object(Bucket=self.bucket, Key=path, VersionId=version_id)
+
+    def store_file_multipart(self, data_file, client=None):
+        client = client or self.client
+        key = data_file.get_filestore_path()
+        storage_class = self.get_storage_class(parse(data_file.get_header_data().get_observation_date()))
+        try:
+            upload_id = client.create_multipart_upload(
+                Bucket=self.bucket,
+                Key=key,
+                ContentDisposition='attachment; filename={0}{1}'.format(
+                    data_file.open_file.basename, data_file.open_file.extension
+                ),
+                ContentType=data_file.get_filestore_content_type(),
+                StorageClass=storage_class,
+            )['UploadId']
+        except Exception as exc:
+            raise FileStoreConnectionError(exc)
+
+        try:
+            md5, parts = self._upload_parts(client, key, upload_id, data_file.open_file.get_from_start())
+            response = client.complete_multipart_upload(
+                Bucket=self.bucket,
+                Key=key,
+                UploadId=upload_id,
+                MultipartUpload={'Parts': [
+                    {'ETag': '"{0}"'.format(digest.hex()), 'PartNumber': number} for number, digest in parts
+                ]}
+            )
+        except Exception as exc:
+            try:
+                client.abort_multipart_upload(Bucket=self.bucket, Key=key, UploadId=upload_id)
+            except Exception:
+                logger.warning('Ingester could not abort multipart upload', extra={'tags': {'key': key}})
+            raise FileStoreConnectionError(exc)
+
+        if strip_quotes_from_etag(response['ETag']) != multipart_etag([digest for _, digest in parts]):
+            raise FileStoreConnectionError('S3 ETag of the assembled upload did not match its parts')
+        logger.info('Ingester uploaded file to s3 in parts', extra={
+            'tags': {
+                'filename': '{}{}'.format(data_file.open_file.basename, data_file.open_file.extension),
+                'key': response['VersionId'],
+                'storage_class': storage_class,
+                'parts': len(parts),
+            }
+        })
+        return {'key': response['VersionId'], 'md5': md5, 'extension': data_file.open_file.extension}
+
+    def _upload_parts(self, client, key, upload_id, fileobj):
+        concurrency = ingester_settings.MULTIPART_CONCURRENCY
+        # Bound the number of parts held in memory to those being uploaded plus the one being read
+        slots = threading.BoundedSemaphore(concurrency + 1)
+        md5 = hashlib.md5()
+        futures = []
+        failed = threading.Event()
+        deadline = get_current_deadline()
+
+        def upload_part(number, data):
+            try:
+                digest = hashlib.md5(data).digest()
+                response = client.upload_part(
+                    Bucket=self.bucket, Key=key, UploadId=upload_id, PartNumber=number, Body=data,
+                    ContentMD5=base64.b64encode(digest).decode()
+                )
+                if strip_quotes_from_etag(response['ETag']) != digest.hex():
+                    raise FileStoreConnectionError('S3 md5 of part {0} did not match ours'.format(number))
+                return number, digest
+            except Exception:
+                failed.set()
+                raise
+            finally:
+                slots.release()
+
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            number = 1
+            while not failed.is_set():
+                if deadline is not None:
+                    deadline.check('uploading part {0}'.format(number))
+                slots.acquire()
+                data = fileobj.read(ingester_settings.MULTIPART_PART_SIZE)
+                if not data:
+                    slots.release()
+                    break
+                md5.update(data)
+                futures.append(executor.submit(upload_part, number, data))
+                number += 1
+        return md5.hexdigest(), [future.result() for future in futures]
+
+
+class ChunkedFileSystemStore(FileSystemStore):
+    """File system store that copies files in chunks, checking the current deadline before each of them.
+
+    A file is copied to a temporary file next to its path, which is moved into place once it is complete, so
+    that a copy stopped by the deadline never leaves part of a file behind.
+
+    Args:
+        root_dir (str): Directory that files are stored in
+    """
+    def store_file(self, data_file):
+        deadline = get_current_deadline()
+        md5 = data_file.open_file.get_md5()
+        path = os.path.join(self.root_dir, data_file.get_filestore_path())
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fileobj = data_file.open_file.get_from_start()
+        descriptor, partial_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.ocs_ingester_')
+        try:
+            with os.fdopen(descriptor, 'wb') as partial_file:
+                while True:
+                    if deadline is not None:
+                        deadline.check('copying the file')
+                    data = fileobj.read(FILESYSTEM_CHUNK_SIZE)
+                    if not data:
+                        break
+                    partial_file.write(data)
+            os.replace(partial_path, path)
+        except Exception:
+            os.remove(partial_path)
+            raise
+        return {'key': md5, 'md5': md5, 'extension': data_file.open_file.extension}
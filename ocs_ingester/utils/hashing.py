@@ -0,0 +1,52 @@
+import os
+import hashlib
+
+HASH_CHUNK_SIZE = 8 * 1024 * 1024
+
+
+class HashingReader(object):
+    """File-like wrapper that computes the md5 of a file while it is being read.
+
+    Only bytes that continue on from the part of the file already hashed are added to the md5, so the
+    file can be seeked and reread, for example by a retried upload, without affecting the result. Any
+    part of the file that was never read is hashed when the md5 is requested.
+    """
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self._md5 = hashlib.md5()
+        self._hashed = 0
+
+    def __getattr__(self, name):
+        return getattr(self.fileobj, name)
+
+    def read(self, size=-1):
+        position = self.fileobj.tell()
+        data = self.fileobj.read(size)
+        self._update(position, data)
+        return data
+
+    def _update(self, position, data):
+        if position <= self._hashed < position + len(data):
+            self._md5.update(data[self._hashed - position:])
+            self._hashed = position + len(data)
+
+    def hexdigest(self):
+        position = self.fileobj.tell()
+        self.fileobj.seek(self._hashed)
+        data = self.fileobj.read(HASH_CHUNK_SIZE)
+        while data:
+            self._update(self._hashed, data)
+            data = self.fileobj.read(HASH_CHUNK_SIZE)
+        self.fileobj.seek(position, os.SEEK_SET)
+        return self._md5.hexdigest()
+
+
+def file_md5(fileobj):
+    """Returns the md5 of a file-like object, reading it from the start in chunks."""
+    fileobj.seek(0)
+    md5 = hashlib.md5()
+    data = fileobj.read(HASH_CHUNK_SIZE)
+    while data:
+        md5.update(data)
+        data = fileobj.read(HASH_CHUNK_SIZE)
+    return md5.hexdigest()
@@ -0,0 +1,63 @@
+"""``local_state.py`` - State that the ingester keeps in each process and on local disk.
+
+:class:`ProcessLocal` holds a value shared by every thread of a process, such as a pool of connections, that a
+forked child process creates again instead of sharing with its parent. :class:`LocalDatabase` is the base of the
+SQLite databases that the ingester keeps on local disk, such as the md5 index, checkpoint journal and spool.
+"""
+import os
+import sqlite3
+import threading
+
+
+class ProcessLocal(object):
+    """A value created on first use and shared by every thread of the process that created it.
+
+    Connections, threads and locks do not survive a fork, so a forked child process creates its own value
+    rather than using the one of its parent. Callers that change the value in place hold the lock while they do.
+    """
+    def __init__(self):
+        self.lock = threading.RLock()
+        self._value = None
+        self._pid = None
+
+    def get(self, create, stale=None):
+        """Return the value of this process, calling create for a new one if there is none yet.
+
+        Args:
+            create (callable): Returns a new value
+            stale (callable): Returns whether the existing value it is given must be replaced by a new one
+        """
+        with self.lock:
+            if self._pid != os.getpid() or (stale is not None and stale(self._value)):
+                self._value = create()
+                self._pid = os.getpid()
+            return self._value
+
+    def set(self, value):
+        """Make the value the one of this process."""
+        with self.lock:
+            self._value = value
+            self._pid = os.getpid()
+
+
+class LocalDatabase(object):
+    """SQLite database on local disk, shared between threads through one connection in WAL mode.
+
+    Subclasses run their statements on ``_connection`` while holding ``_lock``.
+
+    Args:
+        path (str): Path to the SQLite database, which is created if it does not exist
+        *statements (str): Statements run when the database is opened, such as those creating its tables
+    """
+    def __init__(self, path, *statements):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        with self._lock:
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            for statement in statements:
+                self._connection.execute(statement)
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
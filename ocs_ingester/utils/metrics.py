@@ -1,15 +1,226 @@
+import time
+import atexit
+import contextlib
+import random
+import logging
 import functools
+import threading
+import multiprocessing.util
 from datetime import datetime
 
+from opentsdb_python_metrics import metric_wrappers
 from opentsdb_python_metrics.metric_wrappers import metric_timer_with_tags, send_tsdb_metric
 
+from ocs_ingester.utils.local_state import ProcessLocal
 from ocs_ingester.settings import settings as ingester_settings
 
+logger = logging.getLogger('ocs_ingester')
+
+# The process-wide aggregator, started on first use
+_aggregator = ProcessLocal()
+
+
+class _Histogram(object):
+    # Keeps exact count, sum and max, and a uniform sample of the values for percentiles
+    MAX_SAMPLES = 1024
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = None
+        self.samples = []
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.max = value if self.max is None else max(self.max, value)
+        if len(self.samples) < self.MAX_SAMPLES:
+            self.samples.append(value)
+        else:
+            index = random.randrange(self.count)
+            if index < self.MAX_SAMPLES:
+                self.samples[index] = value
+
+    def percentile(self, percent):
+        samples = sorted(self.samples)
+        return samples[min(len(samples) - 1, int(len(samples) * percent / 100.0))]
+
+
+class MetricAggregator(object):
+    """Collects metrics in memory and sends summaries of them every interval seconds.
+
+    Values recorded for the same metric name and tags are summarized by sending their mean under the
+    metric name, along with the ``.count``, ``.max``, ``.p50``, ``.p95`` and ``.p99`` of the values under
+    metric names with those suffixes. Counters are sent as the sum of their increments.
+
+    Args:
+        interval (float): Seconds between flushes by the background thread, or None to only flush manually
+        send (callable): Function used to send a metric, with the signature of ``send_tsdb_metric``
+    """
+    def __init__(self, interval=None, send=send_tsdb_metric):
+        self.interval = interval
+        self.send = send
+        self._histograms = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def record(self, metric_name, value, **tags):
+        """Records a value of a metric, such as a latency or throughput."""
+        key = (metric_name, tuple(sorted(tags.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = _Histogram()
+            histogram.add(value)
+
+    def increment(self, metric_name, value=1, **tags):
+        """Adds to a counter."""
+        key = (metric_name, tuple(sorted(tags.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def flush(self):
+        """Sends summaries of the metrics recorded since the last flush."""
+        with self._lock:
+            histograms, self._histograms = self._histograms, {}
+            counters, self._counters = self._counters, {}
+        for (metric_name, tags), histogram in histograms.items():
+            summary = {
+                metric_name: histogram.total / histogram.count,
+                metric_name + '.count': histogram.count,
+                metric_name + '.max': histogram.max,
+                metric_name + '.p50': histogram.percentile(50),
+                metric_name + '.p95': histogram.percentile(95),
+                metric_name + '.p99': histogram.percentile(99),
+            }
+            for name, value in summary.items():
+                self.send(name, value, asynchronous=False, **dict(tags))
+        for (metric_name, tags), value in counters.items():
+            self.send(metric_name, value, asynchronous=False, **dict(tags))
+
+    def start(self):
+        """Starts flushing in a background thread, and makes sure metrics are flushed when the process exits."""
+        if self.interval:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        atexit.register(self.flush)
+        # Worker processes of multiprocessing pools exit without running atexit handlers
+        multiprocessing.util.Finalize(self, self.flush, exitpriority=10)
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Failed to flush metrics')
+
+
+def get_metric_aggregator():
+    """Return the process-wide aggregator, or None if metrics are sent as they are recorded.
+
+    Metrics are aggregated when METRICS_FLUSH_INTERVAL is greater than 0.
+    """
+    if ingester_settings.METRICS_FLUSH_INTERVAL <= 0:
+        return None
+    return _aggregator.get(_start_metric_aggregator)
+
+
+def _start_metric_aggregator():
+    aggregator = MetricAggregator(interval=ingester_settings.METRICS_FLUSH_INTERVAL)
+    aggregator.start()
+    return aggregator
+
+
+def send_metric(metric_name, value, **tags):
+    """Records a value of a metric, tagged with the EXTRA_METRICS_TAGS.
+
+    The value is added to the process-wide aggregator, or sent straight away if metrics are not aggregated.
+    """
+    if metric_wrappers.test_mode:
+        return
+    tags = dict(ingester_settings.EXTRA_METRICS_TAGS, **tags)
+    aggregator = get_metric_aggregator()
+    if aggregator is not None:
+        aggregator.record(metric_name, value, **tags)
+    else:
+        send_tsdb_metric(metric_name, value, asynchronous=ingester_settings.SUBMIT_METRICS_ASYNCHRONOUSLY, **tags)
+
+
+def count_metric(metric_name, value=1, **tags):
+    """Adds to a counter metric, tagged with the EXTRA_METRICS_TAGS.
+
+    The count is added to the process-wide aggregator, or sent straight away if metrics are not aggregated.
+    """
+    if metric_wrappers.test_mode:
+        return
+    tags = dict(ingester_settings.EXTRA_METRICS_TAGS, **tags)
+    aggregator = get_metric_aggregator()
+    if aggregator is not None:
+        aggregator.increment(metric_name, value, **tags)
+    else:
+        send_tsdb_metric(metric_name, value, asynchronous=ingester_settings.SUBMIT_METRICS_ASYNCHRONOUSLY, **tags)
+
+
+class IngestStats(object):
+    """Time spent in each stage of ingesting a file, along with the bytes and retries involved.
+
+    Stages are timed with :meth:`timed`, and a stage that runs more than once, such as after a retry,
+    accumulates its time.
+    """
+    def __init__(self):
+        self.stages = {}
+        self.bytes = 0
+        self.retries = 0
+
+    @contextlib.contextmanager
+    def timed(self, stage):
+        start_time = time.monotonic()
+        try:
+            yield
+        finally:
+            self.stages[stage] = self.stages.get(stage, 0.0) + time.monotonic() - start_time
+
+    def as_dict(self):
+        """Returns the stats as a dictionary, with the time spent in each stage in seconds."""
+        return {
+            'stages': {stage: round(seconds, 6) for stage, seconds in self.stages.items()},
+            'total': round(sum(self.stages.values()), 6),
+            'bytes': self.bytes,
+            'retries': self.retries,
+        }
+
+    def send_metrics(self, **tags):
+        """Records the runtime of each stage as an ingester.stage.<stage>.runtime metric."""
+        for stage, seconds in self.stages.items():
+            send_metric('ingester.stage.{0}.runtime'.format(stage), seconds * 1000.0, **tags)
+        count_metric('ingester.bytes', self.bytes, **tags)
+        count_metric('ingester.retries_per_ingest', self.retries, **tags)
+
 
 def method_timer(metric_name):
     """Decorator to add extra tags to collected runtime metrics"""
     def method_timer_decorator(method):
         def wrapper(self, *args, **kwargs):
+            if not metric_wrappers.test_mode and get_metric_aggregator() is not None:
+                start_time = time.monotonic()
+                try:
+                    return method(self, *args, **kwargs)
+                finally:
+                    # Tag the class_path the same way as metric_timer_with_tags does for run_method below,
+                    # which names the class of the first positional argument
+                    send_metric(
+                        '{0}.runtime'.format(metric_name), (time.monotonic() - start_time) * 1000.0,
+                        class_path='{0}.{1}.{2}'.format(method.__module__, self.__class__.__name__, method.__name__)
+                    )
+
             # Decorate the wrapped method with metric_timer_with_tags, which does the work of figuring out
             # how long a method takes to run, so that the settings used are evaluated at runtime. An example
             # of when settings are changed at runtime is when the ingester command line entrypoint is used.
@@ -33,12 +244,7 @@ def upload_and_collect_metrics(filestore_class, datafile):
     # Record metric for the bytes transferred / time to upload
     upload_time = datetime.utcnow() - start_time
     bytes_per_second = len(datafile.open_file) / upload_time.total_seconds()
-    send_tsdb_metric(
-        metric_name='ingester.s3_upload_bytes_per_second',
-        value=bytes_per_second,
-        asynchronous=ingester_settings.SUBMIT_METRICS_ASYNCHRONOUSLY,
-        **ingester_settings.EXTRA_METRICS_TAGS
-    )
+    send_metric('ingester.s3_upload_bytes_per_second', bytes_per_second)
     return version
 
 @method_timer('ingester.get_md5')
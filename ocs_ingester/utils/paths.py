@@ -0,0 +1,27 @@
+import os
+import glob
+
+
+def expand_paths(paths):
+    """Expands directories and glob patterns into a list of file paths.
+
+    Directories are expanded to the files directly inside of them. Duplicate paths are only returned once.
+
+    Args:
+        paths (list): File paths, directories or glob patterns
+
+    Returns:
+        list: File paths
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(
+                os.path.join(path, filename) for filename in os.listdir(path)
+                if os.path.isfile(os.path.join(path, filename))
+            ))
+        elif glob.has_magic(path):
+            files.extend(sorted(filename for filename in glob.glob(path) if os.path.isfile(filename)))
+        else:
+            files.append(path)
+    return list(dict.fromkeys(files))
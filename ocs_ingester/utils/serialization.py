@@ -0,0 +1,66 @@
+import json
+import math
+import functools
+from importlib import import_module
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def json_dumps(data):
+    """Serializes data to compact JSON bytes with the standard library, refusing NaN and infinity like requests."""
+    return json.dumps(data, separators=(',', ':'), allow_nan=False).encode()
+
+
+def orjson_dumps(data):
+    """Serializes data to JSON bytes with orjson, falling back to the standard library for what orjson rejects.
+
+    orjson does not serialize integers wider than 64 bits or dictionaries with keys that are not strings. It
+    writes NaN and infinity as null, so those raise a ValueError like they do with json_dumps.
+    """
+    try:
+        body = orjson.dumps(data)
+    except TypeError:
+        return json_dumps(data)
+    # Only a body with a null can hold a float that is out of range
+    if b'null' in body and not _is_finite(data):
+        raise ValueError('Out of range float values are not JSON compliant')
+    return body
+
+
+def _is_finite(data):
+    if isinstance(data, float):
+        return math.isfinite(data)
+    if isinstance(data, dict):
+        return all(_is_finite(value) for value in data.values())
+    if isinstance(data, (list, tuple)):
+        return all(_is_finite(value) for value in data)
+    return True
+
+
+@functools.lru_cache(maxsize=None)
+def get_json_serializer(name):
+    """Returns the function that serializes data to JSON bytes for the given ARCHIVE_JSON_SERIALIZER.
+
+    Args:
+        name (str): 'auto' for orjson if it is installed and the standard library otherwise, 'orjson' or
+            'json' for either, or the dotted path of a function that takes data and returns JSON bytes
+
+    Raises:
+        ImportError: If orjson or the given function cannot be imported
+    """
+    if name == 'auto':
+        return orjson_dumps if orjson is not None else json_dumps
+    if name == 'json':
+        return json_dumps
+    if name == 'orjson':
+        if orjson is None:
+            raise ImportError('ARCHIVE_JSON_SERIALIZER is orjson, but orjson is not installed')
+        return orjson_dumps
+    module_path, _, function_name = name.rpartition('.')
+    try:
+        return getattr(import_module(module_path), function_name)
+    except (ValueError, AttributeError) as e:
+        raise ImportError('Could not import ARCHIVE_JSON_SERIALIZER {0}: {1}'.format(name, e))
@@ -0,0 +1,308 @@
+"""``watch.py`` - Continuously ingest files as they land in watched directories.
+
+Directories are watched with Linux inotify, so that new files are ingested within seconds of being written
+without rescanning the directories. A file is queued once it has been closed after writing or moved into a
+watched directory, and its size and modification time have not changed for ``settle_time`` seconds. Queued
+files are ingested by a pool of worker threads using :func:`ocs_ingester.batch.ingest_path`. The queue is
+bounded, so that watching stops reading new events while the workers are behind.
+
+Hidden files, such as the temporary files written by rsync, are ignored. Files that could not be ingested
+are left in place, and are tried again the next time the watcher starts. Files that failed with a retryable
+error are queued again after a backoff, or, with a :class:`ocs_ingester.spool.Spool`, deferred to the spool to
+be ingested again when it is drained.
+
+Examples:
+    Ingest files landing in two directories, moving them elsewhere once they are in the archive:
+
+    >>> from ocs_ingester.watch import IngestWatcher
+    >>> watcher = IngestWatcher(['/data/landing/coj', '/data/landing/ogg'], workers=8,
+    >>>                         after_ingest=IngestWatcher.MOVE, done_directory='/data/ingested')
+    >>> watcher.run()
+
+"""
+import os
+import time
+import queue
+import random
+import shutil
+import select
+import struct
+import ctypes
+import ctypes.util
+import logging
+import threading
+
+from ocs_ingester.batch import ingest_path, INGESTED, ALREADY_EXISTS, RETRYABLE
+from ocs_ingester.retry import RetryPolicy
+from ocs_ingester.settings import settings as ingester_settings
+
+logger = logging.getLogger('ocs_ingester')
+
+# Event masks from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = os.O_CLOEXEC
+
+_EVENT_HEADER = struct.Struct('iIII')
+
+
+class Inotify(object):
+    """Minimal wrapper around the Linux inotify API.
+
+    Raises:
+        OSError: If inotify is not available or a directory cannot be watched
+    """
+    def __init__(self):
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if not hasattr(self._libc, 'inotify_init1'):
+            raise OSError('inotify is not available on this platform')
+        self.fd = self._libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self._directories = {}
+
+    def add_watch(self, directory, mask=IN_CLOSE_WRITE | IN_MOVED_TO | IN_MODIFY):
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(directory), mask)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), directory)
+        self._directories[wd] = directory
+
+    def read_events(self, timeout=None):
+        """Waits up to timeout seconds for events, returning a list of (path, mask) tuples.
+
+        The path is None for events that do not refer to a file, such as IN_Q_OVERFLOW.
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        buffer = os.read(self.fd, 64 * 1024)
+        events = []
+        offset = 0
+        while offset < len(buffer):
+            wd, mask, _, length = _EVENT_HEADER.unpack_from(buffer, offset)
+            offset += _EVENT_HEADER.size
+            name = buffer[offset:offset + length].rstrip(b'\0')
+            offset += length
+            directory = self._directories.get(wd)
+            path = os.path.join(directory, os.fsdecode(name)) if directory is not None and name else None
+            events.append((path, mask))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class IngestWatcher(object):
+    """Watches directories and ingests the files that land in them.
+
+    Args:
+        directories (list): Directories to watch. Files already in them are ingested when watching starts.
+        workers (int): Number of worker threads that ingest files
+        queue_size (int): Maximum number of settled files waiting for a worker
+        settle_time (float): Seconds that a file must stay unchanged before it is ingested
+        after_ingest (str): What to do with a file once it is in the archive, one of None, MOVE or DELETE
+        done_directory (str): Directory that files are moved to when after_ingest is MOVE
+        spool (ocs_ingester.spool.Spool): Spool that files failing with a retryable error are deferred to
+        retry_backoff (ocs_ingester.retry.RetryPolicy): Without a spool, policy for when a file that failed with a
+            retryable error is queued again, and after how many attempts it is given up on. Defaults to the
+            SPOOL_* settings.
+        ingest_kwargs: Extra arguments for :func:`ocs_ingester.ingester.upload_file_and_ingest_to_archive`
+    """
+    MOVE = 'move'
+    DELETE = 'delete'
+
+    def __init__(self, directories, workers=4, queue_size=100, settle_time=2.0, after_ingest=None,
+                 done_directory=None, spool=None, retry_backoff=None, **ingest_kwargs):
+        if after_ingest not in (None, self.MOVE, self.DELETE):
+            raise ValueError('after_ingest must be one of None, {0!r} or {1!r}'.format(self.MOVE, self.DELETE))
+        if after_ingest == self.MOVE and not done_directory:
+            raise ValueError('A done_directory is required to move ingested files')
+        self.directories = list(directories)
+        self.workers = workers
+        self.settle_time = settle_time
+        self.after_ingest = after_ingest
+        self.done_directory = done_directory
+        self.spool = spool
+        self.retry_backoff = retry_backoff or RetryPolicy(
+            max_attempts=ingester_settings.SPOOL_MAX_ATTEMPTS, base_delay=ingester_settings.SPOOL_BASE_DELAY,
+            max_delay=ingester_settings.SPOOL_MAX_DELAY
+        )
+        self.ingest_kwargs = ingest_kwargs
+        self.queue = queue.Queue(maxsize=queue_size)
+        self._pending = {}
+        # Attempts so far, and when to queue them again, of files that failed with a retryable error
+        self._retries = {}
+        self._in_flight = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def run(self):
+        """Watches the directories and ingests files until :meth:`stop` is called."""
+        inotify = Inotify()
+        threads = [threading.Thread(target=self._work, daemon=True) for _ in range(self.workers)]
+        try:
+            for directory in self.directories:
+                inotify.add_watch(directory)
+            for thread in threads:
+                thread.start()
+            self.scan()
+            while not self._stop.is_set():
+                for path, mask in inotify.read_events(timeout=self._next_timeout()):
+                    if mask & IN_Q_OVERFLOW:
+                        logger.warning('Ingest watcher missed events, rescanning watched directories')
+                        self.scan()
+                    elif path is not None and not mask & (IN_ISDIR | IN_IGNORED):
+                        self.file_changed(path)
+                for path in self.settled():
+                    self._enqueue(path)
+        finally:
+            started = [thread for thread in threads if thread.is_alive()]
+            for _ in started:
+                self.queue.put(None)
+            for thread in started:
+                thread.join()
+            inotify.close()
+
+    def stop(self):
+        """Stops watching. Files that are already queued are still ingested before :meth:`run` returns."""
+        self._stop.set()
+
+    def scan(self):
+        """Marks every file already in the watched directories as changed."""
+        for directory in self.directories:
+            for entry in os.scandir(directory):
+                if entry.is_file():
+                    self.file_changed(entry.path)
+
+    def _enqueue(self, path):
+        # Waits for room in the queue while checking whether the watcher was stopped, so that stopping takes
+        # effect while every worker is busy. A file that was not queued is ingested the next time it is found.
+        while not self._stop.is_set():
+            try:
+                self.queue.put(path, timeout=0.5)
+                return
+            except queue.Full:
+                pass
+        with self._lock:
+            self._in_flight.discard(path)
+
+    def file_changed(self, path, now=None):
+        """Records that the file at path was written to, delaying its ingestion until it settles."""
+        if os.path.basename(path).startswith('.'):
+            return
+        try:
+            stat = os.stat(path)
+        except OSError:
+            self._pending.pop(path, None)
+            return
+        now = time.monotonic() if now is None else now
+        self._pending[path] = (now + self.settle_time, stat.st_size, stat.st_mtime_ns)
+
+    def settled(self, now=None):
+        """Returns the pending files that have not changed for settle_time seconds, and stops tracking them."""
+        now = time.monotonic() if now is None else now
+        ready = []
+        for path, (deadline, size, mtime) in list(self._pending.items()):
+            if deadline > now:
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                del self._pending[path]
+                continue
+            if (stat.st_size, stat.st_mtime_ns) != (size, mtime):
+                # Still being written without any events, such as over a network file system
+                self._pending[path] = (now + self.settle_time, stat.st_size, stat.st_mtime_ns)
+                continue
+            del self._pending[path]
+            with self._lock:
+                if path in self._in_flight:
+                    continue
+                self._in_flight.add(path)
+            ready.append(path)
+        return ready + self.due_retries(now)
+
+    def due_retries(self, now=None):
+        """Returns the files that failed with a retryable error and are due to be tried again."""
+        now = time.monotonic() if now is None else now
+        ready = []
+        with self._lock:
+            for path, (attempts, retry_at) in list(self._retries.items()):
+                if retry_at is None or retry_at > now or path in self._in_flight:
+                    continue
+                if not os.path.exists(path):
+                    del self._retries[path]
+                    continue
+                self._retries[path] = (attempts, None)
+                self._in_flight.add(path)
+                ready.append(path)
+        return ready
+
+    def _retry_later(self, path, now=None):
+        # Returns when the file is queued again, or None if it has been tried too often
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            attempts = self._retries.get(path, (0, None))[0] + 1
+            if attempts >= self.retry_backoff.max_attempts:
+                self._retries.pop(path, None)
+                return None
+            # Jitter so that files that failed together are not all tried again at the same time
+            retry_at = now + random.uniform(0.5, 1) * self.retry_backoff.backoff(attempts)
+            self._retries[path] = (attempts, retry_at)
+        return retry_at
+
+    def _next_timeout(self):
+        deadlines = [deadline for deadline, _, _ in self._pending.values()]
+        with self._lock:
+            deadlines.extend(retry_at for _, retry_at in self._retries.values() if retry_at is not None)
+        if not deadlines:
+            return 1.0
+        return min(1.0, max(0.0, min(deadlines) - time.monotonic()))
+
+    def _work(self):
+        while True:
+            path = self.queue.get()
+            if path is None:
+                return
+            try:
+                self.ingest(path)
+            except Exception:
+                logger.exception('Ingest watcher failed to handle file', extra={'tags': {'filename': path}})
+            finally:
+                with self._lock:
+                    self._in_flight.discard(path)
+
+    def ingest(self, path):
+        """Ingests the file at path, then moves or deletes it if it is in the archive.
+
+        Returns:
+            ocs_ingester.batch.IngestOutcome: The outcome of ingesting the file
+        """
+        outcome = ingest_path(path, **self.ingest_kwargs)
+        tags = {'filename': path, 'status': outcome.status}
+        if outcome.status == RETRYABLE and self.spool is not None:
+            self.spool.defer(path, outcome.message, self.ingest_kwargs)
+            logger.warning('Ingest watcher deferred file: {0}'.format(outcome.message), extra={'tags': tags})
+            return outcome
+        if outcome.status == RETRYABLE and self._retry_later(path) is not None:
+            logger.warning('Ingest watcher will try file again: {0}'.format(outcome.message), extra={'tags': tags})
+            return outcome
+        with self._lock:
+            self._retries.pop(path, None)
+        if outcome.status not in (INGESTED, ALREADY_EXISTS):
+            logger.warning('Ingest watcher could not ingest file: {0}'.format(outcome.message), extra={'tags': tags})
+            return outcome
+        if self.spool is not None:
+            self.spool.remove(path)
+        logger.info('Ingest watcher handled file', extra={'tags': tags})
+        if self.after_ingest == self.MOVE:
+            shutil.move(path, os.path.join(self.done_directory, os.path.basename(path)))
+        elif self.after_ingest == self.DELETE:
+            os.remove(path)
+        return outcome
@@ -28,11 +28,15 @@ setup(
         'opentsdb-python-metrics>=0.2.0'
     ],
     extras_require={
-        'tests': ['pytest']
+        'tests': ['pytest', 'aiohttp'],
+        'orjson': ['orjson'],
+        'async': ['aiohttp']
     },
     entry_points={
         'console_scripts': [
             'ocs_ingest_frame = ocs_ingester.scripts.ingest_frame:main',
+            'ocs_ingest_watch = ocs_ingester.scripts.ingest_watch:main',
+            'ocs_ingest_server = ocs_ingester.scripts.ingest_server:main',
         ]
     }
 )
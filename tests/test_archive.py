@@ -1,12 +1,17 @@
-from unittest.mock import patch
+from unittest.mock import MagicMock, patch
 import unittest
+import gzip
+import json
 import os
 from datetime import datetime
+from requests import Response
 from requests.exceptions import ConnectionError, HTTPError
 
-from ocs_ingester.archive import ArchiveService, obs_end_time_from_dict
-from ocs_ingester.ingester import frame_exists
+from ocs_ingester.archive import ArchiveService, FramePostBatcher, obs_end_time_from_dict, get_session
+from ocs_ingester.ingester import frame_exists, frames_exist
 from ocs_ingester.exceptions import BackoffRetryError, DoNotRetryError
+from ocs_ingester.deadline import Deadline
+from ocs_ingester.utils.serialization import get_json_serializer, json_dumps, orjson_dumps
 
 
 FITS_PATH = os.path.join(
@@ -36,6 +41,17 @@ def mocked_requests_get(*args, **kwargs):
             else:
                 return None
 
+    if args[0].startswith('http://many/versions/'):
+        md5s = kwargs['params']['md5__in'].split(',')
+        results = [{'md5': md5} for md5 in md5s if md5.startswith('exists')]
+        return MockResponse({'count': len(results), 'results': results}, None, 200)
+
+    if args[0].startswith('http://unfiltered/versions/?md5='):
+        return MockResponse({'count': 1 if 'exists' in args[0] else 0}, None, 200)
+
+    if args[0].startswith('http://unfiltered/versions/'):
+        return MockResponse({'count': 500, 'results': [{'md5': 'unrelated'}]}, None, 200)
+
     if args[0].startswith('http://return1/'):
         return MockResponse({'count': 1}, None, 400)
 
@@ -48,8 +64,8 @@ def mocked_requests_get(*args, **kwargs):
     return MockResponse({'count': 0}, None, 200)
 
 
-@patch('requests.get', side_effect=mocked_requests_get)
-@patch('requests.post')
+@patch('requests.Session.get', side_effect=mocked_requests_get)
+@patch('requests.Session.post')
 class TestArchiveService(unittest.TestCase):
     def test_archive_post(self, post_mock, get_mock):
         archive_service = ArchiveService(api_root='http://fake/', auth_token='')
@@ -84,6 +100,66 @@ class TestArchiveService(unittest.TestCase):
             archive_service.version_exists('')
         self.assertFalse(post_mock.called)
 
+    def test_versions_exist(self, post_mock, get_mock):
+        archive_service = ArchiveService(api_root='http://many/', auth_token='')
+        exists = archive_service.versions_exist(['exists1', 'missing1', 'exists2'])
+        self.assertEqual(exists, {'exists1': True, 'missing1': False, 'exists2': True})
+        self.assertEqual(get_mock.call_count, 1)
+
+    @patch('ocs_ingester.settings.settings.ARCHIVE_VERSIONS_CHUNK_SIZE', 2)
+    def test_versions_exist_chunked(self, post_mock, get_mock):
+        archive_service = ArchiveService(api_root='http://many/', auth_token='')
+        md5s = ['exists1', 'missing1', 'exists2', 'missing2', 'exists3']
+        exists = archive_service.versions_exist(md5s)
+        self.assertEqual(len(exists), 5)
+        self.assertEqual(get_mock.call_count, 3)
+
+    def test_versions_exist_falls_back_when_filter_unsupported(self, post_mock, get_mock):
+        archive_service = ArchiveService(api_root='http://unfiltered/', auth_token='')
+        exists = archive_service.versions_exist(['exists1', 'missing1'])
+        self.assertEqual(exists, {'exists1': True, 'missing1': False})
+
+    def test_frames_exist(self, post_mock, get_mock):
+        with open(FITS_FILE, 'rb') as fileobj:
+            exists = frames_exist([fileobj], api_root='http://fake/')
+            self.assertEqual(exists, {fileobj: False})
+
+    def test_connection_error_raised_by_request(self, post_mock, get_mock):
+        get_mock.side_effect = ConnectionError
+        archive_service = ArchiveService(api_root='http://fake/', auth_token='')
+        with self.assertRaises(BackoffRetryError):
+            archive_service.version_exists('')
+
+    @patch('ocs_ingester.settings.settings.ARCHIVE_CONNECT_TIMEOUT', 2)
+    @patch('ocs_ingester.settings.settings.ARCHIVE_READ_TIMEOUT', 30)
+    def test_requests_use_timeouts(self, post_mock, get_mock):
+        archive_service = ArchiveService(api_root='http://fake/', auth_token='')
+        archive_service.version_exists('')
+        self.assertEqual(get_mock.call_args[1]['timeout'], (2, 30))
+
+    @patch('ocs_ingester.settings.settings.ARCHIVE_CONNECT_TIMEOUT', 2)
+    @patch('ocs_ingester.settings.settings.ARCHIVE_READ_TIMEOUT', 30)
+    def test_requests_use_remaining_deadline(self, post_mock, get_mock):
+        archive_service = ArchiveService(api_root='http://fake/', auth_token='', deadline=Deadline(10))
+        archive_service.version_exists('')
+        connect_timeout, read_timeout = get_mock.call_args[1]['timeout']
+        self.assertEqual(connect_timeout, 2)
+        self.assertTrue(9 < read_timeout <= 10)
+
+    def test_no_request_after_deadline(self, post_mock, get_mock):
+        archive_service = ArchiveService(api_root='http://fake/', auth_token='', deadline=Deadline(0))
+        with self.assertRaises(BackoffRetryError):
+            archive_service.version_exists('')
+        self.assertFalse(get_mock.called)
+
+    def test_session_shared_per_api_root(self, post_mock, get_mock):
+        first = ArchiveService(api_root='http://fake/', auth_token='')
+        second = ArchiveService(api_root='http://fake/', auth_token='other')
+        other_root = ArchiveService(api_root='http://other/', auth_token='')
+        self.assertIs(first.session, second.session)
+        self.assertIs(first.session, get_session('http://fake/'))
+        self.assertIsNot(first.session, other_root.session)
+
     def test_get_obs_end_date_obs_date_only(self, post_mock, get_mock):
         archive_headers = {'observation_date': '2021-10-10T20:00:00'}
         end_date = obs_end_time_from_dict(archive_headers)
@@ -105,3 +181,206 @@ class TestArchiveService(unittest.TestCase):
         archive_headers = {'observation_date': '2021-10-10T20:00:00', 'headers': {'UTSTOP': '04:00:00'}}
         end_date = obs_end_time_from_dict(archive_headers)
         self.assertEqual(end_date.isoformat(), '2021-10-11T04:00:00')
+
+
+class StubArchiveApi(object):
+    """Stand-in for the frames/ endpoints of the archive API, rejecting records without an observation_date"""
+    def __init__(self, bulk=True, gzip=True, bulk_status=None, gzip_status=415):
+        self.bulk = bulk
+        self.bulk_status = bulk_status
+        self.gzip = gzip
+        self.gzip_status = gzip_status
+        self.requests = []
+        self.encodings = []
+
+    @staticmethod
+    def response(status_code, data):
+        response = Response()
+        response.status_code = status_code
+        response._content = json.dumps(data).encode()
+        return response
+
+    def create(self, record):
+        if 'observation_date' not in record:
+            return 400, {'error': 'observation_date is required', 'status_code': 400}
+        return 201, {'id': len(self.requests), 'filename': record['basename'] + '.fits.fz',
+                     'url': 'http://fake/' + record['basename']}
+
+    def post(self, url, data=None, headers=None, **kwargs):
+        self.requests.append(url)
+        encoding = headers.get('Content-Encoding')
+        self.encodings.append(encoding)
+        if encoding == 'gzip':
+            if not self.gzip:
+                return self.response(self.gzip_status, {'detail': 'Could not decode the request body'})
+            data = gzip.decompress(data)
+        data = json.loads(data)
+        if url.endswith('frames/bulk/'):
+            if not self.bulk:
+                return self.response(404, {'detail': 'Not found.'})
+            if self.bulk_status:
+                return self.response(self.bulk_status, {'detail': 'Rejected'})
+            return self.response(201, [self.create(record)[1] for record in data])
+        return self.response(*self.create(data))
+
+
+class TestBulkPost(unittest.TestCase):
+    def setUp(self):
+        for name in ('_bulk_unsupported', '_gzip_unsupported', '_gzip_supported'):
+            patcher = patch('ocs_ingester.archive.{0}'.format(name), set())
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = patch('ocs_ingester.settings.settings.ARCHIVE_BULK_FRAMES_PATH', 'frames/bulk/')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.records = [
+            {'basename': 'frame1', 'observation_date': '2019-10-13T10:13:00'},
+            {'basename': 'frame2'},
+            {'basename': 'frame3', 'observation_date': '2019-10-13T10:14:00'},
+        ]
+
+    def post_frames(self, stub):
+        with patch('requests.Session.post', side_effect=stub.post):
+            archive = ArchiveService(api_root='http://fake/', auth_token='')
+            return archive.post_frames(self.records)
+
+    def test_bulk_post(self):
+        stub = StubArchiveApi()
+        results = self.post_frames(stub)
+        self.assertEqual(stub.requests, ['http://fake/frames/bulk/'])
+        self.assertEqual(results[0]['url'], 'http://fake/frame1')
+        self.assertIsInstance(results[1], DoNotRetryError)
+        self.assertEqual(results[2]['filename'], 'frame3.fits.fz')
+
+    def test_falls_back_when_bulk_unsupported(self):
+        stub = StubArchiveApi(bulk=False)
+        results = self.post_frames(stub)
+        self.assertEqual(stub.requests, ['http://fake/frames/bulk/'] + ['http://fake/frames/'] * 3)
+        self.assertEqual(results[0]['url'], 'http://fake/frame1')
+        self.assertIsInstance(results[1], DoNotRetryError)
+        self.assertEqual(results[2]['url'], 'http://fake/frame3')
+
+        # The archive is remembered as not supporting bulk posts
+        stub.requests = []
+        self.post_frames(stub)
+        self.assertNotIn('http://fake/frames/bulk/', stub.requests)
+
+    def test_falls_back_when_bulk_not_allowed(self):
+        stub = StubArchiveApi(bulk_status=405)
+        results = self.post_frames(stub)
+        self.assertEqual(stub.requests, ['http://fake/frames/bulk/'] + ['http://fake/frames/'] * 3)
+        self.assertEqual(results[2]['url'], 'http://fake/frame3')
+
+    def test_bulk_client_error_is_raised(self):
+        stub = StubArchiveApi(bulk_status=400)
+        with self.assertRaises(DoNotRetryError):
+            self.post_frames(stub)
+        self.assertEqual(stub.requests, ['http://fake/frames/bulk/'])
+
+    @patch('ocs_ingester.settings.settings.ARCHIVE_BULK_FRAMES_PATH', '')
+    def test_bulk_disabled(self):
+        stub = StubArchiveApi()
+        self.post_frames(stub)
+        self.assertEqual(stub.requests, ['http://fake/frames/'] * 3)
+
+    def test_batcher(self):
+        stub = StubArchiveApi()
+        with patch('requests.Session.post', side_effect=stub.post):
+            batcher = FramePostBatcher(ArchiveService(api_root='http://fake/', auth_token=''), batch_size=2)
+            self.assertEqual(batcher.add(self.records[0]), [])
+            posted = batcher.add(self.records[1])
+            posted += batcher.add(self.records[2])
+            posted += batcher.flush()
+        self.assertEqual(len(stub.requests), 2)
+        self.assertEqual([record['basename'] for record, _ in posted], ['frame1', 'frame2', 'frame3'])
+        self.assertIsInstance(posted[1][1], DoNotRetryError)
+
+    def test_batcher_whole_batch_error(self):
+        with patch('requests.Session.post', side_effect=ConnectionError):
+            batcher = FramePostBatcher(ArchiveService(api_root='http://fake/', auth_token=''), batch_size=5)
+            batcher.add(self.records[0])
+            posted = batcher.flush()
+        self.assertIsInstance(posted[0][1], BackoffRetryError)
+
+    def test_batcher_whole_batch_rejected(self):
+        archive = MagicMock()
+        archive.post_frames.side_effect = DoNotRetryError('400 Bad Request')
+        batcher = FramePostBatcher(archive, batch_size=2)
+        batcher.add(self.records[0])
+        posted = batcher.add(self.records[1])
+        self.assertEqual([record['basename'] for record, _ in posted], ['frame1', 'frame2'])
+        self.assertTrue(all(isinstance(result, DoNotRetryError) for _, result in posted))
+
+    @patch('ocs_ingester.settings.settings.ARCHIVE_GZIP_MIN_SIZE', 100)
+    def test_large_bodies_are_compressed(self):
+        stub = StubArchiveApi()
+        with patch('requests.Session.post', side_effect=stub.post):
+            archive = ArchiveService(api_root='http://fake/', auth_token='')
+            archive.post_frame(dict(self.records[0]))
+            archive.post_frame({'basename': 'frame1', 'observation_date': '2019-10-13T10:13:00', 'headers': {
+                'KEY{0}'.format(i): 'value' for i in range(20)
+            }})
+        self.assertEqual(stub.encodings, [None, 'gzip'])
+
+    @patch('ocs_ingester.settings.settings.ARCHIVE_GZIP_MIN_SIZE', 1)
+    def test_falls_back_when_gzip_unsupported(self):
+        stub = StubArchiveApi(gzip=False)
+        results = self.post_frames(stub)
+        self.assertEqual(stub.encodings, ['gzip', None])
+        self.assertEqual(results[0]['url'], 'http://fake/frame1')
+
+        # The archive is remembered as not accepting compressed bodies
+        stub.encodings = []
+        self.post_frames(stub)
+        self.assertEqual(stub.encodings, [None])
+
+    @patch('ocs_ingester.settings.settings.ARCHIVE_GZIP_MIN_SIZE', 1)
+    def test_falls_back_when_gzip_is_a_bad_request(self):
+        stub = StubArchiveApi(gzip=False, gzip_status=400)
+        results = self.post_frames(stub)
+        self.assertEqual(stub.encodings, ['gzip', None])
+        self.assertEqual(results[0]['url'], 'http://fake/frame1')
+        stub.encodings = []
+        self.post_frames(stub)
+        self.assertEqual(stub.encodings, [None])
+
+    @patch('ocs_ingester.settings.settings.ARCHIVE_GZIP_MIN_SIZE', 1)
+    def test_bad_compressed_request_keeps_gzip(self):
+        stub = StubArchiveApi()
+        with patch('requests.Session.post', side_effect=stub.post):
+            archive = ArchiveService(api_root='http://fake/', auth_token='')
+            with self.assertRaises(DoNotRetryError):
+                archive.post_frame({'basename': 'frame2'})
+            archive.post_frame(dict(self.records[0]))
+            # Once the archive accepted a compressed body, bad requests are not sent again
+            with self.assertRaises(DoNotRetryError):
+                archive.post_frame({'basename': 'frame2'})
+        self.assertEqual(stub.encodings, ['gzip', None, 'gzip', 'gzip'])
+
+    def test_unserializable_record(self):
+        with patch('requests.Session.post') as post_mock:
+            archive = ArchiveService(api_root='http://fake/', auth_token='')
+            with self.assertRaises(DoNotRetryError):
+                archive.post_frame({'basename': 'frame1', 'headers': {'EXPTIME': float('nan')}})
+        self.assertFalse(post_mock.called)
+
+
+class TestJsonSerializer(unittest.TestCase):
+    def test_serializers(self):
+        data = {'basename': 'frame1', 'headers': {'EXPTIME': 30.5, 'OBJECT': 'M31 \u00e9'}, 'area': None}
+        for name in ('auto', 'json', 'orjson', 'ocs_ingester.utils.serialization.json_dumps'):
+            self.assertEqual(json.loads(get_json_serializer(name)(data)), data)
+
+    def test_orjson_falls_back_for_unsupported_data(self):
+        data = {'REQNUM': 2 ** 70}
+        self.assertEqual(orjson_dumps(data), json_dumps(data))
+
+    def test_serializers_reject_out_of_range_floats(self):
+        for value in (float('nan'), float('inf')):
+            for serializer in (json_dumps, orjson_dumps):
+                with self.assertRaises(ValueError):
+                    serializer({'headers': {'EXPTIME': value, 'OBJECT': None}, 'version_set': [{'area': [value]}]})
+
+    def test_invalid_serializer(self):
+        with self.assertRaises(ImportError):
+            get_json_serializer('ocs_ingester.utils.serialization.does_not_exist')
@@ -0,0 +1,244 @@
+from unittest.mock import MagicMock, AsyncMock, ANY, patch
+from concurrent.futures import ThreadPoolExecutor
+import unittest
+import asyncio
+import hashlib
+import json
+import os
+from datetime import datetime
+
+import opentsdb_python_metrics.metric_wrappers
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from ocs_ingester.archive import AsyncArchiveService, close_async_sessions
+from ocs_ingester.async_ingester import AsyncIngester, upload_file_and_ingest_to_archive
+from ocs_ingester.frame import Frame
+from ocs_ingester.exceptions import BackoffRetryError, DoNotRetryError, NonFatalDoNotRetryError
+from ocs_ingester.deadline import Deadline
+from ocs_ingester.retry import Retrier, RetryPolicy
+
+opentsdb_python_metrics.metric_wrappers.test_mode = True
+
+
+FITS_PATH = os.path.join(
+    os.path.dirname(__file__),
+    'test_files/fits/'
+)
+
+FITS_FILE = os.path.join(
+    FITS_PATH,
+    'coj1m011-kb05-20150219-0125-e90.fits.fz'
+)
+
+
+class FakeArchive(object):
+    # Science archive API served by aiohttp on localhost, answering versions/ and frames/ requests
+    def __init__(self, exists=False, hold_versions=0):
+        self.exists = exists
+        self.posted = []
+        self.encodings = []
+        self.waiting = 0
+        # Number of versions/ requests to hold on to until they are all in flight at once
+        self.hold_versions = hold_versions
+        self.all_waiting = asyncio.Event()
+        app = web.Application()
+        app.router.add_get('/versions/', self.versions)
+        app.router.add_post('/frames/', self.frames)
+        self.server = TestServer(app)
+
+    @property
+    def api_root(self):
+        return str(self.server.make_url('/'))
+
+    async def __aenter__(self):
+        await self.server.start_server()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await close_async_sessions()
+        await self.server.close()
+
+    async def versions(self, request):
+        if self.hold_versions:
+            self.waiting += 1
+            if self.waiting == self.hold_versions:
+                self.all_waiting.set()
+            await asyncio.wait_for(self.all_waiting.wait(), 10)
+        return web.json_response({'count': int(self.exists), 'md5': request.query['md5']})
+
+    async def frames(self, request):
+        # aiohttp decompresses the body of gzip encoded requests
+        self.encodings.append(request.headers.get('Content-Encoding'))
+        record = json.loads(await request.read())
+        if 'observation_date' not in record:
+            return web.json_response({'observation_date': ['This field is required.']}, status=400)
+        self.posted.append(record)
+        return web.json_response({'id': len(self.posted), 'filename': 'file.fits.fz', 'url': 'http://fake/file'})
+
+
+def run_with_archive(archive, coroutine_function):
+    async def run():
+        async with archive:
+            return await coroutine_function(archive)
+    return asyncio.run(run())
+
+
+class TestAsyncArchiveService(unittest.TestCase):
+    def setUp(self):
+        self.md5_index = MagicMock()
+        self.md5_index.contains.return_value = False
+
+    def test_version_exists(self):
+        async def version_exists(archive):
+            service = AsyncArchiveService(api_root=archive.api_root, auth_token='', md5_index=self.md5_index)
+            return await service.version_exists('md5')
+        self.assertTrue(run_with_archive(FakeArchive(exists=True), version_exists))
+        self.md5_index.add.assert_called_with(ANY, ['md5'])
+        self.assertFalse(run_with_archive(FakeArchive(exists=False), version_exists))
+
+    def test_post_frame(self):
+        async def post_frame(archive):
+            service = AsyncArchiveService(api_root=archive.api_root, auth_token='', md5_index=self.md5_index)
+            return await service.post_frame({'observation_date': datetime.utcnow().isoformat()})
+        archive = FakeArchive()
+        record = run_with_archive(archive, post_frame)
+        self.assertEqual(record['url'], 'http://fake/file')
+        self.assertEqual(len(archive.posted), 1)
+
+    @patch('ocs_ingester.settings.settings.ARCHIVE_GZIP_MIN_SIZE', 1)
+    def test_post_frame_compressed(self):
+        async def post_frame(archive):
+            service = AsyncArchiveService(api_root=archive.api_root, auth_token='', md5_index=self.md5_index)
+            return await service.post_frame({'observation_date': datetime.utcnow().isoformat()})
+        archive = FakeArchive()
+        self.assertEqual(run_with_archive(archive, post_frame)['frameid'], 1)
+        self.assertEqual(archive.encodings, ['gzip'])
+
+    def test_bad_record_is_not_retried(self):
+        async def post_frame(archive):
+            service = AsyncArchiveService(api_root=archive.api_root, auth_token='', md5_index=self.md5_index)
+            return await service.post_frame({})
+        with self.assertRaises(DoNotRetryError):
+            run_with_archive(FakeArchive(), post_frame)
+
+    def test_unreachable_archive_is_retried(self):
+        async def version_exists():
+            service = AsyncArchiveService(api_root='http://127.0.0.1:1/', auth_token='', md5_index=self.md5_index)
+            try:
+                return await service.version_exists('md5')
+            finally:
+                await close_async_sessions()
+        with self.assertRaises(BackoffRetryError):
+            asyncio.run(version_exists())
+
+
+class TestAsyncIngester(unittest.TestCase):
+    def setUp(self):
+        self.fileobj = open(FITS_FILE, 'rb')
+        self.addCleanup(self.fileobj.close)
+        self.archive = MagicMock(api_root='http://fake/')
+        self.archive.version_exists = AsyncMock(return_value=False)
+        self.archive.post_frame = AsyncMock(side_effect=lambda record: dict(record, url='http://fake/file'))
+        self.md5 = hashlib.md5(self.fileobj.read()).hexdigest()
+        self.fileobj.seek(0)
+
+    def test_ingest(self):
+        frame = Frame(self.fileobj)
+        filestore = MagicMock()
+        filestore.store_file.return_value = {'md5': frame.md5, 'key': 'version'}
+        result = asyncio.run(AsyncIngester(frame, filestore, self.archive).ingest())
+        self.assertEqual(result['url'], 'http://fake/file')
+        record = self.archive.post_frame.call_args[0][0]
+        self.assertEqual(record['version_set'][0]['md5'], frame.md5)
+        self.assertEqual(record['area']['type'], 'Polygon')
+
+    def test_ingest_modes(self):
+        retrier = Retrier({BackoffRetryError: RetryPolicy(max_attempts=2, base_delay=0, max_delay=0)})
+        modes = [{'streaming': True}, {'concurrent': True}, {'speculative': True}, {'deadline': Deadline(60)},
+                 {'retrier': retrier}]
+        for mode in modes:
+            with self.subTest(mode=mode):
+                fileobj = open(FITS_FILE, 'rb')
+                self.addCleanup(fileobj.close)
+                filestore = MagicMock()
+                filestore.store_file.side_effect = lambda data_file: {
+                    'md5': hashlib.md5(data_file.open_file.get_from_start().read()).hexdigest(), 'key': 'version'
+                }
+                result = asyncio.run(AsyncIngester(Frame(fileobj), filestore, self.archive, **mode).ingest())
+                self.assertEqual(result['version_set'][0]['md5'], self.md5)
+                self.assertEqual(filestore.store_file.call_count, 1)
+
+    def test_ingest_is_retried(self):
+        self.archive.post_frame.side_effect = [BackoffRetryError('Archive unavailable'), {'url': 'http://fake/file'}]
+        frame = Frame(self.fileobj)
+        filestore = MagicMock()
+        filestore.store_file.return_value = {'md5': frame.md5, 'key': 'version'}
+        retrier = Retrier({BackoffRetryError: RetryPolicy(max_attempts=2, base_delay=0, max_delay=0)})
+        result = asyncio.run(AsyncIngester(frame, filestore, self.archive, retrier=retrier).ingest())
+        self.assertEqual(result['ingest_stats']['retries'], 1)
+        self.assertEqual(filestore.store_file.call_count, 1)
+
+    def test_ingest_already_exists(self):
+        self.archive.version_exists.return_value = True
+        filestore = MagicMock()
+        with self.assertRaises(NonFatalDoNotRetryError):
+            asyncio.run(AsyncIngester(Frame(self.fileobj), filestore, self.archive).ingest())
+        self.assertFalse(filestore.store_file.called)
+
+    def test_ingest_md5_mismatch(self):
+        filestore = MagicMock()
+        filestore.store_file.return_value = {'md5': 'othermd5', 'key': 'version'}
+        with self.assertRaises(BackoffRetryError):
+            asyncio.run(AsyncIngester(Frame(self.fileobj), filestore, self.archive).ingest())
+        self.assertFalse(self.archive.post_frame.called)
+
+    def test_ingest_deadline(self):
+        filestore = MagicMock()
+        with self.assertRaises(BackoffRetryError):
+            asyncio.run(AsyncIngester(Frame(self.fileobj), filestore, self.archive, deadline=Deadline(0)).ingest())
+        self.assertFalse(filestore.store_file.called)
+
+    def test_upload_file_and_ingest_to_archive(self):
+        fileobjs = [open(FITS_FILE, 'rb') for _ in range(3)]
+        for fileobj in fileobjs:
+            self.addCleanup(fileobj.close)
+
+        async def ingest_many(archive):
+            return await asyncio.gather(*[
+                upload_file_and_ingest_to_archive(fileobj, api_root=archive.api_root) for fileobj in fileobjs
+            ])
+
+        archive = FakeArchive()
+        with patch('ocs_ingester.archive.get_md5_index', return_value=None), \
+                patch('ocs_ingester.ingester.get_checkpoint_journal', return_value=None):
+            results = run_with_archive(archive, ingest_many)
+        self.assertEqual([result['url'] for result in results], ['http://fake/file'] * 3)
+        self.assertEqual(len(archive.posted), 3)
+
+    def test_frames_wait_on_the_archive_without_holding_threads(self):
+        frames = 20
+        fileobjs = [open(FITS_FILE, 'rb') for _ in range(frames)]
+        for fileobj in fileobjs:
+            self.addCleanup(fileobj.close)
+        executor = ThreadPoolExecutor(max_workers=2)
+        self.addCleanup(executor.shutdown)
+
+        async def ingest_many(archive):
+            # Every frame checks whether it exists before any check is answered, with only two threads
+            return await asyncio.gather(*[
+                upload_file_and_ingest_to_archive(fileobj, api_root=archive.api_root, executor=executor)
+                for fileobj in fileobjs
+            ])
+
+        archive = FakeArchive(hold_versions=frames)
+        with patch('ocs_ingester.archive.get_md5_index', return_value=None), \
+                patch('ocs_ingester.ingester.get_checkpoint_journal', return_value=None), \
+                patch('ocs_ingester.settings.settings.ARCHIVE_POOL_SIZE', frames):
+            results = run_with_archive(archive, ingest_many)
+        self.assertEqual(len(results), frames)
+        self.assertEqual(len(archive.posted), frames)
+
+    def test_upload_file_and_ingest_to_archive_missing_headers(self):
+        with self.assertRaises(DoNotRetryError):
+            asyncio.run(upload_file_and_ingest_to_archive(self.fileobj, required_headers=['fooheader']))
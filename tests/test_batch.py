@@ -0,0 +1,91 @@
+from unittest.mock import patch
+from concurrent.futures import ProcessPoolExecutor
+import unittest
+import os
+
+import opentsdb_python_metrics.metric_wrappers
+
+from ocs_ingester.batch import (ingest_path, ingest_paths, outcome_status_for_exception, _initialize_worker,
+                                INGESTED, ALREADY_EXISTS, RETRYABLE, FATAL)
+from ocs_ingester.utils.paths import expand_paths
+from ocs_ingester.exceptions import BackoffRetryError, RetryError, DoNotRetryError, NonFatalDoNotRetryError
+from ocs_ingester.retry import RetryBudgetManager, get_retry_budget
+
+opentsdb_python_metrics.metric_wrappers.test_mode = True
+
+
+def withdraw_retries(count):
+    # Runs in a worker process, taking retries from the budget that the process was initialized with
+    return sum(get_retry_budget().withdraw() for _ in range(count))
+
+
+FITS_PATH = os.path.join(
+    os.path.dirname(__file__),
+    'test_files/fits/'
+)
+
+OTHER_PATH = os.path.join(
+    os.path.dirname(__file__),
+    'test_files/other/'
+)
+
+FITS_FILE = os.path.join(
+    FITS_PATH,
+    'coj1m011-kb05-20150219-0125-e90.fits.fz'
+)
+
+PDF_FILE = os.path.join(
+    OTHER_PATH,
+    'cptnrs03-fa13-20150219-0001-e92-summary.pdf'
+)
+
+
+class TestExpandPaths(unittest.TestCase):
+    def test_directory(self):
+        self.assertEqual(expand_paths([OTHER_PATH]), [PDF_FILE])
+
+    def test_glob(self):
+        paths = expand_paths([os.path.join(FITS_PATH, '*e90.fits.fz')])
+        self.assertIn(FITS_FILE, paths)
+        self.assertTrue(all(path.endswith('e90.fits.fz') for path in paths))
+
+    def test_plain_paths_and_duplicates(self):
+        self.assertEqual(expand_paths([FITS_FILE, PDF_FILE, FITS_FILE]), [FITS_FILE, PDF_FILE])
+
+    def test_missing_path_is_kept(self):
+        self.assertEqual(expand_paths(['/does/not/exist.fits']), ['/does/not/exist.fits'])
+
+
+class TestIngestPaths(unittest.TestCase):
+    def test_outcome_status_for_exception(self):
+        self.assertEqual(outcome_status_for_exception(NonFatalDoNotRetryError()), ALREADY_EXISTS)
+        self.assertEqual(outcome_status_for_exception(BackoffRetryError()), RETRYABLE)
+        self.assertEqual(outcome_status_for_exception(RetryError()), RETRYABLE)
+        self.assertEqual(outcome_status_for_exception(DoNotRetryError()), FATAL)
+        self.assertEqual(outcome_status_for_exception(ValueError()), FATAL)
+
+    @patch('ocs_ingester.batch.upload_file_and_ingest_to_archive', return_value={'url': 'http://fake/file'})
+    def test_ingest_path(self, upload_mock):
+        outcome = ingest_path(FITS_FILE, api_root='http://fake/')
+        self.assertEqual(outcome.status, INGESTED)
+        self.assertEqual(outcome.message, 'http://fake/file')
+        self.assertEqual(upload_mock.call_args[1]['path'], FITS_FILE)
+        self.assertEqual(upload_mock.call_args[1]['api_root'], 'http://fake/')
+
+    @patch('ocs_ingester.batch.upload_file_and_ingest_to_archive', side_effect=NonFatalDoNotRetryError('exists'))
+    def test_ingest_paths_in_process(self, upload_mock):
+        outcomes = list(ingest_paths([FITS_FILE, '/does/not/exist.fits']))
+        self.assertEqual([outcome.status for outcome in outcomes], [ALREADY_EXISTS, FATAL])
+        self.assertEqual(upload_mock.call_count, 1)
+
+    def test_ingest_paths_with_worker_processes(self):
+        outcomes = list(ingest_paths([PDF_FILE, '/does/not/exist.fits'], processes=2))
+        self.assertEqual([outcome.path for outcome in outcomes], [PDF_FILE, '/does/not/exist.fits'])
+        self.assertEqual([outcome.status for outcome in outcomes], [FATAL, FATAL])
+
+    def test_worker_processes_share_the_retry_budget(self):
+        with RetryBudgetManager() as manager:
+            budget = manager.RetryBudget(ratio=0, per_second=0, capacity=3)
+            with ProcessPoolExecutor(max_workers=2, initializer=_initialize_worker,
+                                     initargs=(False, {}, budget)) as executor:
+                self.assertEqual(sum(executor.map(withdraw_retries, [2, 2, 2])), 3)
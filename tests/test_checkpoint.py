@@ -0,0 +1,131 @@
+from unittest.mock import MagicMock, patch
+import unittest
+import tempfile
+import hashlib
+import time
+import os
+
+import opentsdb_python_metrics.metric_wrappers
+
+from ocs_ingester.checkpoint import CheckpointJournal, get_checkpoint_journal
+from ocs_ingester.utils.local_state import ProcessLocal
+from ocs_ingester.exceptions import BackoffRetryError, NonFatalDoNotRetryError
+from ocs_ingester.ingester import Ingester, Frame
+from ocs_ingester.retry import Retrier, RetryPolicy
+
+from ocs_archive.storage.s3store import S3Store
+
+opentsdb_python_metrics.metric_wrappers.test_mode = True
+
+
+FITS_FILE = os.path.join(
+    os.path.dirname(__file__),
+    'test_files/fits/coj1m011-kb05-20150219-0125-e90.fits.fz'
+)
+
+
+class TestCheckpointJournal(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.path = os.path.join(self.directory.name, 'checkpoints.sqlite3')
+        self.journal = CheckpointJournal(self.path, ttl=60)
+        self.addCleanup(self.journal.close)
+
+    def test_save_load_and_remove(self):
+        self.journal.save('http://fake/', 'bucket', 'md5', {'key': 'version'}, {'basename': 'frame'})
+        self.assertEqual(self.journal.load('http://fake/', 'bucket', 'md5'),
+                         ({'key': 'version'}, {'basename': 'frame'}))
+        self.assertIsNone(self.journal.load('http://other/', 'bucket', 'md5'))
+        self.assertIsNone(self.journal.load('http://fake/', 'other', 'md5'))
+        self.journal.remove('http://fake/', 'bucket', 'md5')
+        self.assertIsNone(self.journal.load('http://fake/', 'bucket', 'md5'))
+
+    def test_expired_checkpoints(self):
+        with patch('time.time', return_value=time.time() - 120):
+            self.journal.save('http://fake/', 'bucket', 'md5', {}, {})
+        self.assertIsNone(self.journal.load('http://fake/', 'bucket', 'md5'))
+        self.assertEqual(self.journal.evict_expired(), 1)
+
+    def test_get_checkpoint_journal_from_settings(self):
+        with patch('ocs_ingester.settings.settings.CHECKPOINT_PATH', ''):
+            self.assertIsNone(get_checkpoint_journal())
+        with patch('ocs_ingester.settings.settings.CHECKPOINT_PATH', self.path), \
+                patch('ocs_ingester.checkpoint._checkpoint_journal', ProcessLocal()):
+            journal = get_checkpoint_journal()
+            self.addCleanup(journal.close)
+            self.assertIs(get_checkpoint_journal(), journal)
+
+
+class TestIngesterCheckpoints(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.journal = CheckpointJournal(os.path.join(self.directory.name, 'checkpoints.sqlite3'))
+        self.addCleanup(self.journal.close)
+        with open(FITS_FILE, 'rb') as fileobj:
+            self.md5 = hashlib.md5(fileobj.read()).hexdigest()
+        self.filestore = MagicMock(spec=S3Store, bucket='bucket')
+        self.filestore.store_file.return_value = {'key': 'version', 'md5': self.md5, 'extension': '.fits.fz'}
+        self.archive = MagicMock(api_root='http://fake/')
+        self.archive.version_exists.return_value = False
+
+    def ingester(self, filestore=None, **kwargs):
+        fileobj = open(FITS_FILE, 'rb')
+        self.addCleanup(fileobj.close)
+        return Ingester(Frame(fileobj), filestore or self.filestore, self.archive, checkpoints=self.journal, **kwargs)
+
+    def test_failed_post_resumes_without_uploading(self):
+        self.archive.post_frame.side_effect = BackoffRetryError('Archive unavailable')
+        with self.assertRaises(BackoffRetryError):
+            self.ingester().ingest()
+        self.assertIsNotNone(self.journal.load('http://fake/', 'bucket', self.md5))
+
+        self.archive.post_frame.side_effect = lambda record: record
+        record = self.ingester().ingest()
+        self.assertEqual(self.filestore.store_file.call_count, 1)
+        self.assertEqual(record['version_set'], [self.filestore.store_file.return_value])
+        self.assertIsNone(self.journal.load('http://fake/', 'bucket', self.md5))
+
+    def test_resume_when_record_was_posted(self):
+        self.archive.post_frame.side_effect = BackoffRetryError('Archive unavailable')
+        with self.assertRaises(BackoffRetryError):
+            self.ingester().ingest()
+        self.archive.version_exists.return_value = True
+        with self.assertRaises(NonFatalDoNotRetryError):
+            self.ingester().ingest()
+        self.assertEqual(self.archive.post_frame.call_count, 1)
+        self.assertIsNone(self.journal.load('http://fake/', 'bucket', self.md5))
+
+    def test_no_resume_into_another_bucket(self):
+        self.archive.post_frame.side_effect = BackoffRetryError('Archive unavailable')
+        with self.assertRaises(BackoffRetryError):
+            self.ingester().ingest()
+
+        other_filestore = MagicMock(spec=S3Store, bucket='other')
+        other_filestore.store_file.return_value = {'key': 'other', 'md5': self.md5, 'extension': '.fits.fz'}
+        self.archive.post_frame.side_effect = lambda record: record
+        record = self.ingester(filestore=other_filestore).ingest()
+        self.assertEqual(other_filestore.store_file.call_count, 1)
+        self.assertEqual(record['version_set'], [other_filestore.store_file.return_value])
+        # The checkpoint of the upload into the first bucket is left for ingests into that bucket
+        self.assertIsNotNone(self.journal.load('http://fake/', 'bucket', self.md5))
+
+    def test_no_resume_with_other_record(self):
+        self.journal.save('http://fake/', 'bucket', self.md5, {'key': 'version'}, {'basename': 'frame'})
+        self.archive.post_frame.side_effect = lambda record: record
+        record = self.ingester().ingest()
+        self.assertEqual(self.filestore.store_file.call_count, 1)
+        self.assertNotEqual(record['basename'], 'frame')
+
+    @patch('time.sleep')
+    def test_retries_do_not_upload_again(self, sleep_mock):
+        self.archive.post_frame.side_effect = [BackoffRetryError('Archive unavailable'), {'url': 'http://fake/'}]
+        retrier = Retrier({BackoffRetryError: RetryPolicy(max_attempts=2, base_delay=0, max_delay=0)})
+        ingester = self.ingester(retrier=retrier)
+        ingester.checkpoints = None
+        result = ingester.ingest()
+        self.assertEqual(result['url'], 'http://fake/')
+        self.assertEqual(result['ingest_stats']['retries'], 1)
+        self.assertEqual(self.filestore.store_file.call_count, 1)
+        self.assertEqual(self.archive.post_frame.call_count, 2)
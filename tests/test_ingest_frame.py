@@ -0,0 +1,48 @@
+from unittest.mock import MagicMock, patch
+import subprocess
+import unittest
+import hashlib
+import sys
+import os
+
+import opentsdb_python_metrics.metric_wrappers
+
+from ocs_ingester.scripts.ingest_frame import check_frame_exists, check_frames_exist
+
+opentsdb_python_metrics.metric_wrappers.test_mode = True
+
+
+FITS_FILE = os.path.join(
+    os.path.dirname(__file__),
+    'test_files/fits/coj1m011-kb05-20150219-0125-e90.fits.fz'
+)
+
+
+class TestCheckOnly(unittest.TestCase):
+    def setUp(self):
+        with open(FITS_FILE, 'rb') as fileobj:
+            self.md5 = hashlib.md5(fileobj.read()).hexdigest()
+
+    def test_script_does_not_import_the_ingester(self):
+        modules = subprocess.check_output([
+            sys.executable, '-c',
+            'import sys, ocs_ingester.scripts.ingest_frame; print(sorted(sys.modules))'
+        ], env=dict(os.environ, OPENTSDB_PYTHON_METRICS_TEST_MODE='True')).decode()
+        for module in ('ocs_ingester.ingester', 'ocs_archive.input', 'astropy', 'boto3'):
+            self.assertNotIn("'{0}'".format(module), modules)
+
+    @patch('requests.Session.get')
+    def test_check_frame_exists(self, get_mock):
+        get_mock.return_value = MagicMock(status_code=200, json=lambda: {'count': 1})
+        with open(FITS_FILE, 'rb') as fileobj:
+            self.assertTrue(check_frame_exists(fileobj, api_root='http://fake/', auth_token=''))
+        self.assertEqual(get_mock.call_args[0][0], 'http://fake/versions/?md5={0}'.format(self.md5))
+
+    @patch('requests.Session.get')
+    def test_check_frames_exist(self, get_mock):
+        get_mock.return_value = MagicMock(
+            status_code=200, json=lambda: {'count': 1, 'results': [{'md5': self.md5}]}
+        )
+        report = check_frames_exist([FITS_FILE, '/does/not/exist.fits'], api_root='http://fake/', auth_token='')
+        self.assertEqual(report['exists'], {FITS_FILE: True})
+        self.assertEqual(list(report['errors']), ['/does/not/exist.fits'])
@@ -1,8 +1,8 @@
 from unittest.mock import MagicMock, patch
+import threading
 import unittest
 import os
 import io
-import tarfile
 import hashlib
 from copy import copy
 
@@ -11,10 +11,14 @@ import dateutil
 
 from ocs_archive.input.file import File
 from ocs_archive.input.filefactory import FileFactory
-
-from ocs_ingester.ingester import (Ingester, upload_file_and_ingest_to_archive, ingest_archive_record,
-                                   upload_file_to_file_store, validate_fits_and_create_archive_record)
-from ocs_ingester.exceptions import DoNotRetryError, NonFatalDoNotRetryError
+from ocs_archive.storage.filestore import FileStore, FileStoreConnectionError
+from ocs_archive.storage.s3store import S3Store
+
+from ocs_ingester.ingester import (Ingester, Frame, upload_file_and_ingest_to_archive, ingest_archive_record,
+                                   upload_file_to_file_store, validate_fits_and_create_archive_record, frame_exists)
+from ocs_ingester.exceptions import BackoffRetryError, DoNotRetryError, NonFatalDoNotRetryError
+from ocs_ingester.utils.hashing import HashingReader
+from ocs_ingester.deadline import Deadline, get_current_deadline
 from ocs_ingester.settings import settings
 
 opentsdb_python_metrics.metric_wrappers.test_mode = True
@@ -70,10 +74,10 @@ archive_mock.version_exists.return_value = False
 filestore_mock = MagicMock()
 filestore_mock.store_file = MagicMock(return_value={'md5': 'fakemd5'})
 
-def mocked_ingester(datafile_real, fake_filestore, fake_archive):
+def mocked_ingester(datafile_real, fake_filestore, fake_archive, **kwargs):
     class MockIngester(Ingester):
         def __init__(self):
-            super().__init__(datafile_real, filestore_mock, archive_mock)
+            super().__init__(datafile_real, filestore_mock, archive_mock, **kwargs)
 
     return MockIngester()
 
@@ -90,7 +94,7 @@ class TestIngesterMethods(unittest.TestCase):
             version = upload_file_to_file_store(fileobj)
             self.assertIn('md5', version)
 
-    @patch('requests.post')
+    @patch('requests.Session.post')
     def test_ingest_archive_record(self, post_mock):
         with open(FITS_FILE, 'rb') as fileobj:
             archive_record = validate_fits_and_create_archive_record(fileobj)
@@ -99,12 +103,57 @@ class TestIngesterMethods(unittest.TestCase):
             self.assertTrue(post_mock.called)
 
 
+class TestFrame(unittest.TestCase):
+    def test_frame_parsed_once_across_steps(self):
+        with open(FITS_FILE, 'rb') as fileobj:
+            frame = Frame(fileobj)
+            with patch.object(frame.datafile, 'get_wcs_corners', wraps=frame.datafile.get_wcs_corners) as wcs_mock, \
+                    patch('ocs_ingester.frame.get_md5_and_collect_metrics', return_value='fakemd5') as md5_mock, \
+                    patch('ocs_ingester.archive.ArchiveService.version_exists', return_value=False):
+                self.assertFalse(frame_exists(frame, api_root='http://fake/'))
+                record = validate_fits_and_create_archive_record(frame)
+                version = upload_file_to_file_store(frame)
+                Ingester(frame, filestore_mock, archive_mock).ingest()
+            self.assertEqual(wcs_mock.call_count, 1)
+            self.assertEqual(md5_mock.call_count, 1)
+            self.assertEqual(record['area']['type'], 'Polygon')
+            self.assertIn('md5', version)
+
+    def test_ingest_stats(self):
+        archive = MagicMock()
+        archive.version_exists.return_value = False
+        archive.post_frame.side_effect = lambda record: record
+        with open(FITS_FILE, 'rb') as fileobj:
+            frame = Frame(fileobj)
+            with patch('ocs_ingester.settings.settings.INGEST_STAGE_METRICS', True), \
+                    patch('ocs_ingester.utils.metrics.IngestStats.send_metrics') as send_metrics_mock:
+                record = Ingester(frame, MagicMock(wraps=FileStore()), archive).ingest()
+            stats = record['ingest_stats']
+            self.assertEqual(set(stats['stages']), {'parse', 'md5', 'exists', 'upload', 'headers', 'wcs', 'post'})
+            self.assertEqual(stats['bytes'], os.path.getsize(FITS_FILE))
+            self.assertEqual(stats['retries'], 0)
+            send_metrics_mock.assert_called_once_with(instrument_id='kb05', extension='.fits.fz')
+
+    def test_archive_record_is_a_copy(self):
+        with open(FITS_FILE, 'rb') as fileobj:
+            frame = Frame(fileobj)
+            frame.archive_record['version_set'] = []
+            self.assertNotIn('version_set', frame.archive_record)
+
+    def test_frame_rejects_missing_required_headers(self):
+        with open(FITS_FILE, 'rb') as fileobj:
+            with self.assertRaises(DoNotRetryError):
+                Frame(fileobj, required_headers=['fooheader']).datafile
+
+
 class TestIngester(unittest.TestCase):
     def setUp(self):
         # Since these are globally used mocks, we should reset them at the start of each test in here
         filestore_mock.reset_mock()
         archive_mock.reset_mock()
-        hashlib.md5 = MagicMock(side_effect=mock_hashlib_md5)
+        md5_patcher = patch('hashlib.md5', side_effect=mock_hashlib_md5)
+        md5_patcher.start()
+        self.addCleanup(md5_patcher.stop)
         self.open_files = [File(open(os.path.join(FITS_PATH, f), 'rb')) for f in os.listdir(FITS_PATH)]
         self.data_files = [FileFactory.get_datafile_class_for_extension(open_file.extension)(open_file) for open_file in self.open_files]
         self.mock_metadata = {'PROPID': 'INGEST-TEST-2021',
@@ -162,6 +211,19 @@ class TestIngester(unittest.TestCase):
         self.assertFalse(archive_mock.post_frame.called)
         archive_mock.version_exists.return_value = False
 
+    def test_ingest_file_store_connection_error(self):
+        filestore_mock.store_file.side_effect = FileStoreConnectionError('Connection was closed')
+        self.addCleanup(setattr, filestore_mock.store_file, 'side_effect', None)
+        with self.assertRaises(BackoffRetryError):
+            self.ingesters[0].ingest()
+        self.assertFalse(archive_mock.post_frame.called)
+
+    @patch('ocs_ingester.ingester.get_file_store', return_value=filestore_mock)
+    @patch('ocs_ingester.ingester.Ingester', side_effect=mocked_ingester)
+    def test_bucket(self, ingester_mock, get_file_store_mock):
+        upload_file_and_ingest_to_archive(self.open_files[0].fileobj, bucket='otherbucket')
+        get_file_store_mock.assert_called_with(bucket='otherbucket')
+
     @patch('ocs_ingester.ingester.Ingester', side_effect=mocked_ingester)
     def test_required(self, ingester_mock):
         required_headers = ['fooheader']
@@ -236,8 +298,8 @@ class TestIngester(unittest.TestCase):
             self.assertTrue(dateutil.parser.parse(archive_mock.post_frame.call_args[0][0]['public_date']))
 
     @patch('ocs_ingester.ingester.Ingester', side_effect=mocked_ingester)
-    def test_spectrograph_missing_meta(self, ingester_mock):
-        tarfile.TarFile.getmembers = MagicMock(return_value=[])
+    @patch('tarfile.TarFile.getmembers', return_value=[])
+    def test_spectrograph_missing_meta(self, getmembers_mock, ingester_mock):
         with self.assertRaises(DoNotRetryError):
             with open(SPECTRO_FILE, 'rb') as fileobj:
                 upload_file_and_ingest_to_archive(fileobj)
@@ -282,3 +344,216 @@ class TestIngester(unittest.TestCase):
             upload_file_and_ingest_to_archive(fileobj, file_metadata=self.mock_metadata)
             self.assertTrue(filestore_mock.store_file.called)
             self.assertTrue(archive_mock.post_frame.called)
+
+
+class TestStreamingIngester(unittest.TestCase):
+    def setUp(self):
+        self.fileobj = open(FITS_FILE, 'rb')
+        self.addCleanup(self.fileobj.close)
+        self.datafile = FileFactory.get_datafile_class_for_extension('.fits.fz')(File(self.fileobj))
+        self.md5 = hashlib.md5(self.datafile.open_file.get_from_start().read()).hexdigest()
+        self.archive = MagicMock()
+        self.archive.version_exists.return_value = False
+
+    def test_hashing_reader_rereads(self):
+        reader = HashingReader(self.fileobj)
+        reader.seek(0)
+        reader.read(100)
+        reader.seek(0)
+        reader.read(1000)
+        reader.read(10)
+        self.assertEqual(reader.hexdigest(), self.md5)
+        self.assertEqual(reader.tell(), 1010)
+
+    def test_ingest_streaming(self):
+        filestore = MagicMock(wraps=FileStore())
+        ingester = Ingester(self.datafile, filestore, self.archive, streaming=True)
+        ingester.ingest()
+        self.archive.version_exists.assert_called_once_with(self.md5)
+        self.assertEqual(self.archive.post_frame.call_args[0][0]['version_set'][0]['md5'], self.md5)
+        self.assertIs(self.datafile.open_file.fileobj, self.fileobj)
+
+    def test_ingest_streaming_reads_file_once(self):
+        filestore = MagicMock()
+        filestore.store_file.side_effect = lambda data_file: {
+            'md5': hashlib.md5(data_file.open_file.get_from_start().read()).hexdigest(), 'key': 'version'
+        }
+        with patch.object(File, 'get_md5') as get_md5_mock:
+            Ingester(self.datafile, filestore, self.archive, streaming=True).ingest()
+        self.assertFalse(get_md5_mock.called)
+        self.assertTrue(self.archive.post_frame.called)
+
+    def test_ingest_streaming_already_exists(self):
+        self.archive.version_exists.return_value = True
+        filestore = MagicMock(spec=S3Store)
+        filestore.store_file.return_value = {'md5': self.md5, 'key': 'version'}
+        with self.assertRaises(NonFatalDoNotRetryError):
+            Ingester(self.datafile, filestore, self.archive, streaming=True).ingest()
+        filestore.delete_file.assert_called_once_with(self.datafile.get_filestore_path(), 'version')
+        self.assertFalse(self.archive.post_frame.called)
+
+
+class TestConcurrentIngester(unittest.TestCase):
+    def setUp(self):
+        with open(FITS_FILE, 'rb') as fileobj:
+            self.data = fileobj.read()
+        self.md5 = hashlib.md5(self.data).hexdigest()
+        self.archive = MagicMock()
+        self.archive.version_exists.return_value = False
+        self.archive.post_frame.side_effect = lambda record: record
+        self.filestore = MagicMock()
+        self.filestore.store_file.return_value = {'md5': self.md5, 'key': 'version'}
+
+    def ingest(self, fileobj, path=None):
+        frame = Frame(fileobj, path)
+        result = Ingester(frame, self.filestore, self.archive, concurrent=True).ingest()
+        return frame, result
+
+    def test_ingest_file_concurrently(self):
+        with open(FITS_FILE, 'rb') as fileobj, patch.object(File, 'get_md5') as get_md5_mock:
+            frame, result = self.ingest(fileobj)
+        self.assertFalse(get_md5_mock.called)
+        self.assertEqual(frame.md5, self.md5)
+        self.archive.version_exists.assert_called_once_with(self.md5)
+        self.assertEqual(result['area']['type'], 'Polygon')
+        self.assertEqual(result['version_set'][0]['md5'], self.md5)
+        self.assertIn('exists', result['ingest_stats']['stages'])
+
+    def test_ingest_in_memory_file_concurrently(self):
+        with patch.object(File, 'get_md5') as get_md5_mock:
+            frame, _ = self.ingest(io.BytesIO(self.data), path=FITS_FILE)
+        self.assertFalse(get_md5_mock.called)
+        self.assertEqual(frame.md5, self.md5)
+
+    def test_file_without_independent_reader_is_hashed_afterwards(self):
+        fileobj = HashingReader(io.BytesIO(self.data))
+        frame, _ = self.ingest(fileobj, path=FITS_FILE)
+        self.assertEqual(frame.md5, self.md5)
+        self.archive.version_exists.assert_called_once_with(self.md5)
+
+    def test_ingest_already_exists_concurrently(self):
+        self.archive.version_exists.return_value = True
+        with open(FITS_FILE, 'rb') as fileobj:
+            with self.assertRaises(NonFatalDoNotRetryError):
+                self.ingest(fileobj)
+        self.assertFalse(self.filestore.store_file.called)
+
+    def test_invalid_file_is_rejected_before_the_exists_error(self):
+        self.archive.version_exists.side_effect = BackoffRetryError('Archive is down')
+        with open(FITS_FILE, 'rb') as fileobj:
+            with self.assertRaises(DoNotRetryError):
+                Ingester(Frame(fileobj, required_headers=['fooheader']), self.filestore, self.archive,
+                         concurrent=True).ingest()
+        self.assertFalse(self.filestore.store_file.called)
+
+
+class TestSpeculativeIngester(unittest.TestCase):
+    def setUp(self):
+        self.fileobj = open(FITS_FILE, 'rb')
+        self.addCleanup(self.fileobj.close)
+        self.frame = Frame(self.fileobj)
+        self.md5 = hashlib.md5(self.fileobj.read()).hexdigest()
+        self.archive = MagicMock()
+        self.archive.version_exists.return_value = False
+        self.archive.post_frame.side_effect = lambda record: record
+        self.filestore = MagicMock(spec=S3Store)
+        self.filestore.store_file.return_value = {'md5': self.md5, 'key': 'version'}
+        patcher = patch('ocs_ingester.ingester.count_metric')
+        self.count_metric_mock = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def ingest(self, ingester=None):
+        return (ingester or Ingester(self.frame, self.filestore, self.archive, speculative=True)).ingest()
+
+    def test_upload_overlaps_exists_check(self):
+        uploading = threading.Event()
+
+        def version_exists(md5):
+            # Only returns once the upload has started
+            return not uploading.wait(timeout=10)
+
+        def store_file(data_file):
+            uploading.set()
+            return {'md5': self.md5, 'key': 'version'}
+
+        self.archive.version_exists.side_effect = version_exists
+        self.filestore.store_file.side_effect = store_file
+        result = self.ingest()
+        self.assertEqual(result['version_set'][0]['md5'], self.md5)
+        self.count_metric_mock.assert_called_once_with('ingester.speculative_uploads', extension='.fits.fz',
+                                                       wasted='false')
+
+    def test_wasted_upload_is_discarded(self):
+        self.archive.version_exists.return_value = True
+        with self.assertRaises(NonFatalDoNotRetryError):
+            self.ingest()
+        self.filestore.delete_file.assert_called_once_with(self.frame.datafile.get_filestore_path(), 'version')
+        self.assertFalse(self.archive.post_frame.called)
+        self.count_metric_mock.assert_called_once_with('ingester.speculative_uploads', extension='.fits.fz',
+                                                       wasted='true')
+
+    def test_existing_file_takes_precedence_over_failed_upload(self):
+        self.archive.version_exists.return_value = True
+        self.filestore.store_file.side_effect = FileStoreConnectionError('Connection was closed')
+        with self.assertRaises(NonFatalDoNotRetryError):
+            self.ingest()
+
+    def test_failed_upload_takes_precedence_over_failed_check(self):
+        self.archive.version_exists.side_effect = DoNotRetryError('Archive rejected the check')
+        self.filestore.store_file.side_effect = FileStoreConnectionError('Connection was closed')
+        with self.assertRaisesRegex(BackoffRetryError, 'Connection was closed'):
+            self.ingest()
+
+    def test_upload_is_kept_when_exists_check_fails(self):
+        self.archive.version_exists.side_effect = [BackoffRetryError('Archive is down'), False]
+        ingester = Ingester(self.frame, self.filestore, self.archive, speculative=True)
+        with self.assertRaises(BackoffRetryError):
+            self.ingest(ingester)
+        self.ingest(ingester)
+        self.assertEqual(self.filestore.store_file.call_count, 1)
+        self.assertFalse(self.filestore.delete_file.called)
+        self.assertTrue(self.archive.post_frame.called)
+
+
+class TestIngestDeadline(unittest.TestCase):
+    def setUp(self):
+        self.fileobj = open(FITS_FILE, 'rb')
+        self.addCleanup(self.fileobj.close)
+        self.frame = Frame(self.fileobj)
+        self.archive = MagicMock()
+        self.archive.version_exists.return_value = False
+        self.filestore = MagicMock()
+        self.filestore.store_file.side_effect = lambda data_file: {'md5': self.frame.md5, 'key': 'version'}
+
+    def test_deadline_passed_before_upload(self):
+        with self.assertRaises(BackoffRetryError):
+            Ingester(self.frame, self.filestore, self.archive, deadline=Deadline(0)).ingest()
+        self.assertFalse(self.archive.version_exists.called)
+        self.assertFalse(self.filestore.store_file.called)
+
+    def test_deadline_passed_during_upload(self):
+        deadline = Deadline(60)
+
+        def store_file(data_file):
+            self.assertIs(get_current_deadline(), deadline)
+            deadline.expires_at = 0
+            return {'md5': self.frame.md5, 'key': 'version'}
+
+        self.filestore.store_file.side_effect = store_file
+        ingester = Ingester(self.frame, self.filestore, self.archive, deadline=deadline)
+        with self.assertRaises(BackoffRetryError):
+            ingester.ingest()
+        self.assertFalse(self.archive.post_frame.called)
+        self.assertIsNone(get_current_deadline())
+        # The upload is kept for a retry with more time
+        self.assertEqual(ingester.version['key'], 'version')
+
+    @patch('requests.Session.get')
+    def test_deadline_setting(self, get_mock):
+        with patch('ocs_ingester.settings.settings.INGEST_DEADLINE', 1e-9), \
+                patch('ocs_ingester.ingester.get_file_store', return_value=self.filestore):
+            with self.assertRaises(BackoffRetryError):
+                upload_file_and_ingest_to_archive(self.fileobj, api_root='http://fake/')
+        self.assertFalse(get_mock.called)
+        self.assertFalse(self.filestore.store_file.called)
+
@@ -0,0 +1,101 @@
+from unittest.mock import MagicMock, patch
+import unittest
+import tempfile
+import time
+import os
+
+from ocs_ingester.archive import ArchiveService
+from ocs_ingester.md5_index import Md5Index, get_md5_index
+from ocs_ingester.utils.local_state import ProcessLocal
+
+
+def mocked_response(json_data):
+    response = MagicMock()
+    response.json.return_value = json_data
+    return response
+
+
+class TestMd5Index(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.path = os.path.join(self.directory.name, 'md5s.sqlite3')
+        self.index = Md5Index(self.path, ttl=60)
+        self.addCleanup(self.index.close)
+
+    def test_add_and_contains(self):
+        self.index.add('http://fake/', ['md5a', 'md5b'])
+        self.assertTrue(self.index.contains('http://fake/', 'md5a'))
+        self.assertFalse(self.index.contains('http://fake/', 'md5c'))
+        self.assertFalse(self.index.contains('http://other/', 'md5a'))
+        self.assertEqual(self.index.contains_many('http://fake/', ['md5a', 'md5b', 'md5c']), {'md5a', 'md5b'})
+
+    def test_persisted(self):
+        self.index.add('http://fake/', ['md5a'])
+        reopened = Md5Index(self.path, ttl=60)
+        self.addCleanup(reopened.close)
+        self.assertTrue(reopened.contains('http://fake/', 'md5a'))
+
+    def test_expired_entries(self):
+        with patch('time.time', return_value=time.time() - 120):
+            self.index.add('http://fake/', ['old'])
+        self.index.add('http://fake/', ['new'])
+        self.assertFalse(self.index.contains('http://fake/', 'old'))
+        self.assertEqual(self.index.evict_expired(), 1)
+        self.assertTrue(self.index.contains('http://fake/', 'new'))
+
+    @patch('requests.Session.get')
+    def test_warm_up(self, get_mock):
+        get_mock.side_effect = [
+            mocked_response({'count': 3, 'next': 'http://fake/versions/?offset=2',
+                             'results': [{'md5': 'md5a'}, {'md5': 'md5b'}]}),
+            mocked_response({'count': 3, 'next': None, 'results': [{'md5': 'md5c'}]}),
+        ]
+        archive = ArchiveService(api_root='http://fake/', auth_token='', md5_index=self.index)
+        self.assertEqual(self.index.warm_up(archive, created_after='2019-10-01'), 3)
+        self.assertEqual(get_mock.call_args_list[0][1]['params'], {'limit': 1000, 'created_after': '2019-10-01'})
+        self.assertEqual(get_mock.call_args_list[1][0][0], 'http://fake/versions/?offset=2')
+        self.assertEqual(self.index.contains_many('http://fake/', ['md5a', 'md5b', 'md5c']), {'md5a', 'md5b', 'md5c'})
+
+    @patch('requests.Session.get')
+    def test_archive_consults_index(self, get_mock):
+        get_mock.return_value = mocked_response({'count': 1})
+        archive = ArchiveService(api_root='http://fake/', auth_token='', md5_index=self.index)
+        self.assertTrue(archive.version_exists('md5a'))
+        self.assertTrue(archive.version_exists('md5a'))
+        self.assertEqual(get_mock.call_count, 1)
+        self.assertTrue(self.index.contains('http://fake/', 'md5a'))
+
+    @patch('requests.Session.get')
+    def test_archive_does_not_index_missing_versions(self, get_mock):
+        get_mock.return_value = mocked_response({'count': 0})
+        archive = ArchiveService(api_root='http://fake/', auth_token='', md5_index=self.index)
+        self.assertFalse(archive.version_exists('md5a'))
+        self.assertFalse(archive.version_exists('md5a'))
+        self.assertEqual(get_mock.call_count, 2)
+
+    @patch('requests.Session.get')
+    def test_versions_exist_only_checks_unknown_md5s(self, get_mock):
+        get_mock.return_value = mocked_response({'count': 1, 'results': [{'md5': 'md5b'}]})
+        self.index.add('http://fake/', ['md5a'])
+        archive = ArchiveService(api_root='http://fake/', auth_token='', md5_index=self.index)
+        self.assertEqual(archive.versions_exist(['md5a', 'md5b', 'md5c']), {'md5a': True, 'md5b': True, 'md5c': False})
+        self.assertEqual(get_mock.call_args[1]['params']['md5__in'], 'md5b,md5c')
+        self.assertTrue(self.index.contains('http://fake/', 'md5b'))
+
+    @patch('requests.Session.post')
+    def test_posted_frames_are_indexed(self, post_mock):
+        post_mock.return_value = mocked_response({'id': 1})
+        archive = ArchiveService(api_root='http://fake/', auth_token='', md5_index=self.index)
+        archive.post_frame({'observation_date': '2019-10-13T10:13:00', 'version_set': [{'md5': 'md5a'}]})
+        self.assertTrue(self.index.contains('http://fake/', 'md5a'))
+
+    def test_get_md5_index_from_settings(self):
+        with patch('ocs_ingester.settings.settings.MD5_INDEX_PATH', ''):
+            self.assertIsNone(get_md5_index())
+        with patch('ocs_ingester.settings.settings.MD5_INDEX_PATH', self.path), \
+                patch('ocs_ingester.md5_index._md5_index', ProcessLocal()):
+            index = get_md5_index()
+            self.addCleanup(index.close)
+            self.assertIs(get_md5_index(), index)
+            self.assertEqual(index.path, self.path)
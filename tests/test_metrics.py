@@ -0,0 +1,99 @@
+from unittest.mock import MagicMock, patch
+import unittest
+
+from ocs_ingester.utils import metrics
+from ocs_ingester.utils.metrics import MetricAggregator
+
+
+class TestMetricAggregator(unittest.TestCase):
+    def setUp(self):
+        self.send = MagicMock()
+        self.aggregator = MetricAggregator(send=self.send)
+
+    def sent(self):
+        return {(args[0], tuple(sorted(kwargs.items()))): args[1] for args, kwargs in self.send.call_args_list}
+
+    def test_histogram_summary(self):
+        for value in range(1, 101):
+            self.aggregator.record('ingester.upload_file.runtime', value, site='coj')
+        self.aggregator.record('ingester.upload_file.runtime', 1000, site='ogg')
+        self.aggregator.flush()
+        sent = self.sent()
+        tags = (('asynchronous', False), ('site', 'coj'))
+        self.assertEqual(sent[('ingester.upload_file.runtime', tags)], 50.5)
+        self.assertEqual(sent[('ingester.upload_file.runtime.count', tags)], 100)
+        self.assertEqual(sent[('ingester.upload_file.runtime.max', tags)], 100)
+        self.assertEqual(sent[('ingester.upload_file.runtime.p50', tags)], 51)
+        self.assertEqual(sent[('ingester.upload_file.runtime.p99', tags)], 100)
+        self.assertEqual(sent[('ingester.upload_file.runtime', (('asynchronous', False), ('site', 'ogg')))], 1000)
+
+    def test_counters(self):
+        self.aggregator.increment('ingester.retries', error='BackoffRetryError')
+        self.aggregator.increment('ingester.retries', 2, error='BackoffRetryError')
+        self.aggregator.flush()
+        self.send.assert_called_once_with('ingester.retries', 3, asynchronous=False, error='BackoffRetryError')
+
+    def test_flush_resets(self):
+        self.aggregator.record('ingester.ingest_lag', 1)
+        self.aggregator.flush()
+        self.send.reset_mock()
+        self.aggregator.flush()
+        self.assertFalse(self.send.called)
+
+    def test_samples_are_bounded(self):
+        for value in range(10000):
+            self.aggregator.record('ingester.ingest_lag', value)
+        histogram = list(self.aggregator._histograms.values())[0]
+        self.assertEqual(len(histogram.samples), histogram.MAX_SAMPLES)
+        self.assertEqual(histogram.count, 10000)
+
+
+@patch('opentsdb_python_metrics.metric_wrappers.test_mode', False)
+class TestSendMetric(unittest.TestCase):
+    def setUp(self):
+        self.aggregator = MetricAggregator(send=MagicMock())
+
+    def test_metrics_are_aggregated(self):
+        with patch('ocs_ingester.utils.metrics.get_metric_aggregator', return_value=self.aggregator), \
+                patch('ocs_ingester.utils.metrics.send_tsdb_metric') as send_mock:
+            metrics.send_metric('ingester.ingest_lag', 10)
+            metrics.count_metric('ingester.retries')
+        self.assertFalse(send_mock.called)
+        self.assertEqual(len(self.aggregator._histograms), 1)
+        self.assertEqual(list(self.aggregator._counters.values()), [1])
+
+    def test_metrics_are_sent_without_aggregator(self):
+        with patch('ocs_ingester.settings.settings.METRICS_FLUSH_INTERVAL', 0), \
+                patch('ocs_ingester.utils.metrics.send_tsdb_metric') as send_mock:
+            metrics.send_metric('ingester.ingest_lag', 10, class_path='path')
+        send_mock.assert_called_once_with('ingester.ingest_lag', 10, asynchronous=False,
+                                          ingester_process_name='ingester', class_path='path')
+
+    def test_method_timer(self):
+        class Timed(object):
+            @metrics.method_timer('ingester.timed')
+            def run(self):
+                return 'done'
+
+        with patch('ocs_ingester.utils.metrics.get_metric_aggregator', return_value=self.aggregator):
+            self.assertEqual(Timed().run(), 'done')
+        (metric_name, tags), = self.aggregator._histograms.keys()
+        self.assertEqual(metric_name, 'ingester.timed.runtime')
+        self.assertIn(('class_path', 'test_metrics.Timed.run'), tags)
+
+    def test_method_timer_tags_match_without_aggregator(self):
+        @metrics.method_timer('ingester.timed')
+        def store(filestore, datafile):
+            return datafile
+
+        class FileStore(object):
+            pass
+
+        with patch('ocs_ingester.utils.metrics.get_metric_aggregator', return_value=self.aggregator):
+            self.assertEqual(store(FileStore(), 'file'), 'file')
+        (_, tags), = self.aggregator._histograms.keys()
+        with patch('ocs_ingester.utils.metrics.get_metric_aggregator', return_value=None), \
+                patch('opentsdb_python_metrics.metric_wrappers.send_tsdb_metric') as send_mock:
+            self.assertEqual(store(FileStore(), 'file'), 'file')
+        self.assertEqual(dict(tags)['class_path'], send_mock.call_args[1]['class_path'])
+        self.assertEqual(dict(tags)['class_path'], 'test_metrics.FileStore.store')
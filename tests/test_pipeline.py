@@ -0,0 +1,188 @@
+from unittest.mock import MagicMock, patch
+import unittest
+import threading
+import os
+
+import opentsdb_python_metrics.metric_wrappers
+
+from ocs_ingester.pipeline import IngestPipeline
+from ocs_ingester.frame import Frame
+from ocs_ingester.exceptions import BackoffRetryError, DoNotRetryError, NonFatalDoNotRetryError
+
+from ocs_archive.storage.filestore import FileStoreConnectionError
+
+opentsdb_python_metrics.metric_wrappers.test_mode = True
+
+
+FITS_PATH = os.path.join(
+    os.path.dirname(__file__),
+    'test_files/fits/'
+)
+
+FITS_FILE = os.path.join(
+    FITS_PATH,
+    'coj1m011-kb05-20150219-0125-e90.fits.fz'
+)
+
+CAT_FILE = os.path.join(
+    FITS_PATH,
+    'cpt1m010-kb70-20151219-0073-e10_cat.fits.fz'
+)
+
+
+class TestIngestPipeline(unittest.TestCase):
+    def setUp(self):
+        self.archive = MagicMock()
+        self.archive.with_deadline.return_value = self.archive
+        self.archive.version_exists.return_value = False
+        self.archive.post_frame.side_effect = lambda record: dict(record, url='http://fake/' + record['basename'])
+        self.filestore = MagicMock()
+        self.filestore.store_file.side_effect = lambda data_file: {
+            'md5': data_file.open_file.get_md5(), 'key': 'version', 'extension': data_file.open_file.extension
+        }
+
+    def open_frames(self, paths, **kwargs):
+        frames = [Frame(open(path, 'rb'), **kwargs) for path in paths]
+        for frame in frames:
+            self.addCleanup(frame.open_file.fileobj.close)
+        return frames
+
+    def test_run(self):
+        frames = self.open_frames([FITS_FILE, CAT_FILE, FITS_FILE])
+        results = list(IngestPipeline(self.filestore, self.archive).run(frames))
+        self.assertEqual(len(results), 3)
+        self.assertTrue(all(result.error is None for result in results))
+        self.assertEqual(
+            sorted(result.record['url'] for result in results),
+            ['http://fake/coj1m011-kb05-20150219-0125-e90'] * 2 + ['http://fake/cpt1m010-kb70-20151219-0073-e10_cat']
+        )
+        self.assertEqual(self.archive.post_frame.call_count, 3)
+
+    def test_existing_frames_skip_remaining_stages(self):
+        self.archive.version_exists.return_value = True
+        frames = self.open_frames([FITS_FILE, CAT_FILE])
+        results = list(IngestPipeline(self.filestore, self.archive).run(frames))
+        self.assertTrue(all(isinstance(result.error, NonFatalDoNotRetryError) for result in results))
+        self.assertTrue(all(frame._datafile is None for frame in frames))
+        self.assertFalse(self.filestore.store_file.called)
+        self.assertFalse(self.archive.post_frame.called)
+
+    def test_invalid_frame_does_not_stop_others(self):
+        bad_frame = self.open_frames([FITS_FILE], required_headers=['fooheader'])[0]
+        frames = self.open_frames([CAT_FILE]) + [bad_frame]
+        results = {result.frame: result for result in IngestPipeline(self.filestore, self.archive).run(frames)}
+        self.assertIsInstance(results[bad_frame].error, DoNotRetryError)
+        self.assertIsNone(results[frames[0]].error)
+        self.assertEqual(self.archive.post_frame.call_count, 1)
+
+    def test_stages_overlap(self):
+        frames = self.open_frames([FITS_FILE, CAT_FILE])
+        second_frame_parsed = threading.Event()
+        overlapped = []
+
+        def store_file(data_file):
+            if data_file is frames[0].datafile:
+                # The second frame is parsed while the first is still uploading
+                overlapped.append(second_frame_parsed.wait(timeout=10))
+            return {'md5': data_file.open_file.get_md5(), 'key': 'version'}
+
+        self.filestore.store_file.side_effect = store_file
+        original_parse = IngestPipeline._parse
+
+        def parse(pipeline, item):
+            original_parse(pipeline, item)
+            if item.ingester.frame is frames[1]:
+                second_frame_parsed.set()
+
+        pipeline = IngestPipeline(self.filestore, self.archive, workers={'upload': 1})
+        pipeline._parse = lambda item: parse(pipeline, item)
+        results = list(pipeline.run(frames))
+        self.assertEqual(overlapped, [True])
+        self.assertTrue(all(result.error is None for result in results))
+
+    @patch('ocs_ingester.settings.settings.RETRY_MAX_ATTEMPTS', 2)
+    @patch('ocs_ingester.settings.settings.RETRY_BASE_DELAY', 0)
+    def test_ingests_are_retried(self):
+        self.archive.post_frame.side_effect = [BackoffRetryError('Archive unavailable'), {'url': 'http://fake/'}]
+        results = list(IngestPipeline(self.filestore, self.archive).run(self.open_frames([FITS_FILE])))
+        self.assertEqual(results[0].record['url'], 'http://fake/')
+        self.assertEqual(results[0].record['ingest_stats']['retries'], 1)
+        self.assertEqual(self.filestore.store_file.call_count, 1)
+
+    @patch('ocs_ingester.settings.settings.RETRY_MAX_ATTEMPTS', 2)
+    @patch('ocs_ingester.settings.settings.RETRY_BASE_DELAY', 0)
+    def test_uploads_are_retried_on_their_own(self):
+        self.filestore.store_file.side_effect = [
+            FileStoreConnectionError('S3 unavailable'), {'md5': Frame(open(FITS_FILE, 'rb')).md5, 'key': 'version'}
+        ]
+        results = list(IngestPipeline(self.filestore, self.archive).run(self.open_frames([FITS_FILE])))
+        self.assertEqual(results[0].record['ingest_stats']['retries'], 1)
+        self.assertEqual(self.filestore.store_file.call_count, 2)
+        self.assertEqual(self.archive.post_frame.call_count, 1)
+
+    @patch('ocs_ingester.settings.settings.RETRY_MAX_ATTEMPTS', 2)
+    @patch('ocs_ingester.settings.settings.RETRY_BASE_DELAY', 0)
+    def test_retried_post_that_was_posted(self):
+        self.archive.post_frame.side_effect = BackoffRetryError('Archive timed out')
+        self.archive.version_exists.side_effect = [False, True]
+        results = list(IngestPipeline(self.filestore, self.archive).run(self.open_frames([FITS_FILE])))
+        self.assertIsInstance(results[0].error, NonFatalDoNotRetryError)
+        self.assertEqual(self.archive.post_frame.call_count, 1)
+
+    def test_posts_overlap_uploads(self):
+        frames = self.open_frames([FITS_FILE, CAT_FILE])
+        first_frame_posted = threading.Event()
+        uploads = []
+        overlapped = []
+
+        def store_file(data_file):
+            uploads.append(data_file)
+            if len(uploads) == 2:
+                # The first frame is posted by the post stage while the single upload worker uploads the second
+                overlapped.append(first_frame_posted.wait(timeout=10))
+            return {'md5': data_file.open_file.get_md5(), 'key': 'version'}
+
+        def post_frame(record):
+            first_frame_posted.set()
+            return dict(record, url='http://fake/')
+
+        self.filestore.store_file.side_effect = store_file
+        self.archive.post_frame.side_effect = post_frame
+        pipeline = IngestPipeline(self.filestore, self.archive, workers={'upload': 1, 'post': 1})
+        results = list(pipeline.run(frames))
+        self.assertEqual(overlapped, [True])
+        self.assertTrue(all(result.error is None for result in results))
+
+    def test_deadline(self):
+        results = list(IngestPipeline(self.filestore, self.archive, deadline=1e-9).run(self.open_frames([FITS_FILE])))
+        self.assertIsInstance(results[0].error, BackoffRetryError)
+        self.assertFalse(self.filestore.store_file.called)
+
+    def test_archive_requests_have_the_deadline_of_their_frame(self):
+        list(IngestPipeline(self.filestore, self.archive, deadline=60).run(self.open_frames([FITS_FILE, CAT_FILE])))
+        deadlines = [args[0][0] for args in self.archive.with_deadline.call_args_list]
+        self.assertEqual([deadline.seconds for deadline in deadlines], [60, 60])
+        self.assertIsNot(deadlines[0], deadlines[1])
+
+    def test_frames_error_is_raised(self):
+        frames = self.open_frames([FITS_FILE, CAT_FILE])
+
+        def iterate_frames():
+            yield frames[0]
+            yield frames[1]
+            raise OSError('Could not list files')
+
+        results = []
+        with self.assertRaisesRegex(OSError, 'Could not list files'):
+            for result in IngestPipeline(self.filestore, self.archive).run(iterate_frames()):
+                results.append(result)
+        self.assertEqual(len(results), 2)
+
+    def test_threads_are_joined_when_stopped_early(self):
+        threads = set(threading.enumerate())
+        frames = self.open_frames([FITS_FILE, CAT_FILE] * 10)
+        results = IngestPipeline(self.filestore, self.archive, queue_size=1).run(iter(frames))
+        next(results)
+        results.close()
+        self.assertEqual(set(threading.enumerate()), threads)
+        self.assertLess(self.archive.post_frame.call_count, len(frames))
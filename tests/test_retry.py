@@ -0,0 +1,121 @@
+from unittest.mock import MagicMock, AsyncMock, patch
+import unittest
+import asyncio
+
+import requests
+
+from ocs_ingester.archive import ArchiveService
+from ocs_ingester.exceptions import BackoffRetryError, RetryError, DoNotRetryError, NonFatalDoNotRetryError
+from ocs_ingester.retry import Retrier, RetryPolicy, RetryBudget, get_retrier
+from ocs_ingester.deadline import Deadline
+
+
+def failing(*exceptions, result='done'):
+    return MagicMock(side_effect=list(exceptions) + [result])
+
+
+@patch('time.sleep')
+class TestRetrier(unittest.TestCase):
+    def setUp(self):
+        self.retrier = Retrier({
+            BackoffRetryError: RetryPolicy(max_attempts=4, base_delay=1, max_delay=3),
+            RetryError: RetryPolicy(max_attempts=2, base_delay=0.5, max_delay=0.5, multiplier=1),
+        })
+
+    def test_retries_until_success(self, sleep_mock):
+        function = failing(BackoffRetryError('blip'), BackoffRetryError('blip'))
+        self.assertEqual(self.retrier.call(function, 'arg', key='value'), 'done')
+        self.assertEqual(function.call_count, 3)
+        function.assert_called_with('arg', key='value')
+        self.assertEqual(sleep_mock.call_count, 2)
+
+    def test_backoff_is_jittered_and_capped(self, sleep_mock):
+        function = failing(*[BackoffRetryError('blip')] * 3)
+        with patch('random.uniform', side_effect=lambda low, high: high) as uniform_mock:
+            self.retrier.call(function)
+        self.assertEqual([args[0] for args, _ in uniform_mock.call_args_list], [0, 0, 0])
+        self.assertEqual([args[0][0] for args in sleep_mock.call_args_list], [1, 2, 3])
+
+    def test_retries_coroutines_without_blocking(self, sleep_mock):
+        function = AsyncMock(side_effect=[BackoffRetryError('blip'), BackoffRetryError('blip'), 'done'])
+        with patch('asyncio.sleep', new_callable=AsyncMock) as async_sleep_mock:
+            self.assertEqual(asyncio.run(self.retrier.call_async(function, 'arg')), 'done')
+        self.assertEqual(function.await_count, 3)
+        self.assertEqual(async_sleep_mock.await_count, 2)
+        sleep_mock.assert_not_called()
+        with patch('asyncio.sleep', new_callable=AsyncMock):
+            with self.assertRaises(DoNotRetryError):
+                asyncio.run(self.retrier.call_async(AsyncMock(side_effect=DoNotRetryError('bad'))))
+
+    def test_max_attempts_per_error_class(self, sleep_mock):
+        function = failing(RetryError('again'), RetryError('again'))
+        with self.assertRaises(RetryError):
+            self.retrier.call(function)
+        self.assertEqual(function.call_count, 2)
+
+    def test_errors_that_must_not_be_retried(self, sleep_mock):
+        for exception in (DoNotRetryError('bad'), NonFatalDoNotRetryError('exists'), ValueError('bug')):
+            function = failing(exception)
+            with self.assertRaises(type(exception)):
+                self.retrier.call(function)
+            self.assertEqual(function.call_count, 1)
+        self.assertFalse(sleep_mock.called)
+
+    def test_max_time(self, sleep_mock):
+        self.retrier.max_time = 0.1
+        function = failing(BackoffRetryError('blip'))
+        with patch('random.uniform', return_value=1), self.assertRaises(BackoffRetryError):
+            self.retrier.call(function)
+        self.assertEqual(function.call_count, 1)
+
+    def test_deadline(self, sleep_mock):
+        self.retrier.deadline = Deadline(0.5)
+        function = failing(BackoffRetryError('blip'))
+        with patch('random.uniform', return_value=1), self.assertRaises(BackoffRetryError):
+            self.retrier.call(function)
+        self.assertEqual(function.call_count, 1)
+
+    def test_budget_limits_retries(self, sleep_mock):
+        self.retrier.budget = RetryBudget(ratio=0, per_second=0, capacity=1)
+        function = failing(*[BackoffRetryError('blip')] * 3)
+        with self.assertRaises(BackoffRetryError):
+            self.retrier.call(function)
+        self.assertEqual(function.call_count, 2)
+
+    def test_get_retrier_from_settings(self, sleep_mock):
+        with patch('ocs_ingester.settings.settings.RETRY_MAX_ATTEMPTS', 1):
+            function = failing(BackoffRetryError('blip'))
+            with self.assertRaises(BackoffRetryError):
+                get_retrier().call(function)
+        with patch('ocs_ingester.settings.settings.RETRY_MAX_ATTEMPTS', 3):
+            self.assertEqual(get_retrier().call(failing(BackoffRetryError('blip'), RetryError('again'))), 'done')
+
+    @patch('requests.Session.get')
+    def test_archive_retries_requests(self, get_mock, sleep_mock):
+        response = MagicMock()
+        response.json.return_value = {'count': 1}
+        get_mock.side_effect = [requests.exceptions.ConnectionError('blip'), response]
+        archive = ArchiveService(api_root='http://fake/', auth_token='', retrier=self.retrier)
+        self.assertTrue(archive.version_exists('md5'))
+        self.assertEqual(get_mock.call_count, 2)
+
+
+class TestRetryBudget(unittest.TestCase):
+    def test_deposits_and_withdrawals(self):
+        budget = RetryBudget(ratio=0.5, per_second=0, capacity=2)
+        self.assertTrue(budget.withdraw())
+        self.assertTrue(budget.withdraw())
+        self.assertFalse(budget.withdraw())
+        budget.deposit()
+        self.assertFalse(budget.withdraw())
+        budget.deposit()
+        self.assertTrue(budget.withdraw())
+
+    def test_refills_over_time(self):
+        budget = RetryBudget(ratio=0, per_second=10, capacity=1)
+        with patch('time.monotonic', return_value=1000):
+            budget._updated = 1000
+            self.assertTrue(budget.withdraw())
+            self.assertFalse(budget.withdraw())
+        with patch('time.monotonic', return_value=1000.1):
+            self.assertTrue(budget.withdraw())
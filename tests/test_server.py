@@ -0,0 +1,98 @@
+from unittest.mock import MagicMock, patch
+import threading
+import unittest
+import tempfile
+import socket
+import os
+
+import opentsdb_python_metrics.metric_wrappers
+
+from ocs_ingester.server import IngestServer, forward_request
+from ocs_ingester.scripts.ingest_frame import CHECK, INGEST, handle_request, run_request
+from ocs_ingester.exceptions import BackoffRetryError
+
+opentsdb_python_metrics.metric_wrappers.test_mode = True
+
+
+FITS_FILE = os.path.join(
+    os.path.dirname(__file__),
+    'test_files/fits/coj1m011-kb05-20150219-0125-e90.fits.fz'
+)
+
+
+class TestIngestServer(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.socket_path = os.path.join(self.directory.name, 'ingester.sock')
+
+    def serve(self, handler):
+        server = IngestServer(self.socket_path, handler, workers=2)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(thread.join)
+        self.addCleanup(server.shutdown)
+        return server
+
+    def test_forward_request(self):
+        handler = MagicMock(return_value=('http://fake/frame', 0))
+        self.serve(handler)
+        request = {'command': INGEST, 'path': '/data/frame.fits.fz', 'args': {}}
+        self.assertEqual(forward_request(self.socket_path, request), ('http://fake/frame', 0))
+        handler.assert_called_once_with(request)
+
+    def test_handler_error(self):
+        self.serve(MagicMock(side_effect=KeyError('command')))
+        self.assertEqual(forward_request(self.socket_path, {}), ("'command'", 1))
+
+    def test_no_server(self):
+        with self.assertRaises(OSError):
+            forward_request(self.socket_path, {})
+
+    def test_replaces_stale_socket(self):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.bind(self.socket_path)
+        self.serve(MagicMock(return_value=('True', 0)))
+        self.assertEqual(forward_request(self.socket_path, {}), ('True', 0))
+
+    def test_refuses_to_replace_running_server_or_file(self):
+        self.serve(MagicMock())
+        with self.assertRaises(OSError):
+            IngestServer(self.socket_path, MagicMock())
+        other_path = os.path.join(self.directory.name, 'file')
+        open(other_path, 'w').close()
+        with self.assertRaises(OSError):
+            IngestServer(other_path, MagicMock())
+        self.assertTrue(os.path.exists(other_path))
+
+
+class TestRequests(unittest.TestCase):
+    @patch('ocs_ingester.scripts.ingest_frame.handle_request', return_value=('True', 0))
+    def test_falls_back_without_server(self, handle_mock):
+        request = {'command': CHECK, 'path': FITS_FILE, 'args': {}}
+        self.assertEqual(run_request(request, '/does/not/exist.sock'), ('True', 0))
+        handle_mock.assert_called_once_with(request)
+
+    @patch('ocs_ingester.scripts.ingest_frame.check_frame_exists', return_value=False)
+    def test_check(self, check_mock):
+        output = handle_request({'command': CHECK, 'path': FITS_FILE, 'args': {'api_root': 'http://fake/'}})
+        self.assertEqual(output, ('False', 1))
+        self.assertEqual(check_mock.call_args[1], {'api_root': 'http://fake/'})
+
+    @patch('ocs_ingester.ingester.upload_file_and_ingest_to_archive', return_value={'url': 'http://fake/frame'})
+    def test_ingest(self, ingest_mock):
+        self.assertEqual(handle_request({'command': INGEST, 'path': FITS_FILE, 'args': {}}), ('http://fake/frame', 0))
+
+    @patch('ocs_ingester.ingester.upload_file_and_ingest_to_archive', side_effect=BackoffRetryError('Unavailable'))
+    def test_ingest_deferred(self, ingest_mock):
+        with tempfile.TemporaryDirectory() as directory:
+            spool_path = os.path.join(directory, 'spool.sqlite3')
+            output = handle_request({'command': INGEST, 'path': FITS_FILE, 'args': {}, 'spool': spool_path})
+            self.assertEqual(output, ('Deferred ingest after error: Unavailable', 0))
+            self.assertEqual(handle_request({'command': INGEST, 'path': FITS_FILE, 'args': {}}),
+                             ('Exception uploading file: Unavailable', 1))
+
+    def test_missing_file(self):
+        output, exit_code = handle_request({'command': INGEST, 'path': '/does/not/exist.fits', 'args': {}})
+        self.assertEqual(exit_code, 1)
@@ -0,0 +1,81 @@
+from unittest.mock import patch
+import unittest
+import tempfile
+import os
+
+from ocs_ingester.batch import IngestOutcome, INGESTED, RETRYABLE, FATAL
+from ocs_ingester.retry import RetryPolicy
+from ocs_ingester.spool import Spool, DEFERRED
+
+
+class TestSpool(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.path = os.path.join(self.directory.name, 'spool.sqlite3')
+        self.spool = Spool(self.path, backoff=RetryPolicy(max_attempts=3, base_delay=10, max_delay=15))
+        self.addCleanup(self.spool.close)
+
+    def test_defer(self):
+        with patch('random.uniform', return_value=1):
+            entry = self.spool.defer('/data/frame.fits', 'Archive unavailable', now=100)
+            self.assertEqual((entry.attempts, entry.next_eligible, entry.first_deferred), (1, 110, 100))
+            entry = self.spool.defer('/data/frame.fits', 'Archive still unavailable', now=110)
+            self.assertEqual((entry.attempts, entry.next_eligible, entry.first_deferred), (2, 125, 100))
+            entry = self.spool.defer('/data/frame.fits', 'Archive still unavailable', now=125)
+            self.assertEqual(entry.next_eligible, 140)
+        self.assertEqual(len(self.spool), 1)
+
+    def test_due(self):
+        with patch('random.uniform', return_value=1):
+            self.spool.defer('/data/later.fits', 'error', now=105)
+            self.spool.defer('/data/sooner.fits', 'error', now=100)
+        self.assertEqual(self.spool.due(now=109), [])
+        self.assertEqual([entry.path for entry in self.spool.due(now=120)], ['/data/sooner.fits', '/data/later.fits'])
+        self.assertEqual([entry.path for entry in self.spool.due(limit=1, now=120)], ['/data/sooner.fits'])
+
+    def test_persisted(self):
+        self.spool.defer('/data/frame.fits', 'Archive unavailable')
+        reopened = Spool(self.path)
+        self.addCleanup(reopened.close)
+        self.assertEqual(len(reopened), 1)
+
+    def test_ingest_args_are_spooled_without_secrets(self):
+        ingest_args = {'api_root': 'http://other/', 'auth_token': 'secret', 'bucket': 'raw', 'file_metadata': {}}
+        self.assertEqual(self.spool.defer('/data/frame.fits', 'error', ingest_args).ingest_args,
+                         {'api_root': 'http://other/', 'bucket': 'raw'})
+        # Including the write-ahead log of the database
+        for filename in os.listdir(self.directory.name):
+            with open(os.path.join(self.directory.name, filename), 'rb') as database:
+                self.assertNotIn(b'secret', database.read())
+
+    @patch('time.sleep')
+    @patch('ocs_ingester.spool.ingest_path')
+    def test_drain(self, ingest_path_mock, sleep_mock):
+        outcomes = {
+            '/data/ingested.fits': IngestOutcome('/data/ingested.fits', INGESTED, 'http://fake/'),
+            '/data/invalid.fits': IngestOutcome('/data/invalid.fits', FATAL, 'Invalid file'),
+            '/data/unavailable.fits': IngestOutcome('/data/unavailable.fits', RETRYABLE, 'Archive unavailable'),
+        }
+        ingest_path_mock.side_effect = lambda path, **kwargs: outcomes[path]
+        for path in outcomes:
+            self.spool.defer(path, 'Archive unavailable', {'bucket': 'raw'}, now=0)
+
+        results = {outcome.path: outcome.status for outcome in self.spool.drain(rate=2, api_root='http://fake/')}
+        self.assertEqual(results, {
+            '/data/ingested.fits': INGESTED, '/data/invalid.fits': FATAL, '/data/unavailable.fits': DEFERRED
+        })
+        ingest_path_mock.assert_any_call('/data/unavailable.fits', api_root='http://fake/', bucket='raw')
+        self.assertEqual([entry.path for entry in self.spool.due(now=float('inf'))], ['/data/unavailable.fits'])
+        self.assertEqual(self.spool.due(now=float('inf'))[0].attempts, 2)
+        self.assertEqual(self.spool.due(now=float('inf'))[0].ingest_args, {'bucket': 'raw'})
+        # The rate limit spaces the ingests out by half a second
+        self.assertEqual(sum(args[0][0] > 0.4 for args in sleep_mock.call_args_list), 2)
+
+    @patch('ocs_ingester.spool.ingest_path')
+    def test_drain_gives_up_after_max_attempts(self, ingest_path_mock):
+        ingest_path_mock.return_value = IngestOutcome('/data/frame.fits', RETRYABLE, 'Archive unavailable')
+        self.spool.defer('/data/frame.fits', 'Archive unavailable', now=0)
+        self.spool.defer('/data/frame.fits', 'Archive unavailable', now=0)
+        self.assertEqual([outcome.status for outcome in self.spool.drain(rate=0)], [RETRYABLE])
+        self.assertEqual(len(self.spool), 0)
@@ -0,0 +1,163 @@
+from unittest.mock import call, patch
+import unittest
+import tempfile
+import hashlib
+import os
+
+from ocs_archive.input.file import File
+from ocs_archive.input.filefactory import FileFactory
+from ocs_archive.storage.filestore import FileStore, FileStoreConnectionError
+
+from ocs_ingester.deadline import Deadline, current_deadline
+from ocs_ingester.exceptions import BackoffRetryError
+from ocs_ingester.storage import (MultipartS3Store, ChunkedFileSystemStore, get_file_store, close_file_stores,
+                                  multipart_etag)
+
+
+FITS_PATH = os.path.join(
+    os.path.dirname(__file__),
+    'test_files/fits/'
+)
+
+FITS_FILE = os.path.join(
+    FITS_PATH,
+    'coj1m011-kb05-20150219-0125-e90.fits.fz'
+)
+
+
+class FakeS3Client(object):
+    """Keeps the parts uploaded to it in memory and responds with ETags the way S3 does"""
+    def __init__(self, corrupt_part=None):
+        self.parts = {}
+        self.objects = {}
+        self.corrupt_part = corrupt_part
+        self.aborted = False
+        self.closed = False
+
+    def put_object(self, Key, Body, **kwargs):
+        self.objects[Key] = Body.read()
+        return {'ETag': '"{0}"'.format(hashlib.md5(self.objects[Key]).hexdigest()), 'VersionId': 'version'}
+
+    def create_multipart_upload(self, **kwargs):
+        return {'UploadId': 'upload'}
+
+    def upload_part(self, PartNumber, Body, **kwargs):
+        if PartNumber == self.corrupt_part:
+            Body = Body[:-1]
+        self.parts[PartNumber] = Body
+        return {'ETag': '"{0}"'.format(hashlib.md5(Body).hexdigest())}
+
+    def complete_multipart_upload(self, MultipartUpload, **kwargs):
+        digests = [hashlib.md5(self.parts[part['PartNumber']]).digest() for part in MultipartUpload['Parts']]
+        return {'ETag': '"{0}"'.format(multipart_etag(digests)), 'VersionId': 'version'}
+
+    def abort_multipart_upload(self, **kwargs):
+        self.aborted = True
+
+    def close(self):
+        self.closed = True
+
+
+@patch('ocs_ingester.settings.settings.MULTIPART_THRESHOLD', 10000)
+@patch('ocs_ingester.settings.settings.MULTIPART_PART_SIZE', 4096)
+@patch('ocs_ingester.settings.settings.MULTIPART_CONCURRENCY', 3)
+class TestMultipartS3Store(unittest.TestCase):
+    def setUp(self):
+        self.fileobj = open(FITS_FILE, 'rb')
+        self.addCleanup(self.fileobj.close)
+        self.data = self.fileobj.read()
+        self.datafile = FileFactory.get_datafile_class_for_extension('.fits.fz')(File(self.fileobj))
+
+    def test_multipart_upload(self):
+        client = FakeS3Client()
+        version = MultipartS3Store(bucket='bucket', client=client).store_file(self.datafile)
+        self.assertEqual(version, {'key': 'version', 'md5': hashlib.md5(self.data).hexdigest(), 'extension': '.fits.fz'})
+        self.assertEqual(len(client.parts), (len(self.data) + 4095) // 4096)
+        self.assertEqual(b''.join(client.parts[number] for number in sorted(client.parts)), self.data)
+
+    def test_corrupt_part_aborts_upload(self):
+        client = FakeS3Client(corrupt_part=2)
+        with self.assertRaises(FileStoreConnectionError):
+            MultipartS3Store(bucket='bucket', client=client).store_file(self.datafile)
+        self.assertTrue(client.aborted)
+
+    def test_deadline_aborts_upload(self):
+        client = FakeS3Client()
+        deadline = Deadline(60)
+        with patch.object(MultipartS3Store, 'client_for', return_value=client):
+            with current_deadline(deadline), self.assertRaises(FileStoreConnectionError):
+                deadline.expires_at = 0
+                MultipartS3Store(bucket='bucket', client=client).store_file(self.datafile)
+        self.assertFalse(client.parts)
+        self.assertTrue(client.aborted)
+
+    def test_passed_deadline_starts_no_upload(self):
+        client = FakeS3Client()
+        with current_deadline(Deadline(0)), self.assertRaises(BackoffRetryError):
+            MultipartS3Store(bucket='bucket', client=client).store_file(self.datafile)
+        self.assertFalse(client.aborted)
+
+    @patch('ocs_ingester.settings.settings.S3_READ_TIMEOUT', 60)
+    @patch('ocs_ingester.storage.create_s3_client', side_effect=lambda endpoint_url, read_timeout: FakeS3Client())
+    def test_uploads_with_a_deadline_are_bounded_by_it(self, create_mock):
+        filestore = MultipartS3Store(bucket='bucket', client=FakeS3Client())
+        with patch('ocs_ingester.settings.settings.MULTIPART_THRESHOLD', len(self.data) + 1):
+            with current_deadline(Deadline(10)):
+                filestore.store_file(self.datafile)
+                filestore.store_file(self.datafile)
+        self.assertEqual(create_mock.call_args_list, [call(None, 8.0)])
+        self.assertIs(filestore.client_for(Deadline(9)), filestore.client_for(Deadline(15)))
+        self.assertIsNot(filestore.client_for(Deadline(100)), filestore.client_for(Deadline(15)))
+        self.assertIs(filestore.client_for(None), filestore.client)
+        self.assertEqual(create_mock.call_args_list[-1], call(None, 60))
+
+    def test_small_files_use_single_upload(self):
+        client = FakeS3Client()
+        with patch('ocs_ingester.settings.settings.MULTIPART_THRESHOLD', len(self.data) + 1):
+            version = MultipartS3Store(bucket='bucket', client=client).store_file(self.datafile)
+        self.assertEqual(version, {'key': 'version', 'md5': hashlib.md5(self.data).hexdigest(), 'extension': '.fits.fz'})
+        self.assertEqual(list(client.objects.values()), [self.data])
+        self.assertFalse(client.parts)
+
+
+class TestChunkedFileSystemStore(unittest.TestCase):
+    def setUp(self):
+        self.fileobj = open(FITS_FILE, 'rb')
+        self.addCleanup(self.fileobj.close)
+        self.datafile = FileFactory.get_datafile_class_for_extension('.fits.fz')(File(self.fileobj))
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.filestore = ChunkedFileSystemStore(root_dir=self.directory.name)
+
+    @patch('ocs_ingester.storage.FILESYSTEM_CHUNK_SIZE', 4096)
+    def test_store_file(self):
+        version = self.filestore.store_file(self.datafile)
+        with open(os.path.join(self.directory.name, self.datafile.get_filestore_path()), 'rb') as stored:
+            self.assertEqual(hashlib.md5(stored.read()).hexdigest(), version['md5'])
+
+    def test_deadline_leaves_no_partial_file(self):
+        with current_deadline(Deadline(0)), self.assertRaises(BackoffRetryError):
+            self.filestore.store_file(self.datafile)
+        self.assertEqual([files for _, _, files in os.walk(self.directory.name) if files], [])
+
+
+class TestGetFileStore(unittest.TestCase):
+    def tearDown(self):
+        close_file_stores()
+
+    def test_get_file_store(self):
+        self.assertIsInstance(get_file_store('s3'), MultipartS3Store)
+        self.assertIs(type(get_file_store('dummy')), FileStore)
+        self.assertIsInstance(get_file_store('local'), ChunkedFileSystemStore)
+
+    def test_file_stores_are_reused_for_the_same_configuration(self):
+        self.assertIs(get_file_store('s3', bucket='bucket'), get_file_store('s3', bucket='bucket'))
+        self.assertIsNot(get_file_store('s3', bucket='bucket'), get_file_store('s3', bucket='other'))
+        self.assertEqual(get_file_store('s3', bucket='other').bucket, 'other')
+
+    def test_close_file_stores(self):
+        filestore = get_file_store('s3', bucket='bucket')
+        client = filestore._client = FakeS3Client()
+        close_file_stores()
+        self.assertTrue(client.closed)
+        self.assertIsNot(get_file_store('s3', bucket='bucket'), filestore)
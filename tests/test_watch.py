@@ -0,0 +1,183 @@
+from unittest.mock import patch
+import unittest
+import threading
+import tempfile
+import time
+import sys
+import os
+
+from ocs_ingester.batch import IngestOutcome, INGESTED, RETRYABLE
+from ocs_ingester.spool import Spool
+from ocs_ingester.retry import RetryPolicy
+from ocs_ingester.watch import IngestWatcher
+
+
+class TestIngestWatcher(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.done = tempfile.TemporaryDirectory()
+        self.addCleanup(self.done.cleanup)
+
+    def write(self, filename, data=b'data'):
+        path = os.path.join(self.directory.name, filename)
+        with open(path, 'ab') as fileobj:
+            fileobj.write(data)
+        return path
+
+    def test_files_settle_before_ingesting(self):
+        watcher = IngestWatcher([self.directory.name], settle_time=5)
+        path = self.write('frame.fits')
+        watcher.file_changed(path, now=0)
+        self.assertEqual(watcher.settled(now=4), [])
+        watcher.file_changed(path, now=4)
+        self.assertEqual(watcher.settled(now=6), [])
+        self.assertEqual(watcher.settled(now=9), [path])
+        self.assertEqual(watcher.settled(now=20), [])
+
+    def test_files_that_keep_growing_are_not_ingested(self):
+        watcher = IngestWatcher([self.directory.name], settle_time=5)
+        path = self.write('frame.fits')
+        watcher.file_changed(path, now=0)
+        self.write('frame.fits')
+        self.assertEqual(watcher.settled(now=5), [])
+        self.assertEqual(watcher.settled(now=10), [path])
+
+    def test_hidden_and_removed_files_are_ignored(self):
+        watcher = IngestWatcher([self.directory.name], settle_time=0)
+        hidden = self.write('.frame.fits.Xa12')
+        removed = self.write('frame.fits')
+        watcher.file_changed(hidden, now=0)
+        watcher.file_changed(removed, now=0)
+        os.remove(removed)
+        self.assertEqual(watcher.settled(now=1), [])
+
+    def test_scan_finds_existing_files(self):
+        watcher = IngestWatcher([self.directory.name], settle_time=0)
+        path = self.write('frame.fits')
+        watcher.scan()
+        self.assertEqual(watcher.settled(), [path])
+
+    @patch('ocs_ingester.watch.ingest_path')
+    def test_move_after_ingest(self, ingest_path_mock):
+        path = self.write('frame.fits')
+        ingest_path_mock.return_value = IngestOutcome(path, INGESTED, 'http://fake/frame.fits')
+        watcher = IngestWatcher([self.directory.name], after_ingest=IngestWatcher.MOVE,
+                                done_directory=self.done.name, api_root='http://fake/')
+        watcher.ingest(path)
+        ingest_path_mock.assert_called_with(path, api_root='http://fake/')
+        self.assertFalse(os.path.exists(path))
+        self.assertTrue(os.path.exists(os.path.join(self.done.name, 'frame.fits')))
+
+    @patch('ocs_ingester.watch.ingest_path')
+    def test_failed_files_are_left_in_place(self, ingest_path_mock):
+        path = self.write('frame.fits')
+        ingest_path_mock.return_value = IngestOutcome(path, RETRYABLE, 'archive unavailable')
+        watcher = IngestWatcher([self.directory.name], after_ingest=IngestWatcher.DELETE)
+        watcher.ingest(path)
+        self.assertTrue(os.path.exists(path))
+
+    @patch('ocs_ingester.watch.ingest_path')
+    def test_retryable_files_are_deferred(self, ingest_path_mock):
+        path = self.write('frame.fits')
+        ingest_path_mock.return_value = IngestOutcome(path, RETRYABLE, 'archive unavailable')
+        spool = Spool(os.path.join(self.done.name, 'spool.sqlite3'))
+        self.addCleanup(spool.close)
+        IngestWatcher([self.directory.name], spool=spool, bucket='raw').ingest(path)
+        self.assertEqual([(entry.path, entry.ingest_args) for entry in spool.due(now=float('inf'))],
+                         [(path, {'bucket': 'raw'})])
+
+    @patch('ocs_ingester.watch.ingest_path')
+    def test_retryable_files_are_queued_again(self, ingest_path_mock):
+        path = self.write('frame.fits')
+        ingest_path_mock.return_value = IngestOutcome(path, RETRYABLE, 'archive unavailable')
+        watcher = IngestWatcher([self.directory.name],
+                                retry_backoff=RetryPolicy(max_attempts=3, base_delay=10, max_delay=10))
+        watcher.ingest(path)
+        self.assertEqual(watcher.due_retries(now=time.monotonic()), [])
+        self.assertEqual(watcher.settled(now=time.monotonic() + 11), [path])
+        # Not queued twice while it is being ingested
+        self.assertEqual(watcher.due_retries(now=float('inf')), [])
+        watcher._in_flight.clear()
+
+        # Given up on after the last attempt
+        watcher.ingest(path)
+        self.assertEqual(watcher.due_retries(now=time.monotonic() + 11), [path])
+        watcher.ingest(path)
+        self.assertEqual(watcher.due_retries(now=float('inf')), [])
+        self.assertTrue(os.path.exists(path))
+
+    @patch('ocs_ingester.watch.ingest_path')
+    def test_retries_are_forgotten_once_ingested(self, ingest_path_mock):
+        path = self.write('frame.fits')
+        watcher = IngestWatcher([self.directory.name])
+        ingest_path_mock.return_value = IngestOutcome(path, RETRYABLE, 'archive unavailable')
+        watcher.ingest(path)
+        ingest_path_mock.return_value = IngestOutcome(path, INGESTED, 'http://fake/frame.fits')
+        watcher.ingest(path)
+        self.assertEqual(watcher.due_retries(now=float('inf')), [])
+
+    def test_move_requires_done_directory(self):
+        with self.assertRaises(ValueError):
+            IngestWatcher([self.directory.name], after_ingest=IngestWatcher.MOVE)
+
+    @unittest.skipUnless(sys.platform.startswith('linux'), 'inotify is only available on linux')
+    @patch('ocs_ingester.watch.ingest_path')
+    def test_run(self, ingest_path_mock):
+        existing = self.write('existing.fits')
+        ingested = []
+        done = threading.Event()
+
+        def ingest(path, **kwargs):
+            ingested.append(path)
+            if len(ingested) == 2:
+                done.set()
+            return IngestOutcome(path, INGESTED, '')
+
+        ingest_path_mock.side_effect = ingest
+        watcher = IngestWatcher([self.directory.name], workers=2, settle_time=0.1, after_ingest=IngestWatcher.DELETE)
+        thread = threading.Thread(target=watcher.run)
+        thread.start()
+        try:
+            new = self.write('new.fits')
+            self.assertTrue(done.wait(10))
+        finally:
+            watcher.stop()
+            thread.join(10)
+        self.assertEqual(sorted(ingested), sorted([existing, new]))
+        self.assertEqual(os.listdir(self.directory.name), [])
+
+    @unittest.skipUnless(sys.platform.startswith('linux'), 'inotify is only available on linux')
+    @patch('ocs_ingester.watch.ingest_path')
+    def test_stop_while_workers_are_busy(self, ingest_path_mock):
+        for filename in ('frame1.fits', 'frame2.fits', 'frame3.fits'):
+            self.write(filename)
+        ingested = []
+        release = threading.Event()
+
+        def ingest(path, **kwargs):
+            ingested.append(path)
+            release.wait(10)
+            return IngestOutcome(path, INGESTED, '')
+
+        ingest_path_mock.side_effect = ingest
+        watcher = IngestWatcher([self.directory.name], workers=1, queue_size=1, settle_time=0)
+        thread = threading.Thread(target=watcher.run)
+        thread.start()
+        try:
+            # One file is being ingested, one is queued and one is waiting for room in the queue
+            for _ in range(100):
+                if watcher.queue.full() and len(watcher._in_flight) == 3:
+                    break
+                time.sleep(0.05)
+            watcher.stop()
+            for _ in range(100):
+                if len(watcher._in_flight) == 2:
+                    break
+                time.sleep(0.05)
+            self.assertEqual(len(watcher._in_flight), 2)
+        finally:
+            release.set()
+            thread.join(10)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(len(ingested), 2)